@@ -2,25 +2,62 @@
 
 """The API module contains most of the important functions for KTC and wrappers for the rest"""
 
-import contextlib
-import sqlite3
 from fractions import Fraction
-from typing import Dict, List, Tuple
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
 
 try:
+    import batch_maths  # type: ignore
+    import cache  # type: ignore
+    import catalog  # type: ignore
     import converter  # type: ignore
+    import db  # type: ignore
+    import jobs  # type: ignore
     import main  # type: ignore
+    import metrics  # type: ignore
 except ModuleNotFoundError:
     from ktc import main  # type: ignore
     from ktc import converter  # type: ignore
+    from ktc import catalog  # type: ignore
+    from ktc import db  # type: ignore
+    from ktc import cache  # type: ignore
+    from ktc import batch_maths  # type: ignore
+    from ktc import metrics  # type: ignore
+    from ktc import jobs  # type: ignore
 
 import os
+import shutil
+import tempfile
 
 path_to_database = os.path.abspath(
     os.path.join(os.path.dirname(__file__), os.pardir, "data/monsters.db")
 )
 db_location = path_to_database
 
+# get_list_of_monsters is answered from an in-memory copy of the catalog, which
+# is only reloaded when the DB is re-ingested. Set KTC_CATALOG_ENGINE=0 to query
+# SQLite directly instead.
+use_catalog_engine = os.environ.get("KTC_CATALOG_ENGINE", "1") != "0"
+
+# Results of get_list_of_monsters, keyed by DB, build id, catalog version and canonical constraints
+monster_list_cache = cache.LRUCache(
+    "monster_lists", int(os.environ.get("KTC_MONSTER_CACHE_SIZE", "128")))
+
+# The facet lists served by get_bootstrap, keyed by DB, build id and catalog version
+bootstrap_cache = cache.LRUCache("bootstrap", 4)
+
+# The largest party, in characters, that the API plans encounters for, and the
+# highest character level. The encounter generator's exact solver needs memory
+# in proportion to the party's XP, so parties are bounded before they get there.
+max_party_size = int(os.environ.get("KTC_MAX_PARTY_SIZE", "20"))
+max_character_level = len(main.xp_thresholds) - 1
+
+monster_columns = "name, cr, size, type, tags, section, alignment, sources, fid, hp, ac, init"
+# What each column of a formatted monster is sorted by, and the columns a search looks through
+sort_columns = ["name", "crvalue", "size", "type", "tags", "section", "alignment", "sources",
+                "fid", "hp", "ac", "CAST(init AS INTEGER)"]
+search_columns = ["name", "cr", "size", "type",
+                  "tags", "section", "alignment", "sources"]
+
 
 def sort_sizes(size_list: List[str]) -> List[str]:
     """
@@ -55,26 +92,19 @@ def sort_sizes(size_list: List[str]) -> List[str]:
 
 def get_list_of_environments() -> List[str]:
     """Returns a deduplicated list of environments from the monster table"""
-    with contextlib.closing(sqlite3.connect(db_location)) as conn:
+    with db.connection(db_location) as conn:
         cursor = conn.cursor()
 
-        cursor.execute("""SELECT DISTINCT environment FROM monsters""")
-        unique_environments = [item[0] for item in cursor.fetchall()]
-
-    set_of_environments = set()
-    for environment in unique_environments:
-        for env in environment.split(","):
-            set_of_environments.add(env.strip())
+        cursor.execute("""SELECT name FROM environments""")
+        environments = [item[0] for item in cursor.fetchall()]
 
-    environments = [env for env in list(
-        set_of_environments) if env != ""]
     environments.sort()
     return environments
 
 
 def get_list_of_sizes() -> List[str]:
     """Returns a unique list of monster sizes from the monster table"""
-    with contextlib.closing(sqlite3.connect(db_location)) as conn:
+    with db.connection(db_location) as conn:
         cursor = conn.cursor()
 
         cursor.execute("""SELECT DISTINCT size FROM monsters""")
@@ -86,7 +116,7 @@ def get_list_of_sizes() -> List[str]:
 
 def get_list_of_monster_types() -> List[str]:
     """Returns a unique list of monster types from the monsters table"""
-    with contextlib.closing(sqlite3.connect(db_location)) as conn:
+    with db.connection(db_location) as conn:
         cursor = conn.cursor()
 
         cursor.execute("""SELECT DISTINCT type FROM monsters""")
@@ -98,22 +128,22 @@ def get_list_of_monster_types() -> List[str]:
 
 def get_list_of_challenge_ratings() -> List[str]:
     """Returns a unique list of challenge ratings from the monsters table"""
-    with contextlib.closing(sqlite3.connect(db_location)) as conn:
+    with db.connection(db_location) as conn:
         cursor = conn.cursor()
 
-        cursor.execute("""SELECT DISTINCT cr FROM monsters""")
+        cursor.execute(
+            """SELECT cr FROM monsters GROUP BY crvalue, cr ORDER BY crvalue, cr""")
         unique_crs = [item[0] for item in cursor.fetchall()]
 
-    unique_crs.sort(key=Fraction)
     return unique_crs
 
 
 def get_list_of_alignments() -> List[str]:
     """Returns a unique list of alignments from the monsters table"""
-    with contextlib.closing(sqlite3.connect(db_location)) as conn:
+    with db.connection(db_location) as conn:
         cursor = conn.cursor()
 
-        cursor.execute("""SELECT DISTINCT alignment FROM monsters""")
+        cursor.execute("""SELECT name FROM alignments""")
         unique_alignments = [
             item[0].lower() for item in cursor.fetchall() if not " or " in item[0]
         ]
@@ -132,7 +162,7 @@ def get_list_of_sources() -> List[str]:
     Returns:
         List[str]: A list containing the names of all official source books in the DB
     """
-    with contextlib.closing(sqlite3.connect(db_location)) as conn:
+    with db.connection(db_location) as conn:
         cursor = conn.cursor()
 
         cursor.execute(
@@ -143,17 +173,53 @@ def get_list_of_sources() -> List[str]:
     sources.sort()
     return sources
 
-# TODO Split paraneter sanitisation and query construction into separate functions
+def get_bootstrap() -> Dict[str, List[str]]:
+    """Returns every list the page needs to build its filters, as one dict
 
+    The lists are only read from the DB once per catalog version, and are shared
+    between calls, so they must not be modified.
 
-def get_list_of_monsters(parameters: Dict) -> Dict[str, List[List[str]]]:
-    """Query the database for monsters matching the parameters passed and return a list
+    Returns:
+        Dict[str, List[str]]: the lists of sources, environments, sizes, types, alignments,
+            challenge ratings ("crs") and unofficial sources ("unofficialsources")
+    """
+    key = (os.path.abspath(db_location), *converter.get_catalog_state(db_location))
+    return bootstrap_cache.get_or_compute(key, lambda: {
+        "sources": get_list_of_sources(),
+        "environments": get_list_of_environments(),
+        "sizes": get_list_of_sizes(),
+        "types": get_list_of_monster_types(),
+        "alignments": get_list_of_alignments(),
+        "crs": get_list_of_challenge_ratings(),
+        "unofficialsources": get_unofficial_sources(),
+    })
+
+
+class MonsterConstraints(NamedTuple):
+    """The sanitised form of the parameters passed to get_list_of_monsters"""
+    environments: List[str]
+    sizes: List[str]
+    sources: List[str]
+    types: List[str]
+    alignments: List[str]
+    challenge_ratings: Optional[Tuple[float, float]]
+    hp: Optional[Tuple[float, float]]
+    ac: Optional[Tuple[float, float]]
+    init: Optional[Tuple[float, float]]
+    allow_legendary: bool
+    allow_named: bool
+
+
+def parse_monster_parameters(parameters: Dict, official_sources: Optional[List[str]] = None) -> MonsterConstraints:
+    """Sanitises the parameters passed to get_list_of_monsters
 
     Args:
         parameters (Dict): a dict of parameters, consisting of column names: [acceptable values]
+        official_sources (Optional[List[str]]): the sources to use if none are given;
+            looked up with get_list_of_sources if not passed
 
     Returns:
-        Dict[str, List[List[Any]]]: a dict where the value of "data" is the list of monster info
+        MonsterConstraints: the constraints described by the parameters
     """
 
     # Here we go through the parameters and split each into an individual variable
@@ -176,7 +242,9 @@ def get_list_of_monsters(parameters: Dict) -> Dict[str, List[List[str]]]:
         source_constraints = [param.split("_")[1]
                               for param in parameters["sources"]]
     except (KeyError, IndexError):
-        source_constraints = get_list_of_sources()
+        if official_sources is None:
+            official_sources = get_list_of_sources()
+        source_constraints = list(official_sources)
 
     try:
         source_constraints += [param.split("_")[1]
@@ -184,8 +252,6 @@ def get_list_of_monsters(parameters: Dict) -> Dict[str, List[List[str]]]:
     except (KeyError, IndexError):
         pass
 
-    print(source_constraints)
-
     try:
         type_constraints = [param.split("_")[1]
                             for param in parameters["types"]]
@@ -199,14 +265,12 @@ def get_list_of_monsters(parameters: Dict) -> Dict[str, List[List[str]]]:
     except (KeyError, IndexError):
         alignment_constraints = []
 
-    try:
-        challenge_rating_minimum = parameters["minimumChallengeRating"]
-    except (KeyError, IndexError):
-        challenge_rating_minimum = None
-    try:
-        challenge_rating_maximum = parameters["maximumChallengeRating"]
-    except (KeyError, IndexError):
-        challenge_rating_maximum = None
+    # CRs may be fractions, such as "1/4"
+    challenge_rating_range = parse_range(
+        parameters, "minimumChallengeRating", "maximumChallengeRating", Fraction)
+    hp_range = parse_range(parameters, "minimumHp", "maximumHp")
+    ac_range = parse_range(parameters, "minimumAc", "maximumAc")
+    init_range = parse_range(parameters, "minimumInit", "maximumInit")
 
     try:
         if parameters["allowLegendary"] and parameters["allowLegendary"] == "false":
@@ -224,90 +288,207 @@ def get_list_of_monsters(parameters: Dict) -> Dict[str, List[List[str]]]:
     except (KeyError, IndexError):
         allow_named = True
 
-    # Oh, this is clumsy, I hate this
+    return MonsterConstraints(environment_constraints, size_constraints, source_constraints,
+                              type_constraints, alignment_constraints, challenge_rating_range,
+                              hp_range, ac_range, init_range, allow_legendary, allow_named)
+
+
+def canonical_constraints(constraints: MonsterConstraints) -> Tuple:
+    """Puts constraints into a hashable form that doesn't depend on the order or repetition of values
+
+    Args:
+        constraints (MonsterConstraints): constraints, as returned by parse_monster_parameters
+
+    Returns:
+        Tuple: the constraints, with every list of values sorted and deduplicated
+    """
+    return tuple(tuple(sorted(set(constraint))) if isinstance(constraint, list) else constraint
+                 for constraint in constraints)
+
+
+def parse_range(parameters: Dict, minimum_key: str, maximum_key: str,
+                convert: Callable[[Any], Any] = float) -> Optional[Tuple[float, float]]:
+    """Reads a pair of numeric bounds from the parameters; a missing bound is unbounded
+
+    Returns:
+        Optional[Tuple[float, float]]: the inclusive range, or None if neither bound is given
+    """
+    bounds = []
+    for (key, default) in [(minimum_key, float("-inf")), (maximum_key, float("inf"))]:
+        try:
+            bounds.append(float(convert(parameters[key])))
+        except (KeyError, TypeError, ValueError, ZeroDivisionError):
+            bounds.append(default)
+
+    if bounds == [float("-inf"), float("inf")]:
+        return None
+    return (bounds[0], bounds[1])
+
+
+def format_monster(monster: Sequence[Any]) -> List[str]:
+    """Converts a row of monster columns into the strings returned by the API
+
+    Args:
+        monster (Sequence[Any]): name, cr, size, type, tags, section, alignment, sources, fid, hp, ac, init
+
+    Returns:
+        List[str]: the same columns as strings, with sources linked where possible
+    """
+    modified_monster = list(monster)
+
+    # convert sources with links to hrefs
+    sources = monster[7].split(",")
+    linked_sources = []
+    for source in sources:
+        (source_name, index) = converter.split_source_from_index(source)
+        if "http" in index:
+            linked_sources.append(
+                f"<a target='_blank' href='{index}''>{source_name}</a>")
+        else:
+            linked_sources.append(f"{source_name}: {index}")
+
+    modified_monster[7] = ', '.join(linked_sources)
+
+    return [str(prop).strip() for prop in modified_monster]
+
+
+def get_page_of_monsters(parameters: Dict, start: int = 0, length: int = -1, search: str = "",
+                         order_column: int = 0, descending: bool = False) -> Dict[str, Any]:
+    """Find one page of the monsters matching the parameters passed, for DataTables' server-side processing
+
+    Args:
+        parameters (Dict): a dict of parameters, as for get_list_of_monsters
+        start (int, optional): the index of the first monster of the page. Defaults to 0.
+        length (int, optional): the size of the page, or -1 for every monster. Defaults to -1.
+        search (str, optional): whitespace separated words that must each appear in the monster's
+            name, CR, size, type, tags, section, alignment or sources. Defaults to "".
+        order_column (int, optional): the column to sort by, counting from 0. Defaults to 0, the name.
+        descending (bool, optional): whether to sort in descending order. Defaults to False.
+
+    Returns:
+        Dict[str, Any]: a dict with the page of monster info as "data", the number of monsters matching
+            the parameters as "recordsTotal" and the number of those that match the search as "recordsFiltered"
+    """
+    start = max(start, 0)
+    if order_column not in range(len(sort_columns)):
+        order_column = 0
+
+    if use_catalog_engine:
+        monster_catalog = catalog.get_catalog(db_location, format_monster)
+        constraints = parse_monster_parameters(
+            parameters, monster_catalog.official_sources)
+        page = monster_catalog.query_page(
+            constraints, start, length, search, order_column, descending)
+    else:
+        constraints = parse_monster_parameters(parameters)
+        page = query_page_of_monsters(
+            constraints, start, length, search, order_column, descending)
+
+    (total, filtered, monsters) = page
+    return {"recordsTotal": total, "recordsFiltered": filtered, "data": monsters}
+
+
+def get_list_of_monsters(parameters: Dict) -> Dict[str, List[List[str]]]:
+    """Query the database for monsters matching the parameters passed and return a list
+
+    The in-memory catalog answers the query unless use_catalog_engine is False;
+    either way the result is the same.
+
+    Results are cached in monster_list_cache until the catalog version changes, and
+    are shared between calls, so they must not be modified.
+
+    Args:
+        parameters (Dict): a dict of parameters, consisting of column names: [acceptable values]
+
+    Returns:
+        Dict[str, List[List[Any]]]: a dict where the value of "data" is the list of monster info
+    """
+    (build, version) = converter.get_catalog_state(db_location)
+    if use_catalog_engine:
+        monster_catalog = catalog.get_catalog(db_location, format_monster)
+        constraints = parse_monster_parameters(
+            parameters, monster_catalog.official_sources)
+
+        def query() -> List[List[str]]:
+            return monster_catalog.query(constraints)
+    else:
+        constraints = parse_monster_parameters(parameters)
+
+        def query() -> List[List[str]]:
+            return query_monsters(constraints)
+
+    key = (os.path.abspath(db_location), build, version, canonical_constraints(constraints))
+    return monster_list_cache.get_or_compute(key, lambda: {"data": query()})
+
+
+def get_facet_counts(parameters: Dict) -> Dict[str, Dict[str, int]]:
+    """Count how many monsters each facet value would give if it were the only one selected for its facet
+
+    These are disjunctive counts: the environment counts honour every parameter except
+    the environments, and so on. They are always taken from the catalog's bitmaps, as
+    counting with SQL would take a query per facet.
+
+    Args:
+        parameters (Dict): a dict of parameters, as for get_list_of_monsters
+
+    Returns:
+        Dict[str, Dict[str, int]]: the number of monsters for each value of the environments,
+            sizes, types, alignments and sources, keyed by facet then value
+    """
+    monster_catalog = catalog.get_catalog(db_location, format_monster)
+    constraints = parse_monster_parameters(
+        parameters, monster_catalog.official_sources)
+    return monster_catalog.facet_counts(constraints)
+
+
+def monster_filter(constraints: MonsterConstraints) -> Tuple[str, List[Any]]:
+    """Build the WHERE clause that selects the monsters matching the constraints passed
+
+    Args:
+        constraints (MonsterConstraints): constraints, as returned by parse_monster_parameters
+
+    Returns:
+        Tuple[str, List[Any]]: the WHERE clause (or "" if there are no constraints), and its arguments
+    """
+    environment_constraints = constraints.environments
+    size_constraints = constraints.sizes
+    source_constraints = constraints.sources
+    type_constraints = constraints.types
+    alignment_constraints = constraints.alignments
+
     where_requirements = ""
-    query_arguments = []
-    query_from = "monsters"
-    # TODO: Refactor to store CRs as floats and convert to fractions
-    possible_challenge_ratings = [
-        "0",
-        "1/8",
-        "1/4",
-        "1/2",
-        "1",
-        "2",
-        "3",
-        "4",
-        "5",
-        "6",
-        "7",
-        "8",
-        "9",
-        "10",
-        "11",
-        "12",
-        "13",
-        "14",
-        "15",
-        "16",
-        "17",
-        "18",
-        "19",
-        "20",
-        "21",
-        "22",
-        "23",
-        "24",
-        "25",
-        "26",
-        "27",
-        "28",
-        "29",
-        "30",
-    ]
+    query_arguments: List[Any] = []
 
     # SO
     # If we have size constraints, we construct a string of placeholders,
     # then put that into a IN subquery
     # and then append the constraints to the query_arguments list
 
-    # Create a custom select with "environment like x or..." for every environment in constraints
+    # Environments, sources and alignments are multi-valued, so they are matched
+    # against their (small) dimension tables and joined back to the monsters
+    # through the junction tables built by converter.rebuild_facet_tables
     if environment_constraints != []:
-        query_from = f"(SELECT * FROM {query_from} WHERE "
-        for i, constraint in enumerate(environment_constraints):
-            query_from += "environment LIKE ? OR "
-            environment_constraints[i] = f"%{constraint}%"
-        query_from = query_from[:-4]
-        query_from += ")"
-        query_arguments += environment_constraints
-
-    # Create a custom select with "sourcehashes like x or", then get the source
-    # hash for every specified source
-    #
-    # You need to do this because of wildcards surrounding the source name
-    # Which makes me wonder if you need to be using those wildcards at all...
+        environment_likes = " OR ".join(
+            ["environments.name LIKE ?"]*len(environment_constraints))
+        where_requirements += f"""rowid IN (SELECT monster_id FROM monster_environments
+            JOIN environments ON environments.id = environment_id WHERE {environment_likes}) AND """
+        query_arguments += [
+            f"%{constraint}%" for constraint in environment_constraints]
+
     if source_constraints != []:
-        query_from = f"(SELECT * FROM {query_from} WHERE "
-        constraint_hashes = []
-        with contextlib.closing(sqlite3.connect(db_location, uri=True)) as conn:
-            cursor = conn.cursor()
-            for constraint in source_constraints:
-                cursor.execute(
-                    '''SELECT hash FROM sources WHERE name = ?''', (constraint,))
-                constraint_hashes.append(f"%{cursor.fetchone()[0]}%")
-                query_from += "sourcehashes LIKE ? OR "
-        query_from = query_from[:-4]
-        query_from += ")"
-        query_arguments += constraint_hashes
+        source_placeholders = f"({', '.join(['?']*len(source_constraints))})"
+        where_requirements += f"""rowid IN (SELECT monster_id FROM monster_sources
+            JOIN source_ids ON source_ids.id = source_id
+            WHERE source_ids.hash IN (SELECT hash FROM sources WHERE name IN {source_placeholders})) AND """
+        query_arguments += source_constraints
 
     if alignment_constraints != []:
-        query_from = f"(SELECT * FROM {query_from} WHERE "
-        for i, constraint in enumerate(alignment_constraints):
-            query_from += "alignment LIKE ? OR "
-            alignment_constraints[i] = f"%{constraint}%"
-        query_from = query_from[:-4]
-        query_from += ")"
-        query_arguments += alignment_constraints
+        alignment_likes = " OR ".join(
+            ["alignments.name LIKE ?"]*len(alignment_constraints))
+        where_requirements += f"""rowid IN (SELECT monster_id FROM monster_alignments
+            JOIN alignments ON alignments.id = alignment_id WHERE {alignment_likes}) AND """
+        query_arguments += [
+            f"%{constraint}%" for constraint in alignment_constraints]
 
     if size_constraints != []:
         size_query_placeholders = f"({', '.join(['?']*len(size_constraints))})"
@@ -319,29 +500,22 @@ def get_list_of_monsters(parameters: Dict) -> Dict[str, List[List[str]]]:
         where_requirements += f"type IN {type_query_placeholders} AND "
         query_arguments += type_constraints
 
-    if challenge_rating_minimum is not None or challenge_rating_maximum is not None:
-        if challenge_rating_minimum is None:
-            min_cr = possible_challenge_ratings[0]
-        else:
-            min_cr = challenge_rating_minimum
-        if challenge_rating_maximum is None:
-            max_cr = possible_challenge_ratings[-1]
-        else:
-            max_cr = challenge_rating_maximum
-
-        mindex = possible_challenge_ratings.index(min_cr)
-        maxdex = possible_challenge_ratings.index(max_cr)+1
-        no_of_placeholders = len(possible_challenge_ratings[mindex:maxdex])
-        challenge_rating_placeholders = (
-            f"({', '.join(['?']*no_of_placeholders)})"
-        )
-        where_requirements += f"cr IN {challenge_rating_placeholders} AND "
-        query_arguments += possible_challenge_ratings[mindex:maxdex]
-
-    if allow_legendary is not True:
+    # hp and ac are only compared when they are numbers; anything stored as text,
+    # such as a blank ac, never falls between two numbers
+    for (column, value_range) in [("crvalue", constraints.challenge_ratings),
+                                  ("hp", constraints.hp),
+                                  ("ac", constraints.ac),
+                                  ("CAST(init AS INTEGER)", constraints.init)]:
+        if value_range is not None:
+            where_requirements += f"{column} BETWEEN ? AND ? AND "
+            query_arguments += value_range
+    if constraints.init is not None:
+        where_requirements += "init != '' AND "
+
+    if constraints.allow_legendary is not True:
         where_requirements += "legendary = 0 AND "
 
-    if allow_named is not True:
+    if constraints.allow_named is not True:
         where_requirements += "named = 0 AND "
 
     # If there are requirements, we add a WHERE to the start
@@ -351,10 +525,43 @@ def get_list_of_monsters(parameters: Dict) -> Dict[str, List[List[str]]]:
     if where_requirements.endswith(" AND "):
         where_requirements = where_requirements[:-5]
 
-    cols = "name, cr, size, type, tags, section, alignment, sources, fid, hp, ac, init"
-    query_string = f"""SELECT {cols} FROM {query_from} {where_requirements} ORDER BY name"""
+    return (where_requirements, query_arguments)
+
+
+def search_filter(search: str) -> Tuple[str, List[str]]:
+    """Build the conditions that require every word of the search to appear in one of the search_columns
 
-    with contextlib.closing(sqlite3.connect(db_location)) as conn:
+    Args:
+        search (str): whitespace separated words, matched regardless of ASCII case
+
+    Returns:
+        Tuple[str, List[str]]: the conditions joined with AND (or "" if there are no words), and their arguments
+    """
+    conditions = []
+    query_arguments: List[str] = []
+    for word in search.split():
+        escaped = word.replace("\\", "\\\\").replace(
+            "%", "\\%").replace("_", "\\_")
+        likes = " OR ".join(
+            [f"{column} LIKE ? ESCAPE '\\'" for column in search_columns])
+        conditions.append(f"({likes})")
+        query_arguments += [f"%{escaped}%"]*len(search_columns)
+    return (" AND ".join(conditions), query_arguments)
+
+
+def query_monsters(constraints: MonsterConstraints) -> List[List[str]]:
+    """Query the database directly for monsters matching the constraints passed
+
+    Args:
+        constraints (MonsterConstraints): constraints, as returned by parse_monster_parameters
+
+    Returns:
+        List[List[str]]: the formatted monster info, ordered by name
+    """
+    (where_requirements, query_arguments) = monster_filter(constraints)
+    query_string = f"""SELECT {monster_columns} FROM monsters {where_requirements} ORDER BY name"""
+
+    with db.connection(db_location) as conn:
         cursor = conn.cursor()
         # conn.set_trace_callback(print)
 
@@ -364,27 +571,83 @@ def get_list_of_monsters(parameters: Dict) -> Dict[str, List[List[str]]]:
             cursor.execute(query_string, (*query_arguments,))
         monster_list = cursor.fetchall()
 
-    monster_data = []
-    for monster in monster_list:
-        modified_monster = list(monster)
+    return [format_monster(monster) for monster in monster_list]
 
-        # convert sources with links to hrefs
-        sources = monster[7].split(",")
-        linked_sources = []
-        for source in sources:
-            (source_name, index) = converter.split_source_from_index(source)
-            if "http" in index:
-                linked_sources.append(
-                    f"<a target='_blank' href='{index}''>{source_name}</a>")
-            else:
-                linked_sources.append(f"{source_name}: {index}")
 
-        modified_monster[7] = ', '.join(linked_sources)
+def query_page_of_monsters(constraints: MonsterConstraints, start: int = 0, length: int = -1,
+                           search: str = "", order_column: int = 0,
+                           descending: bool = False) -> Tuple[int, int, List[List[str]]]:
+    """Query the database directly for one page of the monsters matching the constraints passed
 
-        # append modified monster data
-        monster_data.append([str(prop).strip() for prop in modified_monster])
+    Only the monsters on the page are fetched and formatted.
 
-    return {"data": monster_data}
+    Args:
+        constraints (MonsterConstraints): constraints, as returned by parse_monster_parameters
+        start (int, optional): the index of the first monster of the page. Defaults to 0.
+        length (int, optional): the size of the page, or -1 for every monster. Defaults to -1.
+        search (str, optional): words that must each appear in one of the search_columns. Defaults to "".
+        order_column (int, optional): the formatted column to sort by. Defaults to 0, the name.
+        descending (bool, optional): whether to sort in descending order. Defaults to False.
+
+    Returns:
+        Tuple[int, int, List[List[str]]]: the number of monsters matching the constraints,
+            the number of those that also match the search, and the page of formatted monster info
+    """
+    (where_requirements, query_arguments) = monster_filter(constraints)
+    (search_requirements, search_arguments) = search_filter(search)
+    if search_requirements == "":
+        searched_requirements = where_requirements
+    elif where_requirements == "":
+        searched_requirements = f"WHERE {search_requirements}"
+    else:
+        searched_requirements = f"{where_requirements} AND {search_requirements}"
+    direction = "DESC" if descending else "ASC"
+
+    with db.connection(db_location) as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""SELECT COUNT(*) FROM monsters {where_requirements}""",
+                       query_arguments)
+        total = cursor.fetchone()[0]
+        if search_requirements == "":
+            filtered = total
+        else:
+            cursor.execute(f"""SELECT COUNT(*) FROM monsters {searched_requirements}""",
+                           query_arguments + search_arguments)
+            filtered = cursor.fetchone()[0]
+
+        cursor.execute(f"""SELECT {monster_columns} FROM monsters {searched_requirements}
+            ORDER BY {sort_columns[order_column]} {direction}, name {direction}
+            LIMIT ? OFFSET ?""", query_arguments + search_arguments + [length, start])
+        monster_list = cursor.fetchall()
+
+    return (total, filtered, [format_monster(monster) for monster in monster_list])
+
+
+def check_party(party: Any) -> List[Tuple[int, int]]:
+    """Checks that a party sent to the API is a list of [character quantity, character level]
+    pairs of at most max_party_size characters, each of a level from 1 to max_character_level
+
+    Args:
+        party (Any): the party, as decoded from the request
+
+    Raises:
+        ValueError: if the party isn't one the API can plan encounters for
+
+    Returns:
+        List[Tuple[int, int]]: the party, as a list of tuples
+    """
+    try:
+        checked = [(quantity, level) for (quantity, level) in party]
+    except (TypeError, ValueError):
+        raise ValueError("A party must be a list of [character quantity, character level] pairs")
+    for (quantity, level) in checked:
+        if type(quantity) is not int or type(level) is not int or quantity < 0:
+            raise ValueError("Character quantities and levels must be whole numbers")
+        if not 1 <= level <= max_character_level:
+            raise ValueError(f"Character levels must be between 1 and {max_character_level}")
+    if sum(quantity for (quantity, _) in checked) > max_party_size:
+        raise ValueError(f"A party can have at most {max_party_size} characters")
+    return checked
 
 
 def get_party_thresholds(party: List[Tuple[int, int]]) -> List[int]:
@@ -400,42 +663,208 @@ def get_party_thresholds(party: List[Tuple[int, int]]) -> List[int]:
     return main.party_thresholds_calc(party)
 
 
-def get_encounter_xp(monsters: List[Tuple[str, int]]) -> int:
+def evaluate_encounter(party: List[Tuple[int, int]], monsters: List[Tuple[str, int]],
+                       fids: Optional[List[Tuple[str, int]]] = None) -> Dict[str, Any]:
+    """Work out a party's thresholds, an encounter's XP and which threshold it meets, all at once
+
+    Args:
+        party (List[Tuple[int, int]]): A list of tuples [character quantity, character level]
+        monsters (List[Tuple[str, int]]): A list of tuples [monster name, monster quantity]
+        fids (Optional[List[Tuple[str, int]]]): more monsters, as a list of tuples [monster fid, monster quantity]
+
+    Returns:
+        Dict[str, Any]: the party's thresholds as "thresholds", the encounter's adjusted XP as "xp",
+            and the threshold it meets ("trifling", "easy", "medium", "hard" or "deadly") as "difficulty"
+    """
+    thresholds = main.party_thresholds_calc(party)
+    xp = get_encounter_xp(monsters, fids)
+    return {"thresholds": thresholds, "xp": xp, "difficulty": main.threshold_met(thresholds, xp)}
+
+
+def get_monster_crs(monsters: List[str], by_fid: bool = False) -> Dict[str, str]:
+    """Look up the CRs of many monsters at once
+
+    The catalog's name and fid maps answer the lookup unless use_catalog_engine is False,
+    in which case main.get_monster_crs does it in one query.
+
+    Args:
+        monsters (List[str]): the names of the monsters, or their fids if by_fid is set
+        by_fid (bool, optional): whether to look the monsters up by fid. Defaults to False.
+
+    Returns:
+        Dict[str, str]: the CR of every monster found, keyed by name (or fid)
+    """
+    if not use_catalog_engine:
+        return main.get_monster_crs(monsters, by_fid)
+    monster_crs = catalog.get_catalog(
+        db_location, format_monster).monster_crs(by_fid)
+    return {monster: monster_crs[monster] for monster in monsters if monster in monster_crs}
+
+
+def get_encounter_xp(monsters: List[Tuple[str, int]], fids: Optional[List[Tuple[str, int]]] = None) -> int:
     """
     Formats information for the cr_calc function and calls it
 
     Args:
         monsters (List[Tuple[str, int]]): A list of tuples [monster name, monster quantity]
+        fids (Optional[List[Tuple[str, int]]]): more monsters, as a list of tuples [monster fid, monster quantity]
 
     Returns:
         int: The total adjusted XP for this encounter
     """
-    # TODO: refactor once corresponding main function is refactored
+    if fids is None:
+        fids = []
+    crs_by_name = get_monster_crs([name for (name, _) in monsters])
+    crs_by_fid = get_monster_crs([fid for (fid, _) in fids], by_fid=True)
 
-    crs = []
-    quantities = []
-    for monster_pair in monsters:
-        (name, number) = monster_pair
-        monster_cr = main.get_monster_cr(name)
-        crs.append(monster_cr)
-        quantities.append(int(number))
+    crs = [crs_by_name[name] for (name, _) in monsters] + \
+        [crs_by_fid[fid] for (fid, _) in fids]
+    quantities = [int(number) for (_, number) in monsters + fids]
 
     adj_xp_total = main.cr_calc(crs, quantities)
     return adj_xp_total
 
 
+def check_encounters(encounters: Any) -> List[List[Tuple[str, int]]]:
+    """Checks that encounters sent to the API are lists of [monster, quantity] pairs,
+    with a whole, positive quantity of each monster
+
+    Args:
+        encounters (Any): the encounters, as decoded from the request
+
+    Raises:
+        ValueError: if any encounter isn't one
+
+    Returns:
+        List[List[Tuple[str, int]]]: the encounters, as lists of tuples
+    """
+    try:
+        checked = [[(monster, quantity) for (monster, quantity) in encounter] for encounter in encounters]
+    except (TypeError, ValueError):
+        raise ValueError("Encounters must be lists of [monster, quantity] pairs")
+    for encounter in checked:
+        for (monster, quantity) in encounter:
+            if type(monster) is not str:
+                raise ValueError("Monsters must be given as strings")
+            if type(quantity) is not int or quantity < 1:
+                raise ValueError("Monster quantities must be whole numbers of at least 1")
+    return checked
+
+
+def get_batch_encounter_xp(encounters: List[List[Tuple[str, int]]],
+                           parties: Optional[List[List[Tuple[int, int]]]] = None,
+                           identifier: str = "name") -> Dict[str, Any]:
+    """Work out the XP of many encounters, and how difficult each is for many parties, all at once
+
+    Every monster in the batch is looked up together, and the maths is done by batch_maths.
+
+    Args:
+        encounters (List[List[Tuple[str, int]]]): the encounters, each a list of tuples [monster, monster quantity]
+        parties (Optional[List[List[Tuple[int, int]]]]): the parties, each a list of tuples [size, level]
+        identifier (str, optional): what identifies the monsters: "name", "fid" or "cr". Defaults to "name".
+
+    Raises:
+        ValueError: if an encounter or party isn't valid, see check_encounters and check_party,
+            or a monster or CR is unknown
+
+    Returns:
+        Dict[str, Any]: the adjusted XP of each encounter as "xp" and, if parties were passed, the
+            thresholds of each party as "thresholds" and a party x encounter list of lists of
+            difficulties as "difficulties"
+    """
+    encounters = check_encounters(encounters)
+    if parties is not None:
+        parties = [check_party(party) for party in parties]
+    monsters = [monster for encounter in encounters for (monster, _) in encounter]
+    if identifier == "cr":
+        unknown = {monster for monster in monsters if monster not in batch_maths.challenge_ratings}
+        if unknown:
+            raise ValueError(f"Unknown challenge ratings: {', '.join(sorted(unknown))}")
+        encounter_crs = encounters
+    elif identifier in ["name", "fid"]:
+        monster_crs = get_monster_crs(monsters, by_fid=identifier == "fid")
+        unknown = {monster for monster in monsters if monster not in monster_crs}
+        if unknown:
+            raise ValueError(f"Unknown monsters: {', '.join(sorted(unknown))}")
+        encounter_crs = [[(monster_crs[monster], quantity) for (monster, quantity) in encounter]
+                         for encounter in encounters]
+    else:
+        raise ValueError('Monsters must be identified by "name", "fid" or "cr"')
+
+    xp = batch_maths.adjusted_xp(batch_maths.encounter_matrix(encounter_crs))
+    result: Dict[str, Any] = {"xp": xp.tolist()}
+    if parties is not None:
+        thresholds = batch_maths.party_thresholds(
+            batch_maths.party_matrix(parties))
+        result["thresholds"] = thresholds.tolist()
+        result["difficulties"] = batch_maths.difficulty_names(
+            batch_maths.difficulty_bands(thresholds, xp))
+    return result
+
+
+def get_metrics() -> Dict[str, Dict[str, int]]:
+    """Returns the hit, miss and eviction counts of every cache, and every set of counters, keyed by name"""
+    stats = {name: result_cache.stats()
+             for (name, result_cache) in cache.caches.items()}
+    stats.update({name: counts.stats()
+                  for (name, counts) in metrics.counters.items()})
+    return stats
+
+
 def ingest_custom_csv_string(csv_string, db_location, url=""):
     """Simply a wrapper for the converter function"""
     return converter.ingest_data(csv_string, db_location, url)
 
 
+def spool_stream(stream):
+    """Copies a stream to a temporary file, returning the file rewound to its start"""
+    spooled = tempfile.TemporaryFile()
+    shutil.copyfileobj(stream, spooled)
+    spooled.seek(0)
+    return spooled
+
+
+def ingest_custom_csv_stream(stream, db_location, url="", compressed=False):
+    """Ingests a CSV stream, after copying all of it to a temporary file
+
+    The CSV is only parsed once it has been received in full, so a slow upload
+    doesn't hold up the ingest, or anything else, while it trickles in.
+    """
+    with spool_stream(stream) as spooled:
+        return converter.ingest_stream(spooled, db_location, url, compressed=compressed)
+
+
+def submit_custom_csv_ingest(stream, db_location, url="", compressed=False) -> jobs.Job:
+    """Ingests a CSV stream in the background, returning the job doing it straight away
+
+    The stream is copied to a temporary file first, since it may not outlive the
+    request it came with. The job's progress is a converter.IngestProgress, and
+    its result is the names of the sources added from the sheet, as "name".
+
+    Raises:
+        jobs.JobQueueFull: if too many jobs are waiting to run already
+    """
+    spooled = spool_stream(stream)
+    progress = converter.IngestProgress()
+
+    def ingest():
+        with spooled:
+            return {"name": converter.ingest_stream(spooled, db_location, url, compressed=compressed,
+                                                    progress=progress)}
+    try:
+        return jobs.submit(ingest, progress)
+    except jobs.JobQueueFull:
+        spooled.close()
+        raise
+
+
 def get_unofficial_sources() -> List[str]:
     """Returns a deduplicated list of unofficial sources
 
     Returns:
         List[str]: a deduplicated list of unofficial sources
     """
-    with contextlib.closing(sqlite3.connect(db_location)) as conn:
+    with db.connection(db_location) as conn:
         cursor = conn.cursor()
 
         cursor.execute(
@@ -7,16 +7,23 @@ a deliberate design decision to allow for the possibility of other
 frontends in the future.
 """
 
+import functools
+import hashlib
 import json
 import os
+import random
 
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, jsonify, render_template, request, url_for
 
 try:
     import api  # type: ignore
+    import converter  # type: ignore
+    import jobs  # type: ignore
     import random_encounter_generator  # type: ignore
 except ModuleNotFoundError:
     from ktc import api  # type: ignore
+    from ktc import converter  # type: ignore
+    from ktc import jobs  # type: ignore
     from ktc import random_encounter_generator  # type: ignore
 
 VERSION = "v0.5"
@@ -27,6 +34,40 @@ path_to_database = os.path.abspath(os.path.join(
 
 db_location = path_to_database
 
+# The longest an ingest job's event stream goes without sending an event
+job_event_interval = 15
+# How many seconds a client turned away because the job queue is full is told to wait
+job_retry_after = 10
+
+
+def catalog_etag(route):
+    """Gives a route's responses a strong ETag, and answers GETs with a matching
+    If-None-Match with 304 Not Modified without calling the route
+
+    The ETag is derived from the DB's build id and catalog version, which change
+    whenever the DB is rebuilt or re-ingested, as well as the app version, the path
+    and the request's parameters. So it only suits routes whose responses depend on
+    nothing else. Unless something has committed to the DB since, the build id and
+    catalog version are already cached, so a 304 doesn't query it.
+    """
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        (build, version) = converter.get_catalog_state(api.db_location)
+        request_parameters = sorted(request.values.items(multi=True))
+        digest = hashlib.sha1(json.dumps(
+            [VERSION, build, request.path, request_parameters]).encode("utf-8")).hexdigest()
+        etag = f"{version}-{digest[:16]}"
+
+        if request.method in ["GET", "HEAD"] and request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            response = app.make_response(route(*args, **kwargs))
+        response.set_etag(etag)
+        # Cached copies must be revalidated, which is a cheap 304 until the next ingest
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+    return wrapper
+
 
 @app.route("/", methods=["GET", "POST", "PUT"])
 def home():
@@ -46,69 +87,160 @@ def about_page():
     return render_template("about.html")
 
 
+@app.route("/api/bootstrap", methods=["GET"])
+@catalog_etag
+def get_bootstrap():
+    """Returns every list needed to build the page's filters in one response"""
+    return jsonify(api.get_bootstrap())
+
+
 @app.route("/api/environments", methods=["GET"])
+@catalog_etag
 def get_environments():
     """Returns a list of all possible environments"""
     return jsonify(api.get_list_of_environments())
 
 
 @app.route("/api/sizes", methods=["GET"])
+@catalog_etag
 def get_sizes():
     """Returns a list of all possible monster sizes"""
     return jsonify(api.get_list_of_sizes())
 
 
 @app.route("/api/crs", methods=["GET"])
+@catalog_etag
 def get_crs():
     """Returns a list of all possible challenge ratings"""
     return jsonify(api.get_list_of_challenge_ratings())
 
 
 @app.route("/api/sources", methods=["GET"])
+@catalog_etag
 def get_sources():
     """Returns a list of imported source titles"""
     return jsonify(api.get_list_of_sources())
 
 
 @app.route("/api/types", methods=["GET"])
+@catalog_etag
 def get_types():
     """Returns a list of imported monster types"""
     return jsonify(api.get_list_of_monster_types())
 
 
 @app.route("/api/alignments", methods=["GET"])
+@catalog_etag
 def get_alignments():
     """Returns a list of imported alignments"""
     return jsonify(api.get_list_of_alignments())
 
 
 @app.route("/api/monsters", methods=["GET", "POST"])
+@catalog_etag
 def get_monsters():
-    """Gets a list of monsters matching the passed parameters and returns them"""
+    """Gets a list of monsters matching the passed parameters and returns them
+
+    If DataTables' server-side processing parameters are passed (draw, start,
+    length, search[value] and order[0][column]/order[0][dir]), only the page
+    asked for is returned. If facetCounts is "true", the number of monsters
+    each facet value would give is returned as well.
+    """
     try:
         monster_parameters_string = request.values["params"]
         monster_parameters = json.loads(
             monster_parameters_string)
     except KeyError:
         monster_parameters = {}
-    return jsonify(api.get_list_of_monsters(monster_parameters))
+    if "draw" not in request.values:
+        monsters = dict(api.get_list_of_monsters(monster_parameters))
+        if request.values.get("facetCounts") == "true":
+            monsters["facetCounts"] = api.get_facet_counts(monster_parameters)
+        return jsonify(monsters)
+
+    page = api.get_page_of_monsters(
+        monster_parameters,
+        start=request.values.get("start", 0, type=int),
+        length=request.values.get("length", -1, type=int),
+        search=request.values.get("search[value]", ""),
+        order_column=request.values.get("order[0][column]", 0, type=int),
+        descending=request.values.get("order[0][dir]", "asc") == "desc")
+    # DataTables echoes draw back to tell responses apart, so it is cast to stop XSS
+    page["draw"] = request.values.get("draw", 0, type=int)
+    if request.values.get("facetCounts") == "true":
+        page["facetCounts"] = api.get_facet_counts(monster_parameters)
+    return jsonify(page)
+
+
+@app.route("/api/metrics", methods=["GET"])
+def get_metrics():
+    """Returns the hit, miss and eviction counts of the server's caches"""
+    return jsonify(api.get_metrics())
 
 
 @app.route("/api/expthresholds", methods=["GET", "POST"])
 def get_exp_thresholds():
     """Finds and returns the encounter difficulty thresholds for a party"""
-    party = json.loads(request.values["party"])
+    try:
+        party = api.check_party(json.loads(request.values["party"]))
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
     return jsonify(api.get_party_thresholds(party))
 
 
 @app.route("/api/encounterxp", methods=["GET", "POST"])
 def get_encounter_xp():
-    """Calculate & return the XP generated by an encounter"""
-    monsters = json.loads(request.values["monsters"])
-    return jsonify(api.get_encounter_xp(monsters))
+    """Calculate & return the XP generated by an encounter
+
+    The monsters are passed as a list of [name, quantity] pairs, and/or as a list of
+    [fid, quantity] pairs under fids.
+    """
+    monsters = json.loads(request.values.get("monsters", "[]"))
+    fids = json.loads(request.values.get("fids", "[]"))
+    return jsonify(api.get_encounter_xp(monsters, fids))
+
+
+@app.route("/api/evaluate", methods=["GET", "POST"])
+def evaluate_encounter():
+    """Returns a party's thresholds, an encounter's XP and the threshold it meets in one response
+
+    The party is passed as a list of [quantity, level] pairs, and the monsters as for
+    /api/encounterxp.
+    """
+    try:
+        party = api.check_party(json.loads(request.values["party"]))
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    monsters = json.loads(request.values.get("monsters", "[]"))
+    fids = json.loads(request.values.get("fids", "[]"))
+    return jsonify(api.evaluate_encounter(party, monsters, fids))
+
+
+@app.route("/api/encounterxp/batch", methods=["GET", "POST"])
+def get_batch_encounter_xp():
+    """Calculate & return the XP of many encounters, and their difficulty for many parties
+
+    The encounters are passed as a list of lists of [monster, quantity] pairs, where
+    the monsters are identified by name, or by fid or CR if identifier says so. If
+    parties are passed, as a list of lists of [size, level] pairs, their thresholds
+    and a party x encounter matrix of difficulties are returned too. Unknown
+    monsters or CRs, quantities that aren't whole and positive, and parties that
+    api.check_party rejects get 400 Bad Request.
+    """
+    encounters = json.loads(request.values["encounters"])
+    try:
+        parties = json.loads(request.values["parties"])
+    except KeyError:
+        parties = None
+    identifier = request.values.get("identifier", "name")
+    try:
+        return jsonify(api.get_batch_encounter_xp(encounters, parties, identifier))
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
 
 
 @app.route("/api/unofficialsources", methods=["GET"])
+@catalog_etag
 def get_unofficial_sources():
     """Get a list of unofficial sources"""
     return jsonify(api.get_unofficial_sources())
@@ -123,6 +255,104 @@ def process_csv():
     return jsonify({"name": source_name})
 
 
+def uploaded_csv():
+    """Returns the stream of the CSV uploaded in the request body, or as the "csv" file
+    of a multipart form, and whether it is gzipped
+
+    Gzipped CSVs are detected from a gzip Content-Encoding or content type, or a .gz filename.
+    """
+    upload = request.files.get("csv")
+    if upload is not None:
+        stream = upload.stream
+        content_type = upload.mimetype
+        filename = upload.filename or ""
+    else:
+        stream = request.stream
+        content_type = request.mimetype
+        filename = ""
+    compressed = (request.headers.get("Content-Encoding", "").lower() == "gzip"
+                  or content_type in ("application/gzip", "application/x-gzip")
+                  or filename.endswith(".gz"))
+    return (stream, compressed)
+
+
+@app.route("/api/uploadcsv", methods=["POST"])
+def upload_csv():
+    """Imports a CSV uploaded as uploaded_csv describes
+
+    The CSV is spooled to a temporary file rather than buffered in memory, and
+    only parsed once it has all arrived. The key of the sheet is passed in the
+    "key" query parameter or form field.
+    """
+    key = request.values.get("key", "")
+    (stream, compressed) = uploaded_csv()
+    try:
+        source_name = api.ingest_custom_csv_stream(
+            stream, db_location, key, compressed)
+    except (UnicodeDecodeError, OSError, EOFError, KeyError):
+        return jsonify({"error": "The CSV could not be read"}), 400
+    return jsonify({"name": source_name})
+
+
+@app.route("/api/ingestjobs", methods=["POST"])
+def submit_ingest_job():
+    """Starts importing a CSV uploaded as for /api/uploadcsv in the background
+
+    Responds with 202 Accepted and the job straight away, with a Location header
+    to poll for its progress, or with 503 Service Unavailable if too many jobs
+    are waiting to run already.
+    """
+    key = request.values.get("key", "")
+    (stream, compressed) = uploaded_csv()
+    try:
+        job = api.submit_custom_csv_ingest(stream, db_location, key, compressed)
+    except jobs.JobQueueFull as error:
+        response = jsonify({"error": str(error)})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(job_retry_after)
+        return response
+    response = jsonify(job.to_dict())
+    response.status_code = 202
+    response.headers["Location"] = url_for("get_ingest_job", job_id=job.id)
+    return response
+
+
+@app.route("/api/ingestjobs/<job_id>", methods=["GET"])
+def get_ingest_job(job_id):
+    """Returns the status, progress and result of an ingest job"""
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "There is no such job"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/api/ingestjobs/<job_id>/events", methods=["GET"])
+def stream_ingest_job(job_id):
+    """Streams an ingest job's status and progress as Server-Sent Events, until it finishes
+
+    An event is sent whenever the job's status changes, with its progress at most
+    every jobs.progress_interval seconds, and at least every job_event_interval
+    seconds to keep the connection open. The stream holds a request thread, which
+    sleeps between events, for as long as the job runs, so it is only for clients
+    that opt in to it. Polling /api/ingestjobs/<job_id>, as the app's own page
+    does, is the supported way of following a job.
+    """
+    job = jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"error": "There is no such job"}), 404
+
+    def events():
+        last_seen = None
+        while True:
+            last_seen = job.wait_for_change(last_seen, job_event_interval)
+            yield f"data: {json.dumps(last_seen)}\n\n"
+            if last_seen["status"] in ("done", "failed"):
+                break
+
+    return app.response_class(events(), mimetype="text/event-stream",
+                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.route("/api/checksource", methods=["GET", "POST"])
 def check_if_key_processed():
     """Checks if the existing key has been processed"""
@@ -131,20 +361,49 @@ def check_if_key_processed():
     return jsonify(result)
 
 
+@app.route("/api/rarityprofiles", methods=["GET"])
+def get_rarity_profiles():
+    """Returns the named rarity profiles the encounter generator can use"""
+    return jsonify({name: profile.to_dict() for (name, profile)
+                    in random_encounter_generator.rarity_profiles.items()})
+
+
 @app.route("/api/encountergenerator", methods=["GET", "POST"])
 def generate_encounter():
-    """Wrapper for the encounter generator function"""
+    """Wrapper for the encounter generator function
+
+    An optional seed makes the encounter reproducible. Without one, a seed is
+    chosen at random; either way it is sent back in the X-Encounter-Seed header,
+    so that the same encounter can be fetched again by passing it back. Only
+    encounters for seeds the client chose are cached, since a random seed is
+    unlikely to be passed back.
+    """
     try:
         params = json.loads(request.values["params"])
     except KeyError:
         params = {}
+    if "seed" in request.values:
+        params["seed"] = request.values["seed"]
+    seeded = params.get("seed") is not None
+    if not seeded:
+        params["seed"] = str(random.getrandbits(64))
+    if "party" in params:
+        try:
+            params["party"] = api.check_party(params["party"])
+        except ValueError as error:
+            return jsonify({"error": str(error)}), 400
 
-    result = random_encounter_generator.generate(params)
+    try:
+        result = random_encounter_generator.generate(params, cache_seeded=seeded)
+    except random_encounter_generator.EncounterGenerationError as error:
+        return jsonify({"error": str(error), "attempts": error.attempts}), 422
     return_list = []
     for res_tup in result:
         for _ in range(res_tup[0]):
             return_list.append(res_tup[1])
-    return jsonify(return_list)
+    response = jsonify(return_list)
+    response.headers["X-Encounter-Seed"] = str(params["seed"])
+    return response
 
 
 if __name__ == "__main__":
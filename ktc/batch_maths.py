@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""The encounter maths from main, vectorised with NumPy to work on many encounters and parties at once
+
+An encounter is a row of quantities, one per CR in challenge_ratings, and a party
+is a row of character counts, one per level from 0 to 20. Every function here
+takes a 2D array with one encounter or party per row, and gives the same answers
+as its counterpart in main.
+"""
+
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import main  # type: ignore
+except ModuleNotFoundError:
+    from ktc import main  # type: ignore
+
+# The CR each column of an encounter matrix counts monsters of
+challenge_ratings = list(main.cr_xp_mapping)
+cr_xp = np.array(list(main.cr_xp_mapping.values()), dtype=np.int64)
+
+# One row per level, with the easy, medium, hard and deadly thresholds and the daily XP budget
+level_thresholds = np.array([(main.xp_thresholds[level] or [0, 0, 0, 0]) +
+                             [main.xp_per_day_per_character_per_level[level]]
+                             for level in range(len(main.xp_thresholds))], dtype=np.int64)
+
+difficulties = ["trifling", "easy", "medium", "hard", "deadly"]
+
+# main.cr_calc's multiplier applies to encounters of up to 1, 2, 6, 10 and 14 monsters, then more
+_quantity_bounds = np.array([1, 2, 6, 10, 14])
+_multipliers = np.array(main.encounter_xp_multipliers)
+
+
+def encounter_matrix(encounters: Sequence[Sequence[Tuple[str, int]]]) -> np.ndarray:
+    """Builds an encounter matrix from encounters given as lists of (CR, quantity) pairs"""
+    cr_indices = {challenge_rating: i for (
+        i, challenge_rating) in enumerate(challenge_ratings)}
+    matrix = np.zeros((len(encounters), len(challenge_ratings)), dtype=np.int64)
+    for (row, encounter) in enumerate(encounters):
+        for (challenge_rating, quantity) in encounter:
+            matrix[row, cr_indices[challenge_rating]] += int(quantity)
+    return matrix
+
+
+def party_matrix(parties: Sequence[main.PartyType]) -> np.ndarray:
+    """Builds a party matrix from parties given as lists of (size, level) pairs"""
+    matrix = np.zeros((len(parties), len(level_thresholds)), dtype=np.int64)
+    for (row, party) in enumerate(parties):
+        for (size, level) in party:
+            matrix[row, int(level)] += int(size)
+    return matrix
+
+
+def adjusted_xp(encounters: np.ndarray) -> np.ndarray:
+    """Calculates the XP of every encounter, adjusted for the number of monsters, as main.cr_calc does
+
+    Args:
+        encounters (np.ndarray): an encounter matrix, with one row per encounter
+
+    Returns:
+        np.ndarray: the adjusted XP of each encounter
+    """
+    unadjusted = encounters @ cr_xp
+    multipliers = _multipliers[np.searchsorted(
+        _quantity_bounds, encounters.sum(axis=1))]
+    return np.floor(unadjusted * multipliers).astype(np.int64)
+
+
+def party_thresholds(parties: np.ndarray) -> np.ndarray:
+    """Calculates the XP thresholds of every party, as main.party_thresholds_calc does
+
+    Args:
+        parties (np.ndarray): a party matrix, with one row per party
+
+    Returns:
+        np.ndarray: one row per party, of its easy, medium, hard and deadly thresholds and its daily XP
+    """
+    return parties @ level_thresholds
+
+
+def difficulty_bands(thresholds: np.ndarray, xp: np.ndarray) -> np.ndarray:
+    """Works out how difficult every encounter is for every party, as main.diff_calc does
+
+    Args:
+        thresholds (np.ndarray): the thresholds of each party, as returned by party_thresholds
+        xp (np.ndarray): the adjusted XP of each encounter, as returned by adjusted_xp
+
+    Returns:
+        np.ndarray: a party x encounter matrix of indices into difficulties
+    """
+    return (xp[np.newaxis, :, np.newaxis] >= thresholds[:, np.newaxis, :4]).sum(axis=2)
+
+
+def difficulty_names(bands: np.ndarray) -> List[List[str]]:
+    """Converts a matrix of difficulty bands to a nested list of their names"""
+    return np.array(difficulties)[bands].tolist()
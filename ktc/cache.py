@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""Bounded, least recently used caches that keep count of how well they work
+
+Every cache registers itself in caches under its name, so that its hit, miss
+and eviction counts can be reported by api.get_metrics and used to size it.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+caches: Dict[str, "LRUCache"] = {}
+
+_missing = object()
+
+
+class LRUCache:
+    """A thread safe cache that drops the least recently used entry once it is full"""
+
+    def __init__(self, name: str, max_size: int):
+        self.name = name
+        self.max_size = max_size
+        self.entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        caches[name] = self
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the value cached for the key, or the default if there isn't one"""
+        with self.lock:
+            value = self.entries.get(key, _missing)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        """Caches a value, evicting the least recently used entry if the cache is full"""
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """Returns the value cached for the key, computing and caching it if there isn't one
+
+        The value is computed outside the lock, so two threads missing on the same
+        key at once will both compute it.
+        """
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the size of the cache and how many hits, misses and evictions it has had"""
+        with self.lock:
+            return {"size": len(self.entries), "max_size": self.max_size,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,541 @@
+# -*- coding: utf-8 -*-
+
+"""An in-memory copy of the monsters and sources tables, indexed with bitmaps
+
+The catalog is loaded once and answers monster queries without touching SQLite.
+Every facet value (each environment, size, type, alignment, source and CR) has
+a bitmap with bit n set for the monster with rowid n, so any combination of
+filters is a handful of bitwise ANDs and ORs.
+
+A catalog is never modified once built. When the catalog version of the DB
+changes, which happens whenever converter.ingest_data writes to it, a new
+catalog is built from the old one and only the rows that changed are re-read.
+When the DB is rebuilt, which gives it a new build id, the catalog is loaded
+from scratch.
+"""
+
+import bisect
+import os
+import re
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import converter  # type: ignore
+    import db  # type: ignore
+except ModuleNotFoundError:
+    from ktc import converter  # type: ignore
+    from ktc import db  # type: ignore
+
+MonsterFormatter = Callable[[Sequence[Any]], List[str]]
+Bitmaps = Dict[str, Dict[Any, int]]
+
+monster_columns = ("name, cr, size, type, tags, section, alignment, sources, fid, hp, ac, init, "
+                   "environment, sourcehashes, legendary, named, crvalue")
+formatted_column_count = 12
+
+facets = ["environment", "size", "type", "alignment", "source", "cr", "legendary", "named",
+          "crvalue", "hp", "ac", "init"]
+# Facets whose values are numbers, which can be filtered by range
+numeric_facets = ["crvalue", "hp", "ac", "init"]
+
+# The facets the page lists values of, which facet_counts counts
+counted_facets = ["environments", "sizes", "types", "alignments", "sources"]
+
+# The monster column each formatted column is sorted by, as in api.sort_columns
+sort_columns = [0, 16, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+# The monster columns a search looks through, as in api.search_columns
+search_columns = [0, 1, 2, 3, 4, 5, 6, 7]
+
+_integer_prefix = re.compile(r"\s*([+-]?\d+)")
+
+# SQLite's LIKE is only case insensitive for ASCII characters, so the catalog
+# must not lower() anything else
+_ascii_lowercase = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ",
+                                 "abcdefghijklmnopqrstuvwxyz")
+
+# Rows are re-read one chunk at a time to stay under SQLite's variable limit
+_fetch_chunk_size = 500
+
+
+def ascii_lower(text: str) -> str:
+    """Lowercases the ASCII characters of a string, the way SQLite's LIKE does"""
+    return text.translate(_ascii_lowercase)
+
+
+def sqlite_integer(text: str) -> int:
+    """Converts text to an integer the way SQLite's CAST(text AS INTEGER) does"""
+    match = _integer_prefix.match(text)
+    return int(match.group(1)) if match else 0
+
+
+def sqlite_order(value: Any) -> Tuple:
+    """Returns a sort key that orders values the way SQLite's ORDER BY does:
+    NULLs first, then numbers, then text"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    return (2, value)
+
+
+def numbers(*values: Any) -> List[Any]:
+    """Filters out anything that SQLite wouldn't compare as a number"""
+    return [value for value in values
+            if isinstance(value, (int, float)) and not isinstance(value, bool)]
+
+
+def facet_values(monster: Sequence[Any]) -> Dict[str, List[Any]]:
+    """Splits a monster row into the values it is indexed under, per facet
+
+    Environments and sources are split the same way as in converter.rebuild_facet_tables,
+    and the numeric facets compare the same way as the BETWEENs in api.query_monsters.
+    """
+    environments = [environment.strip()
+                    for environment in monster[12].split(",")]
+    init = monster[11]
+    return {
+        "environment": [environment for environment in environments if environment != ""],
+        "size": [monster[2]],
+        "type": [monster[3]],
+        "alignment": [monster[6]],
+        "source": monster[13].split(","),
+        "cr": [monster[1]],
+        "legendary": [monster[14]],
+        "named": [monster[15]],
+        "crvalue": numbers(monster[16]),
+        "hp": numbers(monster[9]),
+        "ac": numbers(monster[10]),
+        "init": [sqlite_integer(init)] if isinstance(init, str) and init != "" else [],
+    }
+
+
+def bitmap_from_positions(positions: Iterable[int]) -> int:
+    """Builds a bitmap with the given bits set in a single pass"""
+    positions = list(positions)
+    if not positions:
+        return 0
+    bits = bytearray(max(positions) // 8 + 1)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, "little")
+
+
+def positions_from_bitmap(bitmap: int) -> List[int]:
+    """Lists the bits set in a bitmap, lowest first"""
+    return [match.start() for match in re.finditer("1", bin(bitmap)[:1:-1])]
+
+
+def count_bits(bitmap: int) -> int:
+    """Counts the bits set in a bitmap"""
+    return bin(bitmap).count("1")
+
+
+class Catalog:
+    """An immutable snapshot of the monsters in a single DB"""
+
+    def __init__(self, db_location: str, formatter: MonsterFormatter, version: int,
+                 monsters: Dict[int, Tuple], formatted: Dict[int, List[str]], bitmaps: Bitmaps,
+                 source_hashes: Dict[str, str], official_sources: List[str], build: str = "",
+                 change_seq: Optional[int] = None):
+        self.db_location = db_location
+        self.formatter = formatter
+        self.version = version
+        # The DB's build id, see converter.get_catalog_state
+        self.build = build
+        self.monsters = monsters
+        self.formatted = formatted
+        self.bitmaps = bitmaps
+        self.source_hashes = source_hashes
+        self.official_sources = official_sources
+        # The last entry of the DB's change log the catalog includes, or None if it has no log
+        self.change_seq = change_seq
+
+        self.all_rows = bitmap_from_positions(monsters)
+        self.order = sorted(monsters, key=lambda rowid: monsters[rowid][0])
+        rank = [0] * (max(monsters, default=0) + 1)
+        for i, rowid in enumerate(self.order):
+            rank[rowid] = i
+        self.rank = rank
+        self.sorted_values = {facet: sorted(bitmaps[facet])
+                              for facet in numeric_facets}
+        # Built the first time they are needed
+        self.column_ranks: Dict[int, List[int]] = {0: rank}
+        self.search_text: Dict[int, str] = {}
+        self.value_bitmaps: Dict[str, Dict[str, int]] = {}
+        self.cr_maps: Dict[bool, Dict[str, str]] = {}
+
+    def bitmap(self, facet: str, values: Iterable[Any]) -> int:
+        """Returns the monsters with any of the values for the facet"""
+        facet_bitmaps = self.bitmaps[facet]
+        bitmap = 0
+        for value in values:
+            bitmap |= facet_bitmaps.get(value, 0)
+        return bitmap
+
+    def bitmap_like(self, facet: str, patterns: Iterable[str]) -> int:
+        """Returns the monsters with a value for the facet that matches any of the
+        patterns, the way "value LIKE '%pattern%'" would"""
+        patterns = [ascii_lower(pattern) for pattern in patterns]
+        bitmap = 0
+        for (value, value_bitmap) in self.bitmaps[facet].items():
+            lowered = ascii_lower(value)
+            if any(pattern in lowered for pattern in patterns):
+                bitmap |= value_bitmap
+        return bitmap
+
+    def bitmap_range(self, facet: str, value_range: Tuple[float, float]) -> int:
+        """Returns the monsters with a value for a numeric facet within the inclusive range"""
+        values = self.sorted_values[facet]
+        facet_bitmaps = self.bitmaps[facet]
+        bitmap = 0
+        for value in values[bisect.bisect_left(values, value_range[0]):
+                            bisect.bisect_right(values, value_range[1])]:
+            bitmap |= facet_bitmaps[value]
+        return bitmap
+
+    def constraint_bitmaps(self, constraints: Any) -> Dict[str, int]:
+        """Returns the bitmap of monsters allowed by each of the constraints
+
+        Args:
+            constraints (Any): the constraints, as returned by api.parse_monster_parameters
+
+        Returns:
+            Dict[str, int]: a bitmap for each of the counted_facets that is constrained,
+                and one under "other" for the ranges and flags
+        """
+        bitmaps = {}
+        if constraints.environments:
+            bitmaps["environments"] = self.bitmap_like(
+                "environment", constraints.environments)
+        if constraints.sources:
+            bitmaps["sources"] = self.bitmap("source", [self.source_hashes[source]
+                                                        for source in constraints.sources
+                                                        if source in self.source_hashes])
+        if constraints.alignments:
+            bitmaps["alignments"] = self.bitmap_like(
+                "alignment", constraints.alignments)
+        if constraints.sizes:
+            bitmaps["sizes"] = self.bitmap("size", constraints.sizes)
+        if constraints.types:
+            bitmaps["types"] = self.bitmap("type", constraints.types)
+
+        other = self.all_rows
+        for (facet, value_range) in [("crvalue", constraints.challenge_ratings),
+                                     ("hp", constraints.hp),
+                                     ("ac", constraints.ac),
+                                     ("init", constraints.init)]:
+            if value_range is not None:
+                other &= self.bitmap_range(facet, value_range)
+        if constraints.allow_legendary is not True:
+            other &= self.bitmap("legendary", [0])
+        if constraints.allow_named is not True:
+            other &= self.bitmap("named", [0])
+        bitmaps["other"] = other
+
+        return bitmaps
+
+    def match(self, constraints: Any) -> int:
+        """Returns the bitmap of monsters matching the constraints
+
+        Args:
+            constraints (Any): the constraints, as returned by api.parse_monster_parameters
+
+        Returns:
+            int: a bitmap with the rowid of every matching monster set
+        """
+        bitmap = self.all_rows
+        for constraint_bitmap in self.constraint_bitmaps(constraints).values():
+            bitmap &= constraint_bitmap
+        return bitmap
+
+    def monster_crs(self, by_fid: bool = False) -> Dict[str, str]:
+        """Returns the CR of every monster, keyed by name or by fid, the way
+        main.get_monster_crs looks them up"""
+        if by_fid not in self.cr_maps:
+            column = 8 if by_fid else 0
+            monster_crs: Dict[str, str] = {}
+            for rowid in sorted(self.monsters):
+                monster = self.monsters[rowid]
+                monster_crs.setdefault(monster[column], monster[1])
+            self.cr_maps[by_fid] = monster_crs
+        return self.cr_maps[by_fid]
+
+    def facet_value_bitmaps(self, facet: str) -> Dict[str, int]:
+        """Returns the bitmap of monsters that selecting each value of one of the
+        counted_facets would allow, keyed by the values the page lists"""
+        if facet not in self.value_bitmaps:
+            bitmaps = self.bitmaps
+            if facet == "environments":
+                value_bitmaps = {environment: self.bitmap_like("environment", [environment])
+                                 for environment in bitmaps["environment"]}
+            elif facet == "alignments":
+                # Listed the way api.get_list_of_alignments lists them
+                alignments = {alignment.lower() for alignment in bitmaps["alignment"]
+                              if " or " not in alignment}
+                value_bitmaps = {alignment: self.bitmap_like("alignment", [alignment])
+                                 for alignment in alignments}
+            elif facet == "sources":
+                value_bitmaps = {source: bitmaps["source"].get(source_hash, 0)
+                                 for (source, source_hash) in self.source_hashes.items()}
+            elif facet == "sizes":
+                value_bitmaps = dict(bitmaps["size"])
+            else:
+                value_bitmaps = dict(bitmaps["type"])
+            self.value_bitmaps[facet] = value_bitmaps
+        return self.value_bitmaps[facet]
+
+    def facet_counts(self, constraints: Any) -> Dict[str, Dict[str, int]]:
+        """Counts, for every value of every one of the counted_facets, how many monsters
+        would match if only that value were selected for its facet
+
+        Each facet's counts ignore that facet's own constraint but honour all the others,
+        so they are the results a user would get by toggling the value. Every count is
+        taken from the same constraint bitmaps that match uses.
+
+        Args:
+            constraints (Any): the constraints, as returned by api.parse_monster_parameters
+
+        Returns:
+            Dict[str, Dict[str, int]]: the count for each value, keyed by facet then value
+        """
+        constraint_bitmaps = self.constraint_bitmaps(constraints)
+        counts = {}
+        for facet in counted_facets:
+            base = self.all_rows
+            for (constrained_facet, constraint_bitmap) in constraint_bitmaps.items():
+                if constrained_facet != facet:
+                    base &= constraint_bitmap
+            counts[facet] = {value: count_bits(base & value_bitmap)
+                             for (value, value_bitmap) in self.facet_value_bitmaps(facet).items()}
+        return counts
+
+    def rowids(self, bitmap: int) -> List[int]:
+        """Returns the rowids set in a bitmap, ordered by monster name"""
+        if bitmap == self.all_rows:
+            return list(self.order)
+        return sorted(positions_from_bitmap(bitmap), key=self.rank.__getitem__)
+
+    def query(self, constraints: Any) -> List[List[str]]:
+        """Returns the formatted monsters matching the constraints, ordered by name
+
+        The rows returned are shared between calls and must not be modified.
+        """
+        formatted = self.formatted
+        return [formatted[rowid] for rowid in self.rowids(self.match(constraints))]
+
+    def column_rank(self, column: int) -> List[int]:
+        """Returns the position of each rowid when sorted by a formatted column,
+        ties broken by name, the way api.query_page_of_monsters sorts them"""
+        if column not in self.column_ranks:
+            monster_column = sort_columns[column]
+            monsters = self.monsters
+
+            def sort_key(rowid: int) -> Tuple:
+                value = monsters[rowid][monster_column]
+                if monster_column == 11 and isinstance(value, str):
+                    value = sqlite_integer(value)
+                return (sqlite_order(value), monsters[rowid][0])
+
+            rank = [0] * len(self.rank)
+            for i, rowid in enumerate(sorted(monsters, key=sort_key)):
+                rank[rowid] = i
+            self.column_ranks[column] = rank
+        return self.column_ranks[column]
+
+    def matches_search(self, rowid: int, words: List[str]) -> bool:
+        """Checks if every (lowercased) word appears in one of the searched columns,
+        the way "column LIKE '%word%'" would"""
+        if not self.search_text:
+            self.search_text = {
+                row: "\n".join(ascii_lower(str(monster[column]))
+                                for column in search_columns if monster[column] is not None)
+                for (row, monster) in self.monsters.items()}
+        text = self.search_text[rowid]
+        return all(word in text for word in words)
+
+    def query_page(self, constraints: Any, start: int = 0, length: int = -1, search: str = "",
+                   order_column: int = 0, descending: bool = False) -> Tuple[int, int, List[List[str]]]:
+        """Returns one page of the formatted monsters matching the constraints
+
+        Args:
+            constraints (Any): the constraints, as returned by api.parse_monster_parameters
+            start (int, optional): the index of the first monster of the page. Defaults to 0.
+            length (int, optional): the size of the page, or -1 for every monster. Defaults to -1.
+            search (str, optional): words that must each appear in one of the search_columns. Defaults to "".
+            order_column (int, optional): the formatted column to sort by. Defaults to 0, the name.
+            descending (bool, optional): whether to sort in descending order. Defaults to False.
+
+        Returns:
+            Tuple[int, int, List[List[str]]]: the number of monsters matching the constraints,
+                the number of those that also match the search, and the page of monsters
+        """
+        bitmap = self.match(constraints)
+        total = count_bits(bitmap)
+
+        rank = self.column_rank(order_column)
+        if bitmap == self.all_rows and order_column == 0:
+            rowids = list(self.order)
+        else:
+            rowids = sorted(positions_from_bitmap(bitmap), key=rank.__getitem__)
+        words = ascii_lower(search).split()
+        if words:
+            rowids = [rowid for rowid in rowids if self.matches_search(rowid, words)]
+        if descending:
+            rowids.reverse()
+
+        end = None if length < 0 else start + length
+        formatted = self.formatted
+        return (total, len(rowids), [formatted[rowid] for rowid in rowids[start:end]])
+
+
+def read_sources(cursor: sqlite3.Cursor) -> Tuple[Dict[str, str], List[str]]:
+    """Returns a map of source name to source hash, and the sorted official sources"""
+    cursor.execute("""SELECT name, hash, official FROM sources""")
+    source_hashes: Dict[str, str] = {}
+    official_sources = set()
+    for (name, source_hash, official) in cursor.fetchall():
+        source_hashes.setdefault(name, source_hash)
+        if official == 1:
+            official_sources.add(name)
+    return (source_hashes, sorted(official_sources))
+
+
+def index_monsters(bitmaps: Bitmaps, monsters: Dict[int, Tuple]):
+    """Sets the bits for the monsters passed in the bitmaps, in place"""
+    positions: Dict[Tuple[str, Any], List[int]] = {}
+    for (rowid, monster) in monsters.items():
+        for (facet, values) in facet_values(monster).items():
+            for value in values:
+                positions.setdefault((facet, value), []).append(rowid)
+
+    for ((facet, value), rowids) in positions.items():
+        bitmaps[facet][value] = bitmaps[facet].get(
+            value, 0) | bitmap_from_positions(rowids)
+
+
+def unindex_monsters(bitmaps: Bitmaps, rowids: Iterable[int]):
+    """Clears the bits for the rowids passed from the bitmaps, in place"""
+    keep = ~bitmap_from_positions(rowids)
+    for facet_bitmaps in bitmaps.values():
+        for value in list(facet_bitmaps):
+            facet_bitmaps[value] &= keep
+            if facet_bitmaps[value] == 0:
+                del facet_bitmaps[value]
+
+
+def read_change_seq(cursor: sqlite3.Cursor) -> Optional[int]:
+    """Returns the last entry of the DB's log of changed monsters, or None if it has no log,
+    see converter.create_change_log"""
+    try:
+        cursor.execute("""SELECT MAX(seq) FROM monster_changes""")
+    except sqlite3.OperationalError:
+        return None
+    return cursor.fetchone()[0] or 0
+
+
+def load_catalog(db_location: str, formatter: MonsterFormatter, version: int) -> Catalog:
+    """Builds a catalog from scratch"""
+    build = converter.get_catalog_build(db_location)
+    with db.connection(db_location) as conn:
+        cursor = conn.cursor()
+        # Read first, so that anything changed while the monsters are read is re-read later
+        change_seq = read_change_seq(cursor)
+        cursor.execute(f"""SELECT rowid, {monster_columns} FROM monsters""")
+        monsters = {row[0]: row[1:] for row in cursor.fetchall()}
+        (source_hashes, official_sources) = read_sources(cursor)
+
+    bitmaps: Bitmaps = {facet: {} for facet in facets}
+    index_monsters(bitmaps, monsters)
+    formatted = {rowid: formatter(monster[:formatted_column_count])
+                 for (rowid, monster) in monsters.items()}
+    return Catalog(db_location, formatter, version, monsters, formatted, bitmaps,
+                   source_hashes, official_sources, build, change_seq)
+
+
+def update_catalog(old: Catalog, version: int) -> Catalog:
+    """Builds a catalog from an older one, re-reading only the monsters that changed
+
+    Every monster inserted or updated since the old catalog was built is in the
+    DB's change log, see converter.create_change_log, even if it took the rowid of
+    one that was deleted. Deleted monsters are simply missing. If the log is
+    missing, or has been pruned past the old catalog, the catalog is loaded from
+    scratch instead.
+    """
+    if old.change_seq is None:
+        return load_catalog(old.db_location, old.formatter, version)
+    with db.connection(old.db_location) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""SELECT MIN(seq), MAX(seq) FROM monster_changes""")
+        except sqlite3.OperationalError:
+            return load_catalog(old.db_location, old.formatter, version)
+        (first_seq, change_seq) = cursor.fetchone()
+        if first_seq is not None and first_seq > old.change_seq + 1:
+            return load_catalog(old.db_location, old.formatter, version)
+        change_seq = change_seq or old.change_seq
+        cursor.execute("""SELECT DISTINCT monster_id FROM monster_changes WHERE seq > ? AND seq <= ?""",
+                       (old.change_seq, change_seq))
+        logged = {row[0] for row in cursor.fetchall()}
+
+        cursor.execute("""SELECT rowid FROM monsters""")
+        rowids = {row[0] for row in cursor.fetchall()}
+
+        removed = [rowid for rowid in old.monsters if rowid not in rowids]
+        changed = [rowid for rowid in rowids
+                   if rowid in logged or rowid not in old.monsters]
+
+        if len(removed) + len(changed) > len(rowids) // 2:
+            return load_catalog(old.db_location, old.formatter, version)
+
+        changed_monsters: Dict[int, Tuple] = {}
+        for i in range(0, len(changed), _fetch_chunk_size):
+            chunk = changed[i:i + _fetch_chunk_size]
+            cursor.execute(f"""SELECT rowid, {monster_columns} FROM monsters
+                WHERE rowid IN ({', '.join(['?']*len(chunk))})""", chunk)
+            changed_monsters.update(
+                {row[0]: row[1:] for row in cursor.fetchall()})
+        (source_hashes, official_sources) = read_sources(cursor)
+
+    monsters = dict(old.monsters)
+    formatted = dict(old.formatted)
+    bitmaps = {facet: dict(facet_bitmaps)
+               for (facet, facet_bitmaps) in old.bitmaps.items()}
+
+    stale = removed + [rowid for rowid in changed_monsters if rowid in old.monsters]
+    unindex_monsters(bitmaps, stale)
+    for rowid in stale:
+        del monsters[rowid]
+        del formatted[rowid]
+
+    index_monsters(bitmaps, changed_monsters)
+    monsters.update(changed_monsters)
+    formatted.update({rowid: old.formatter(monster[:formatted_column_count])
+                      for (rowid, monster) in changed_monsters.items()})
+
+    return Catalog(old.db_location, old.formatter, version, monsters, formatted, bitmaps,
+                   source_hashes, official_sources, old.build, change_seq)
+
+
+_catalogs: Dict[str, Catalog] = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(db_location: str, formatter: MonsterFormatter) -> Catalog:
+    """Returns the up to date catalog for a DB, loading or updating it if necessary"""
+    key = os.path.abspath(db_location)
+    (build, version) = converter.get_catalog_state(db_location)
+    monster_catalog = _catalogs.get(key)
+    if monster_catalog is not None and (monster_catalog.build, monster_catalog.version) == (build, version):
+        return monster_catalog
+
+    with _catalogs_lock:
+        monster_catalog = _catalogs.get(key)
+        (build, version) = converter.get_catalog_state(db_location)
+        if monster_catalog is None or monster_catalog.build != build:
+            monster_catalog = load_catalog(db_location, formatter, version)
+        elif monster_catalog.version != version:
+            monster_catalog = update_catalog(monster_catalog, version)
+        _catalogs[key] = monster_catalog
+    return monster_catalog
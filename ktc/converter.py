@@ -1,18 +1,45 @@
 # -*- coding: utf-8 -*-
-import contextlib
+import collections
+import concurrent.futures
 import csv
+import gzip
 import hashlib
+import io
+import itertools
 import os
+import queue
 import re
 import sqlite3
+import threading
+import uuid
 from io import StringIO
-from typing import Any, List, Tuple
+from fractions import Fraction
+from typing import IO, Any, BinaryIO, Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+try:
+    import db  # type: ignore
+    import metrics  # type: ignore
+except ModuleNotFoundError:
+    from ktc import db  # type: ignore
+    from ktc import metrics  # type: ignore
 
 dir_path = os.path.join(os.path.dirname(__file__), os.pardir, "data/")
 db_location = os.path.abspath(os.path.join(dir_path, "monsters.db"))
 whitespace_pattern = re.compile(r'\s+')
 url_pattern = re.compile(r"(?P<url>https?://[^\s]+)")
 
+# The dimension and junction tables maintained by rebuild_facet_tables
+facet_tables = ["environments", "monster_environments", "alignments", "monster_alignments",
+                "source_ids", "monster_sources"]
+
+# How many processes normalise master.csv's rows when the DB is rebuilt, and how
+# many rows each of them is sent at a time
+ingest_workers = int(os.environ.get("KTC_INGEST_WORKERS", os.cpu_count() or 1))
+ingest_chunk_size = 500
+
+# How many entries of the monster_changes log are kept, see create_change_log
+max_logged_changes = 100000
+
 
 def hash_source_name(source: str) -> str:
     sourcebytes = source.encode('utf-8')
@@ -20,15 +47,73 @@ def hash_source_name(source: str) -> str:
     return "0x" + str(sha.hexdigest())
 
 
-def check_if_key_processed(key: str) -> str:
+# The build id and catalog version last read from each DB, with the change marker
+# they were read under, see get_catalog_state
+_catalog_states: Dict[str, Tuple[db.ChangeMarker, Tuple[str, int]]] = {}
+
+
+def get_catalog_state(db_location: str = db_location) -> Tuple[str, int]:
+    """Returns the DB's build id and current catalog version
+
+    The catalog version is kept in the DB's user_version, and bumped every time the
+    monsters or sources tables change. The build id is the one configure_db gave the
+    DB when it was built, or "" if it has none: a rebuilt DB's catalog version starts
+    again from its new user_version, so anything cached by catalog version must be
+    cached by build id as well.
+
+    Both are read in a single query, and only again once the DB's change marker
+    shows that something, in this process or another, has committed to it since.
+    """
+    key = os.path.abspath(db_location)
+    marker = db.change_marker(key)
+    cached = _catalog_states.get(key)
+    if cached is not None and cached[0] == marker:
+        return cached[1]
+
+    with db.connection(key) as conn:
+        try:
+            row = conn.execute(
+                'SELECT (SELECT id FROM catalog_build), user_version FROM pragma_user_version').fetchone()
+        except sqlite3.OperationalError:
+            row = ("", conn.execute('PRAGMA user_version').fetchone()[0])
+    state = (row[0] or "", row[1])
+    # Read after the marker, so a commit in between only means reading it again
+    _catalog_states[key] = (marker, state)
+    return state
+
+
+def get_catalog_version(db_location: str = db_location) -> int:
+    """Returns the current catalog version of the DB, see get_catalog_state"""
+    return get_catalog_state(db_location)[1]
+
+
+def get_catalog_build(db_location: str = db_location) -> str:
+    """Returns the DB's build id, or "" if it has none, see get_catalog_state"""
+    return get_catalog_state(db_location)[0]
+
+
+def bump_catalog_version(cursor: sqlite3.Cursor) -> int:
+    """Increments the catalog version as part of the cursor's pending transaction"""
+    cursor.execute('PRAGMA user_version')
+    version = cursor.fetchone()[0] + 1
+    cursor.execute(f'PRAGMA user_version = {version}')
+    return version
+
+
+def check_if_key_processed(key: str, db_location: str = db_location) -> str:
+    with db.connection(db_location) as conn:
+        return sheet_source_names(conn.cursor(), key)
+
+
+def sheet_source_names(cursor: sqlite3.Cursor, key: str) -> str:
+    """Returns the names of the sources added from a sheet, as check_if_key_processed does,
+    but as seen by the cursor's transaction"""
     if key == "":
         return ""
-    with contextlib.closing(sqlite3.connect(db_location, uri=True)) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            '''SELECT name FROM sources WHERE url = ?''', (key,))
-        results = [result[0] for result in cursor.fetchall()]
-        return ", ".join(results)
+    cursor.execute(
+        '''SELECT name FROM sources WHERE url = ?''', (key,))
+    results = [result[0] for result in cursor.fetchall()]
+    return ", ".join(results)
 
 
 def split_source_from_index(source: str) -> Tuple[str, str]:
@@ -45,12 +130,120 @@ def split_source_from_index(source: str) -> Tuple[str, str]:
     return (source_name, index)
 
 
+def challenge_rating_value(challenge_rating: str) -> Optional[float]:
+    """Converts a CR string such as "1/4" to a number, or None if it isn't one"""
+    try:
+        return float(Fraction(challenge_rating))
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
 def write_to_db(query: str, values: List[List[Any]], db_location=db_location):
-    with contextlib.closing(sqlite3.connect(db_location)) as conn:
+    submit_write(db_location, lambda cursor: cursor.executemany(query, values)).result()
+
+
+class PendingWrite(NamedTuple):
+    """A write queued for the writer thread, and the future its result is given to"""
+    db_location: str
+    # Makes the write with the cursor passed, and returns its result
+    write: Callable[[sqlite3.Cursor], Any]
+    # Whether the facet tables need rebuilding after the write
+    rebuild_facets: bool
+    future: "concurrent.futures.Future[Any]"
+
+
+# Every write to a DB is queued for a single writer thread, which makes the
+# writes that have queued up while it was busy together in one transaction, in
+# the order they were submitted. The catalog version is bumped, the facet tables
+# rebuilt and the transaction committed once for all of them.
+max_group_size = 32
+_write_queue: "queue.Queue[PendingWrite]" = queue.Queue()
+_writer: Optional[threading.Thread] = None
+_writer_lock = threading.Lock()
+
+writer_metrics = metrics.Counters("writer", "writes", "groups", "failed_writes")
+
+
+def submit_write(db_location: str, write: Callable[[sqlite3.Cursor], Any],
+                 rebuild_facets: bool = False) -> "concurrent.futures.Future[Any]":
+    """Queues a write to a DB for the writer thread
+
+    Each write is made in a savepoint, so a write that raises an exception is
+    rolled back without affecting the others it is committed with.
+
+    Args:
+        db_location (str): the DB to write to
+        write (Callable[[sqlite3.Cursor], Any]): makes the write with the cursor passed, and
+            returns its result. It must not commit.
+        rebuild_facets (bool, optional): whether the facet tables need rebuilding after the write
+
+    Returns:
+        concurrent.futures.Future[Any]: the result of the write, once it has been committed
+    """
+    global _writer
+    future: "concurrent.futures.Future[Any]" = concurrent.futures.Future()
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(
+                target=write_forever, name="ktc-writer", daemon=True)
+            _writer.start()
+    _write_queue.put(PendingWrite(os.path.abspath(db_location), write, rebuild_facets, future))
+    return future
+
+
+def write_forever():
+    """Makes the queued writes, a group at a time, for as long as the process runs"""
+    while True:
+        writes = [_write_queue.get()]
+        while len(writes) < max_group_size:
+            try:
+                writes.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        groups: Dict[str, List[PendingWrite]] = {}
+        for pending in writes:
+            groups.setdefault(pending.db_location, []).append(pending)
+        for (location, group) in groups.items():
+            try:
+                write_group(location, group)
+            except Exception as e:
+                for pending in group:
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+
+
+def write_group(db_location: str, writes: List[PendingWrite]):
+    """Makes a group of writes to a DB in one transaction, in order, and gives each its result"""
+    results: List[Tuple[PendingWrite, Any]] = []
+    with db.connection(db_location) as conn:
         cursor = conn.cursor()
-        cursor.executemany(query, values)
+        # Taking the write lock up front means readers are only ever waited on once
+        cursor.execute("BEGIN IMMEDIATE")
+        for pending in writes:
+            cursor.execute("SAVEPOINT pending_write")
+            try:
+                results.append((pending, pending.write(cursor)))
+                cursor.execute("RELEASE pending_write")
+            except Exception as e:
+                cursor.execute("ROLLBACK TO pending_write")
+                cursor.execute("RELEASE pending_write")
+                writer_metrics.increment("failed_writes")
+                pending.future.set_exception(e)
+
+        if not results:
+            conn.rollback()
+            return
+        if any(pending.rebuild_facets for (pending, _) in results):
+            rebuild_facet_tables(cursor)
+        bump_catalog_version(cursor)
         conn.commit()
 
+    writer_metrics.increment("groups")
+    writer_metrics.increment("writes", len(results))
+    for (pending, result) in results:
+        pending.future.set_result(result)
+
 
 def amalgamate_sources(sources_list: List[List[str]]) -> List[str]:
     master: List[str] = []
@@ -65,193 +258,779 @@ def amalgamate_sources(sources_list: List[List[str]]) -> List[str]:
     return master
 
 
+# The columns of the monsters and sources tables, in order
+monster_table_columns = ["fid", "name", "cr", "size", "type", "tags", "section", "alignment", "environment",
+                         "ac", "hp", "init", "lair", "legendary", "named", "sources", "sourcehashes", "crvalue"]
+source_table_columns = ["name", "official", "hash", "url", "sourceurlhash"]
+
+# Sources that are official whatever the DB says, with their whitespace removed and in lower case
+official_sources = {'basicrulesv1', "player'shandbook", 'monstermanual', 'thewildbeyondthewitchlight', "vanrichten'sguidetoravenloft", 'strixhaven:acurriculumofchaos', "fizban'streasuryofdragons", 'candlekeepmysteries', "tasha'scauldronofeverything", 'strangerthingsanddungeons&dragons', 'beasts&behemoths', 'icewinddale:rimeofthefrostmaiden', 'mythicodysseysoftheros', "explorer'sguidetowildmount", 'dungeons&dragonsvsrickandmorty', 'eberron:risingfromthelastwar', 'infernalmachinerebuild', 'tyrranyofdragons', 'locathahrising', "baldur'sgate:descentintoavernus",
+                    'dungeons&dragonsessentialskit', 'acquisitionsincorporated', 'ghostsofsaltmarsh', "guildmasters'guidetoravnica", 'waterdeep:dungeonofthemadmage', 'waterdeep:dragonheist', 'lostlaboratoryofkwalish', "mordenkainen'stomeoffoes", 'intotheborderlands', "xanathar'sguidetoeverything", 'tombofannihilation', 'thetortlepackage', 'talesfromtheyawningportal', "volo'sguidetomonsters", "stormking'sthunder", 'curseofstrahd', "swordcoastadventurer'sguide", 'outoftheabyss', "player'scompanion", 'princesoftheapocalypse', "dungeonmaster'sguide", 'riseoftiamat', 'hoardofthedragonqueen', "explorer'sguidetowildemount"}
+# Alternative names used for official sources in sheets, and the names they're stored as
+source_replace_from = [
+    "Waterdeep dungeon Of The Mad Mage", "Waterdeep Dungeon of the Mad Mage", "Waterdeep Dragon Heist", 'Eberron - Rising from the Last War', "Baldur's Gate - Descent into Avernus", "Explorers Guide to Wildemount", "Rime of the Frost Maiden", "Icewind Dale", "Tome of Beasts 2"]
+source_replace_to = [
+    "Waterdeep: Dungeon of the Mad Mage", "Waterdeep: Dungeon of the Mad Mage", "Waterdeep: Dragon Heist", "Eberron: Rising from the Last War", "Baldur's Gate: Descent into Avernus", "Explorer's Guide to Wildemount", "Icewind Dale: Rime of the Frost Maiden", "Icewind Dale: Rime of the Frost Maiden", "Tome of Beasts II"]
+
+
+class CursorIngestStore:
+    """Reads and writes the monsters and sources tables for ingest_data, one query at a time"""
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        self.cursor = cursor
+
+    def official_source_names(self) -> List[str]:
+        self.cursor.execute(
+            '''SELECT name FROM sources WHERE official = 1''')
+        return [source[0] for source in self.cursor.fetchall()]
+
+    def monster_sources(self, name: str) -> List[str]:
+        """Returns the sources string of the monster with this name, if there is one"""
+        self.cursor.execute('SELECT sources FROM monsters WHERE name = ?',
+                            (name,))
+        return [string[0] for string in self.cursor.fetchall()]
+
+    def source_is_official(self, name: str) -> bool:
+        self.cursor.execute(
+            '''SELECT official FROM sources WHERE name = ?''', (name,))
+        return bool(self.cursor.fetchall()[0][0])
+
+    def rename_monsters(self, updates: List[Tuple[str, str, str]], ignore_conflicts: bool) -> int:
+        """Renames monsters, given (new name, name, sources) for each, and returns how many were renamed"""
+        if ignore_conflicts:
+            self.cursor.executemany(
+                '''UPDATE OR IGNORE monsters SET name = ? WHERE name = ? AND sources = ?''', (updates))
+        else:
+            self.cursor.executemany(
+                '''UPDATE monsters SET name = ? WHERE name = ? AND sources = ?''', (updates))
+        return max(self.cursor.rowcount, 0)
+
+    def insert_sources(self, rows: List[List[Any]]):
+        self.cursor.executemany('''INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?)''',
+                                rows)
+
+    def insert_monster(self, values: List[Any]) -> int:
+        """Adds a monster, replacing any with the same name, and returns its rowid"""
+        self.cursor.execute(
+            '''INSERT OR REPLACE INTO monsters VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', values)
+        rowid = self.cursor.lastrowid
+        # Always set after a successful INSERT
+        assert rowid is not None
+        return rowid
+
+    def monster_rowid(self, name: str) -> Optional[int]:
+        self.cursor.execute('SELECT rowid FROM monsters WHERE name = ?', (name,))
+        result = self.cursor.fetchone()
+        return None if result is None else result[0]
+
+    def monster_sources_by_rowid(self, rowid: int) -> Optional[str]:
+        self.cursor.execute('SELECT sources FROM monsters WHERE rowid = ?', (rowid,))
+        result = self.cursor.fetchone()
+        return None if result is None else result[0]
+
+    def delete_monsters(self, rowids: Iterable[int]):
+        self.cursor.executemany('DELETE FROM monsters WHERE rowid = ?',
+                                [(rowid,) for rowid in rowids])
+
+    def sheet_source_hashes(self, url: str) -> List[str]:
+        """Returns the sourceurlhash of every source added from a sheet"""
+        self.cursor.execute('''SELECT sourceurlhash FROM sources WHERE url = ?''', (url,))
+        return [result[0] for result in self.cursor.fetchall()]
+
+    def delete_sources(self, source_url_hashes: Iterable[str]):
+        self.cursor.executemany('''DELETE FROM sources WHERE sourceurlhash = ?''',
+                                [(source_url_hash,) for source_url_hash in source_url_hashes])
+
+    def sheet_digests(self, url: str) -> Dict[str, Tuple[str, int, int]]:
+        """Returns the sourceurlhash, monster rowid and merged flag of every row added from a sheet, by its digest"""
+        self.cursor.execute('''SELECT digest, row_digests.sourceurlhash, monster_id, merged FROM row_digests
+            JOIN sources ON sources.sourceurlhash = row_digests.sourceurlhash WHERE sources.url = ?''', (url,))
+        return {digest: (source_url_hash, monster_id, merged)
+                for (digest, source_url_hash, monster_id, merged) in self.cursor.fetchall()}
+
+    def has_digests(self, monster_id: int) -> bool:
+        self.cursor.execute('''SELECT 1 FROM row_digests WHERE monster_id = ? LIMIT 1''', (monster_id,))
+        return self.cursor.fetchone() is not None
+
+    def record_digest(self, source_url_hash: str, digest: str, monster_id: int, merged: bool):
+        self.cursor.execute('''INSERT OR REPLACE INTO row_digests VALUES (?, ?, ?, ?)''',
+                            (source_url_hash, digest, monster_id, int(merged)))
+
+    def move_digests(self, from_monster_id: int, to_monster_id: int):
+        """Points the digests of the rows that added a monster at the monster that replaced it"""
+        self.cursor.execute('''UPDATE row_digests SET monster_id = ? WHERE monster_id = ?''',
+                            (to_monster_id, from_monster_id))
+
+    def delete_digests(self, digests: Iterable[Tuple[str, str]]):
+        """Deletes the digests passed as (sourceurlhash, digest) pairs"""
+        self.cursor.executemany('''DELETE FROM row_digests WHERE sourceurlhash = ? AND digest = ?''',
+                                digests)
+
+    def delete_monster_digests(self, monster_ids: Iterable[int]):
+        """Deletes the digests of every row, of any sheet, that added the monsters passed"""
+        self.cursor.executemany('''DELETE FROM row_digests WHERE monster_id = ?''',
+                                [(monster_id,) for monster_id in monster_ids])
+
+    def flush(self):
+        pass
+
+
+class BulkTable:
+    """An in-memory copy of a table with one UNIQUE column, changed as SQLite would change it
+
+    Rows are kept by rowid. An INSERT OR REPLACE deletes the row it conflicts
+    with and gets a rowid one more than the largest in the table, counting the
+    row it replaces, just like SQLite's. Unlike SQLite, the rowids of deleted rows
+    are never handed out again. Only the rows changed since loading are written
+    back, by flush.
+    """
+
+    def __init__(self, cursor: sqlite3.Cursor, table: str, columns: List[str], unique_column: str):
+        self.cursor = cursor
+        self.table = table
+        self.columns = columns
+        self.unique_index = columns.index(unique_column)
+        cursor.execute(f'''SELECT rowid, {", ".join(columns)} FROM {table}''')
+        self.rows: Dict[int, List[Any]] = {
+            row[0]: list(row[1:]) for row in cursor.fetchall()}
+        self.rowids = {row[self.unique_index]: rowid for (rowid, row) in self.rows.items()}
+        self.max_rowid = max(self.rows, default=0)
+        self.loaded = set(self.rows)
+        self.changed: set = set()
+
+    def replace(self, values: List[Any]) -> int:
+        """Does an INSERT OR REPLACE of a row, returning its rowid"""
+        self.max_rowid += 1
+        existing = self.rowids.get(values[self.unique_index])
+        if existing is not None:
+            del self.rows[existing]
+            self.changed.add(existing)
+        self.rows[self.max_rowid] = list(values)
+        self.rowids[values[self.unique_index]] = self.max_rowid
+        self.changed.add(self.max_rowid)
+        return self.max_rowid
+
+    def delete(self, rowid: int):
+        row = self.rows.pop(rowid)
+        del self.rowids[row[self.unique_index]]
+        self.changed.add(rowid)
+
+    def update_unique(self, rowid: int, value: Any, ignore_conflicts: bool) -> bool:
+        """Changes the unique column of a row, as an UPDATE (OR IGNORE) would"""
+        if value in self.rowids:
+            if ignore_conflicts:
+                return False
+            raise sqlite3.IntegrityError(
+                f"UNIQUE constraint failed: {self.table}.{self.columns[self.unique_index]}")
+        row = self.rows[rowid]
+        del self.rowids[row[self.unique_index]]
+        row[self.unique_index] = value
+        self.rowids[value] = rowid
+        self.changed.add(rowid)
+        return True
+
+    def flush(self):
+        """Writes every changed row back in one batch of deletes and one of inserts"""
+        self.cursor.executemany(f'''DELETE FROM {self.table} WHERE rowid = ?''',
+                                [(rowid,) for rowid in sorted(self.changed & self.loaded)])
+        placeholders = ", ".join(["?"] * (len(self.columns) + 1))
+        self.cursor.executemany(f'''INSERT INTO {self.table} (rowid, {", ".join(self.columns)}) VALUES ({placeholders})''',
+                                [[rowid] + self.rows[rowid] for rowid in sorted(self.changed) if rowid in self.rows])
+        self.loaded = set(self.rows)
+        self.changed = set()
+
+
+class BulkIngestStore(CursorIngestStore):
+    """Reads and writes the monsters and sources tables for ingest_data in memory
+
+    Both tables are loaded once, and every change is written back by flush in
+    a few executemany calls, leaving the tables just as CursorIngestStore would.
+    """
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        super().__init__(cursor)
+        self.monsters = BulkTable(
+            cursor, "monsters", monster_table_columns, "name")
+        self.sources = BulkTable(
+            cursor, "sources", source_table_columns, "sourceurlhash")
+        self.name_column = monster_table_columns.index("name")
+        self.sources_column = monster_table_columns.index("sources")
+        # The rowid and officiality of every row of sources, by source name
+        self.sources_by_name: Dict[str, Dict[int, Any]] = {}
+        for (rowid, row) in self.sources.rows.items():
+            self.sources_by_name.setdefault(row[0], {})[rowid] = row[1]
+
+    def official_source_names(self) -> List[str]:
+        return [row[0] for (_, row) in sorted(self.sources.rows.items()) if row[1] == 1]
+
+    def monster_sources(self, name: str) -> List[str]:
+        rowid = self.monsters.rowids.get(name)
+        if rowid is None:
+            return []
+        return [self.monsters.rows[rowid][self.sources_column]]
+
+    def source_is_official(self, name: str) -> bool:
+        # SELECT official FROM sources WHERE name = ? gives the lowest rowid first
+        rows = self.sources_by_name.get(name)
+        if not rows:
+            # Just as fetchall()[0] fails when there is no such source
+            raise IndexError(f"There is no source named {name}")
+        return bool(rows[min(rows)])
+
+    def rename_monsters(self, updates: List[Tuple[str, str, str]], ignore_conflicts: bool) -> int:
+        renamed = 0
+        for (new_name, name, sources) in updates:
+            rowid = self.monsters.rowids.get(name)
+            if rowid is not None and self.monsters.rows[rowid][self.sources_column] == sources:
+                renamed += self.monsters.update_unique(rowid, new_name, ignore_conflicts)
+        return renamed
+
+    def insert_sources(self, rows: List[List[Any]]):
+        for row in rows:
+            existing = self.sources.rowids.get(row[4])
+            if existing is not None:
+                del self.sources_by_name[self.sources.rows[existing][0]][existing]
+            rowid = self.sources.replace(row)
+            self.sources_by_name.setdefault(row[0], {})[rowid] = row[1]
+
+    def insert_monster(self, values: List[Any]) -> int:
+        return self.monsters.replace(values)
+
+    def monster_rowid(self, name: str) -> Optional[int]:
+        return self.monsters.rowids.get(name)
+
+    def monster_sources_by_rowid(self, rowid: int) -> Optional[str]:
+        row = self.monsters.rows.get(rowid)
+        return None if row is None else row[self.sources_column]
+
+    def delete_monsters(self, rowids: Iterable[int]):
+        for rowid in rowids:
+            self.monsters.delete(rowid)
+
+    def sheet_source_hashes(self, url: str) -> List[str]:
+        return [row[4] for row in self.sources.rows.values() if row[3] == url]
+
+    def delete_sources(self, source_url_hashes: Iterable[str]):
+        for source_url_hash in source_url_hashes:
+            rowid = self.sources.rowids[source_url_hash]
+            del self.sources_by_name[self.sources.rows[rowid][0]][rowid]
+            self.sources.delete(rowid)
+
+    def flush(self):
+        self.sources.flush()
+        self.monsters.flush()
+
+
+class IngestProgress:
+    """How far an ingest has got, counted by ingest_rows as it goes, so that another thread can report it"""
+
+    def __init__(self):
+        self.rows_parsed = 0
+        self.rows_written = 0
+        self.renames = 0
+
+    def to_dict(self) -> Dict[str, int]:
+        return {"rows_parsed": self.rows_parsed, "rows_written": self.rows_written, "renames": self.renames}
+
+
+def ingest_data(csv_string: str, db_location: str, source="", bulk: bool = False, workers: int = 0,
+                progress: Optional[IngestProgress] = None):
+    """Adds the monsters in a CSV to the DB, renaming monsters that share a name with another source's
+
+    Args:
+        csv_string (str): the CSV, with a header row
+        db_location (str): the DB to add the monsters to
+        source (str, optional): the key of the sheet the CSV came from, if any
+        bulk (bool, optional): write every change in one batch, see ingest_rows
+        workers (int, optional): how many processes to normalise the rows on, see ingest_rows
+        progress (IngestProgress, optional): counts how far the ingest has got, if given
+
+    Returns:
+        str: the names of the sources added from the sheet
+    """
+    return ingest_rows(csv.DictReader(StringIO(csv_string), delimiter=','), db_location, source, bulk, workers,
+                       progress)
+
+
+def ingest_stream(stream: BinaryIO, db_location: str, source="", bulk: bool = False, compressed: bool = False,
+                  progress: Optional[IngestProgress] = None):
+    """Adds the monsters in a UTF-8 CSV read from a binary stream to the DB, a row at a time
+
+    Unlike ingest_data, the CSV is never held in memory as a whole, so big sheets
+    can be uploaded without buffering them first.
+
+    Args:
+        stream (BinaryIO): the CSV, with a header row
+        db_location (str): the DB to add the monsters to
+        source (str, optional): the key of the sheet the CSV came from, if any
+        bulk (bool, optional): write every change in one batch, see ingest_rows
+        compressed (bool, optional): whether the stream is gzipped
+        progress (IngestProgress, optional): counts how far the ingest has got, if given
+
+    Returns:
+        str: the names of the sources added from the sheet
+    """
+    if compressed:
+        stream = gzip.GzipFile(fileobj=stream, mode="rb")  # type: ignore
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")  # type: ignore
+    try:
+        return ingest_rows(csv.DictReader(text, delimiter=','), db_location, source, bulk, progress=progress)
+    finally:
+        # Leave the underlying stream for its owner to close
+        text.detach()
+
+
+# The name and index of a source, whether it's official, the hash of its name, and
+# the hash of its name and the key of the sheet it came from
+SourceDetails = Tuple[str, str, int, str, str]
+
+
+class NormalisedRow(NamedTuple):
+    """A CSV row cleaned up by normalise_row, waiting to be checked for name-twins and added"""
+    name: str
+    sources: List[str]
+    is_official: bool
+    # The monster's columns, with the name, sources and source hashes left to fill in
+    values: List[Any]
+    source_details: Dict[str, SourceDetails]
+    digest: str
+
+
+def row_digest(row: Dict[str, str]) -> str:
+    """Returns a digest of everything in a CSV row, to tell whether it has changed since it was added"""
+    return hashlib.sha1(repr(list(row.items())).encode('utf-8')).hexdigest()
+
+
+def clean_value(value: Any) -> Any:
+    if type(value) == str:
+        value = value.replace("'           '", "")
+        value = value.strip()
+    return value
+
+
+def is_official_source(source_name: str, sources_official: Set[str]) -> bool:
+    return re.sub(whitespace_pattern, '', source_name.lower()) in official_sources or source_name in sources_official
+
+
+def describe_source(source: str, sources_official: Set[str], source_url: str) -> SourceDetails:
+    (source_name, index) = split_source_from_index(source)
+    return (source_name, index, 1 if is_official_source(source_name, sources_official) else 0,
+            hash_source_name(source_name), hash_source_name(f"{source_name}{source_url}"))
+
+
+def normalise_row(row: Dict[str, str], sources_official: Set[str], source_url: str) -> NormalisedRow:
+    """Does all the work of adding a CSV row that doesn't depend on the monsters already in the DB
+
+    Args:
+        row (Dict[str, str]): the row, keyed by the CSV's header row
+        sources_official (Set[str]): the names of the official sources in the DB
+        source_url (str): the key of the sheet the row came from, if any
+
+    Returns:
+        NormalisedRow: the cleaned up row
+    """
+    monster_is_official = False
+    dirty_sources = row['sources'].split(', ')
+    sources = []
+    for source in dirty_sources:
+        (source_name, index) = split_source_from_index(source)
+        try:
+            source_name = source_replace_to[source_replace_from.index(
+                source_name)]
+        except ValueError:
+            pass
+        finally:
+            if index == '':
+                sources.append(f"{source_name}")
+            else:
+                sources.append(f"{source_name}: {index}")
+
+        if is_official_source(source_name, sources_official):
+            monster_is_official = True
+
+    # Start sanity checking the data
+
+    # Tidy up alignments
+    if row['alignment'] == "any":
+        alignment = "any alignment"
+    elif row['alignment'] == "":
+        alignment = "unaligned"
+    else:
+        alignment = row['alignment'].lower()
+
+    # Prevent blank environments
+    if re.sub(whitespace_pattern, '', row['environment']) == "":
+        environments = "no environment specified"
+    else:
+        environments = row['environment']
+
+    # Some source sheets don't have tags or sections...
+    try:
+        monster_tags = row["tags"]
+    except KeyError:
+        monster_tags = ""
+
+    try:
+        monster_section = row["section"]
+    except KeyError:
+        monster_section = ""
+
+    try:
+        is_legendary = 1 if row['legendary'] == "legendary" else 0
+    except KeyError:
+        is_legendary = 0
+
+    try:
+        is_named = 1 if row['named'] == "named" else 0
+    except KeyError:
+        is_named = 0
+
+    values: List[Any] = []
+    try:
+        values = [row['fid'], None, row['cr'], row['size'], row["type"], monster_tags, monster_section, alignment,
+                  environments, row['ac'], row['hp'], row['init'], row['lair'], is_legendary, is_named, None, None]
+    except KeyError:
+        values = [row['fid'], None, row['cr'], row['size'], row["type"], monster_tags, monster_section, alignment,
+                  environments, row['ac'], row['hp'], row['init'], row['lair?'], is_legendary, is_named, None, None]
+
+    values = [clean_value(value) for value in values]
+    values.append(challenge_rating_value(values[2]))
+
+    source_details = {source: describe_source(source, sources_official, source_url)
+                      for source in sources}
+    return NormalisedRow(row['name'], sources, monster_is_official, values, source_details, row_digest(row))
+
+
+def normalise_rows(rows: List[Dict[str, str]], sources_official: Set[str], source_url: str) -> List[NormalisedRow]:
+    """Normalises a chunk of rows, in a worker process of normalise_in_parallel"""
+    return [normalise_row(row, sources_official, source_url) for row in rows]
+
+
+def normalise_in_parallel(rows: Iterable[Dict[str, str]], sources_official: Set[str], source_url: str,
+                          workers: int) -> Iterator[NormalisedRow]:
+    """Normalises rows in chunks on a pool of worker processes, yielding them in their original order
+
+    Only two chunks per worker are read ahead of the rows yielded, so that the
+    whole CSV is never held in memory.
+    """
+    rows = iter(rows)
+    chunks = iter(lambda: list(itertools.islice(rows, ingest_chunk_size)), [])
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending: Deque[concurrent.futures.Future] = collections.deque()
+        for chunk in chunks:
+            pending.append(executor.submit(normalise_rows, chunk, sources_official, source_url))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def counted(rows: Iterable[NormalisedRow], progress: Optional[IngestProgress]) -> Iterator[NormalisedRow]:
+    for row in rows:
+        if progress is not None:
+            progress.rows_parsed += 1
+        yield row
+
+
+def add_normalised_row(store: CursorIngestStore, row: NormalisedRow, sources_official: Set[str],
+                       source_url: str, progress: Optional[IngestProgress] = None) -> Optional[int]:
+    """Resolves a normalised row's name-twins and adds it and its sources to the DB
+
+    The digest of a row from a sheet is kept, tied to the sheet by the
+    sourceurlhash of the row's first source, so that the sheet can be diffed
+    when it is submitted again. A row whose monster replaced one that no sheet's
+    row added, such as one from master.csv, is marked as merged, so that the
+    diff doesn't delete the monster when the row is removed.
+
+    Args:
+        store (CursorIngestStore): the monsters and sources tables to add the row to
+        row (NormalisedRow): the row, as returned by normalise_row
+        sources_official (Set[str]): the names of the official sources in the DB
+        source_url (str): the key of the sheet the row came from, if any
+        progress (IngestProgress, optional): counts the row if it is written, and any renames
+
+    Returns:
+        Optional[int]: the rowid of the monster added, or None if the row was skipped
+    """
+    sources = row.sources
+    monster_is_official = row.is_official
+
+    # Now comes the fun; we need to define some logic for handling monsters with similar names
+    # Specifically, if monsters from multiple sources have the same name, we need to put a name
+    # abbreviation next to the name to prevent confusion.
+    # However, official monsters should not have an abbreviation next to their name, and many
+    # official monsters are in multiple sourcebooks.
+    # This logic should hold true even if a custom monster is in the db before an official monster
+    # of the same name.
+    # Start situations: official monster in db, unofficial monster in db, both in db, neither in db
+    # Changes: official monster added, unofficial monster added
+
+    monster_name = row.name
+    sources_of_nametwins = []
+    renamed = 0
+
+    existing_monsters_with_name_string = store.monster_sources(
+        monster_name)
+    for string in existing_monsters_with_name_string:
+        sources_of_nametwins += string.split(', ')
+
+    official_nametwins = []
+    unofficial_nametwins = []
+    for source in sources_of_nametwins:
+        name, _ = split_source_from_index(source)
+        if store.source_is_official(name):
+            official_nametwins.append(source)
+        else:
+            unofficial_nametwins.append(source)
+
+    if sources_of_nametwins:
+        if monster_is_official:
+            sources = amalgamate_sources(
+                [sources, official_nametwins])
+            updates = []
+            for un_source in unofficial_nametwins:
+                name, _ = split_source_from_index(un_source)
+                source_acronym = ''.join([word[0]
+                                          for word in name.split()])
+                new_name = f"{row.name} ({source_acronym})"
+                updates.append((new_name, monster_name, un_source))
+            renamed = store.rename_monsters(updates, ignore_conflicts=False)
+
+        else:
+            updates = []
+            if list(filter(lambda x: x in sources, unofficial_nametwins)) != []:
+                # print(amalgamate_sources([sources, unofficial_nametwins]))
+                # cursor.execute('''UPDATE monsters SET sources = ? WHERE name = ? AND sources = ?''', (", ".join(amalgamate_sources([sources, unofficial_nametwins])), monster_name, un_source,))
+                return None
+            for un_source in unofficial_nametwins:
+                name, _ = split_source_from_index(un_source)
+                source_acronym = ''.join([word[0]
+                                          for word in name.split()])
+                new_name = f"{row.name} ({source_acronym})"
+                updates.append((new_name, monster_name, un_source))
+            name, _ = split_source_from_index(sources[0])
+            source_acronym = ''.join([word[0]
+                                      for word in name.split()])
+            monster_name = f"{row.name} ({source_acronym})"
+            renamed = store.rename_monsters(updates, ignore_conflicts=True)
+
+    # Standardise the way sources are saved and confirm officiality - or lack thereof - of source
+    source_hashes = []
+    corrected_sources = []
+    storing_sources = []
+    for source in sources:
+        # Only the official name-twins' sources weren't described by normalise_row
+        details = row.source_details.get(source)
+        if details is None:
+            details = describe_source(source, sources_official, source_url)
+        (source_name, index, is_official, source_hash, source_url_hash) = details
+
+        corrected_sources.append(f"{source_name}: {index}")
+        source_hashes.append(source_hash)
+
+        storing_sources.append([source_name, is_official, source_hash, source_url, source_url_hash])
+
+    store.insert_sources(storing_sources)
+
+    values = list(row.values)
+    values[1] = clean_value(monster_name)
+    values[15] = clean_value(', '.join(corrected_sources))
+    values[16] = clean_value(','.join(source_hashes))
+
+    replaced = store.monster_rowid(values[1])
+    merged = replaced is not None and not store.has_digests(replaced)
+    monster_id = store.insert_monster(values)
+    if replaced is not None:
+        store.move_digests(replaced, monster_id)
+    if source_url != "":
+        store.record_digest(row.source_details[row.sources[0]][4], row.digest, monster_id, merged)
+    if progress is not None:
+        progress.rows_written += 1
+        progress.renames += renamed
+    return monster_id
+
+
+def apply_sheet_diff(store: CursorIngestStore, rows: Iterable[NormalisedRow], digests: Dict[str, Tuple[str, int, int]],
+                     sources_official: Set[str], source_url: str,
+                     progress: Optional[IngestProgress] = None) -> Tuple[int, int]:
+    """Brings the monsters added from a sheet up to date with its rows, by their digests
+
+    The monsters of rows that have been removed or changed are deleted, unless
+    they were merged into an existing monster, and only the rows that are new or
+    changed are added. Monsters renamed because of a deleted monster keep their
+    new names.
+
+    Args:
+        store (CursorIngestStore): the monsters and sources tables to change
+        rows (Iterable[NormalisedRow]): every row of the sheet, as returned by normalise_row
+        digests (Dict[str, Tuple[str, int, int]]): the digests kept when the sheet was last added,
+            as returned by CursorIngestStore.sheet_digests
+        sources_official (Set[str]): the names of the official sources in the DB
+        source_url (str): the key of the sheet
+        progress (IngestProgress, optional): counts the rows written and renames, if given
+
+    Returns:
+        Tuple[int, int]: how many rows were added and how many were removed
+    """
+    added: List[NormalisedRow] = []
+    kept = set()
+    for row in rows:
+        if row.digest in digests:
+            kept.add(row.digest)
+        else:
+            added.append(row)
+    removed = [digest for digest in digests if digest not in kept]
+
+    kept_monsters = {digests[digest][1] for digest in kept}
+    store.delete_digests([(digests[digest][0], digest) for digest in removed])
+    deleted = {digests[digest][1] for digest in removed
+               if not digests[digest][2] and digests[digest][1] not in kept_monsters}
+    store.delete_monsters(deleted)
+    # Other sheets' rows may have been merged into the deleted monsters too, and
+    # will be added again when those sheets are diffed
+    store.delete_monster_digests(deleted)
+
+    monster_ids = kept_monsters - deleted
+    for row in added:
+        rowid = add_normalised_row(store, row, sources_official, source_url, progress)
+        if rowid is not None:
+            monster_ids.add(rowid)
+
+    # Drop the sheet's sources that none of its monsters are from any more
+    in_use = set()
+    for monster_id in monster_ids:
+        sources = store.monster_sources_by_rowid(monster_id)
+        for source in (sources or "").split(', '):
+            (source_name, _) = split_source_from_index(source)
+            in_use.add(hash_source_name(f"{source_name}{source_url}"))
+    store.delete_sources([source_url_hash for source_url_hash in store.sheet_source_hashes(source_url)
+                          if source_url_hash not in in_use])
+
+    return (len(added), len(removed))
+
+
 # TODO: split this up, I guess?
-def ingest_data(csv_string: str, db_location: str, source=""):
+def ingest_rows(rows: Iterable[Dict[str, str]], db_location: str, source="", bulk: bool = False, workers: int = 0,
+                progress: Optional[IngestProgress] = None):
+    """Adds monsters to the DB, renaming monsters that share a name with another source's
+
+    Args:
+        rows (Iterable[Dict[str, str]]): the rows of a CSV, keyed by its header row
+        db_location (str): the DB to add the monsters to
+        source (str, optional): the key of the sheet the CSV came from, if any
+        bulk (bool, optional): load the monsters and sources tables into memory and
+            write every change in one batch, instead of querying the DB for every
+            monster. Both leave the DB the same, but bulk is much faster for big CSVs,
+            at the cost of holding the whole of both tables in memory.
+        workers (int, optional): if more than 1, normalise the rows in chunks on this
+            many processes, while this one resolves name-twins and writes them in order.
+            This only pays off for CSVs of thousands of rows.
+        progress (IngestProgress, optional): counts the rows parsed and written, and the
+            monsters renamed, as the ingest goes
+
+    A sheet that has been added before is diffed against the digests of the rows
+    it was last added with, see apply_sheet_diff, rather than added again.
+
+    The ingest is made by the writer thread, along with any others submitted at
+    the same time, see submit_write, and this waits for it to be committed. The
+    rows are read, normalised and written a chunk at a time, so an ingest's memory
+    doesn't grow with the size of the sheet. Since they are read on the writer
+    thread, they should come from somewhere quick to read, such as a spooled
+    upload, see api.spool_stream, rather than straight from a slow client.
+
+    Returns:
+        str: the names of the sources added from the sheet
+    """
     source_url = str(source)
-    official_sources = ['basicrulesv1', "player'shandbook", 'monstermanual', 'thewildbeyondthewitchlight', "vanrichten'sguidetoravenloft", 'strixhaven:acurriculumofchaos', "fizban'streasuryofdragons", 'candlekeepmysteries', "tasha'scauldronofeverything", 'strangerthingsanddungeons&dragons', 'beasts&behemoths', 'icewinddale:rimeofthefrostmaiden', 'mythicodysseysoftheros', "explorer'sguidetowildmount", 'dungeons&dragonsvsrickandmorty', 'eberron:risingfromthelastwar', 'infernalmachinerebuild', 'tyrranyofdragons', 'locathahrising', "baldur'sgate:descentintoavernus",
-                        'dungeons&dragonsessentialskit', 'acquisitionsincorporated', 'ghostsofsaltmarsh', "guildmasters'guidetoravnica", 'waterdeep:dungeonofthemadmage', 'waterdeep:dragonheist', 'lostlaboratoryofkwalish', "mordenkainen'stomeoffoes", 'intotheborderlands', "xanathar'sguidetoeverything", 'tombofannihilation', 'thetortlepackage', 'talesfromtheyawningportal', "volo'sguidetomonsters", "stormking'sthunder", 'curseofstrahd', "swordcoastadventurer'sguide", 'outoftheabyss', "player'scompanion", 'princesoftheapocalypse', "dungeonmaster'sguide", 'riseoftiamat', 'hoardofthedragonqueen', "explorer'sguidetowildemount"]
-    source_replace_from = [
-        "Waterdeep dungeon Of The Mad Mage", "Waterdeep Dungeon of the Mad Mage", "Waterdeep Dragon Heist", 'Eberron - Rising from the Last War', "Baldur's Gate - Descent into Avernus", "Explorers Guide to Wildemount", "Rime of the Frost Maiden", "Icewind Dale", "Tome of Beasts 2"]
-    source_replace_to = [
-        "Waterdeep: Dungeon of the Mad Mage", "Waterdeep: Dungeon of the Mad Mage", "Waterdeep: Dragon Heist", "Eberron: Rising from the Last War", "Baldur's Gate: Descent into Avernus", "Explorer's Guide to Wildemount", "Icewind Dale: Rime of the Frost Maiden", "Icewind Dale: Rime of the Frost Maiden", "Tome of Beasts II"]
-
-    with contextlib.closing(sqlite3.connect(db_location, uri=True)) as conn:
-        f = StringIO(csv_string)
-        csv_reader = csv.DictReader(f, delimiter=',')
-        cursor = conn.cursor()
-        sources_in_url: List[str] = []
 
-        if already_processed := check_if_key_processed(source_url):
+    def ingest(cursor: sqlite3.Cursor) -> str:
+        create_row_digests_table(cursor)
+        create_change_log(cursor)
+
+        # Checked in the writer's transaction, so that two submissions of the same
+        # sheet can't both find it hasn't been added yet
+        already_processed = sheet_source_names(cursor, source_url)
+        digests = CursorIngestStore(cursor).sheet_digests(
+            source_url) if already_processed else {}
+        if already_processed and not digests:
+            # Sheets added before row digests were kept can't be diffed, so they
+            # are left as they are
             return already_processed
 
-        cursor.execute(
-            '''SELECT name FROM sources WHERE official = 1''')
-        sources_official = [source[0] for source in cursor.fetchall()]
-
-        for row in csv_reader:
-            monster_is_official = False
-            dirty_sources = row['sources'].split(', ')
-            sources = []
-            for source in dirty_sources:
-                (source_name, index) = split_source_from_index(source)
-                try:
-                    source_name = source_replace_to[source_replace_from.index(
-                        source_name)]
-                except ValueError:
-                    pass
-                finally:
-                    if index == '':
-                        sources.append(f"{source_name}")
-                    else:
-                        sources.append(f"{source_name}: {index}")
-
-                if re.sub(whitespace_pattern, '', source_name.lower()) in official_sources or source_name in sources_official:
-                    monster_is_official = True
-
-            # Now comes the fun; we need to define some logic for handling monsters with similar names
-            # Specifically, if monsters from multiple sources have the same name, we need to put a name
-            # abbreviation next to the name to prevent confusion.
-            # However, official monsters should not have an abbreviation next to their name, and many
-            # official monsters are in multiple sourcebooks.
-            # This logic should hold true even if a custom monster is in the db before an official monster
-            # of the same name.
-            # Start situations: official monster in db, unofficial monster in db, both in db, neither in db
-            # Changes: official monster added, unofficial monster added
-
-            monster_name = row['name']
-            sources_of_nametwins = []
-
-            cursor.execute('SELECT sources FROM monsters WHERE name = ?',
-                           (monster_name,))
-
-            existing_monsters_with_name_string = cursor.fetchall()
-            for string in existing_monsters_with_name_string:
-                sources_of_nametwins += string[0].split(', ')
-
-            official_nametwins = []
-            unofficial_nametwins = []
-            for source in sources_of_nametwins:
-                name, _ = split_source_from_index(source)
-                cursor.execute(
-                    '''SELECT official FROM sources WHERE name = ?''', (name,))
-                if cursor.fetchall()[0][0]:
-                    official_nametwins.append(source)
-                else:
-                    unofficial_nametwins.append(source)
-
-            if sources_of_nametwins:
-                if monster_is_official:
-                    sources = amalgamate_sources(
-                        [sources, official_nametwins])
-                    updates = []
-                    for un_source in unofficial_nametwins:
-                        name, _ = split_source_from_index(un_source)
-                        source_acronym = ''.join([word[0]
-                                                  for word in name.split()])
-                        new_name = f"{row['name']} ({source_acronym})"
-                        updates.append((new_name, monster_name, un_source))
-                    cursor.executemany(
-                        '''UPDATE monsters SET name = ? WHERE name = ? AND sources = ?''', (updates))
-
-                else:
-                    updates = []
-                    if list(filter(lambda x: x in sources, unofficial_nametwins)) != []:
-                        # print(amalgamate_sources([sources, unofficial_nametwins]))
-                        # cursor.execute('''UPDATE monsters SET sources = ? WHERE name = ? AND sources = ?''', (", ".join(amalgamate_sources([sources, unofficial_nametwins])), monster_name, un_source,))
-                        continue
-                    for un_source in unofficial_nametwins:
-                        name, _ = split_source_from_index(un_source)
-                        source_acronym = ''.join([word[0]
-                                                  for word in name.split()])
-                        new_name = f"{row['name']} ({source_acronym})"
-                        updates.append((new_name, monster_name, un_source))
-                    name, _ = split_source_from_index(sources[0])
-                    source_acronym = ''.join([word[0]
-                                              for word in name.split()])
-                    monster_name = f"{row['name']} ({source_acronym})"
-                    cursor.executemany(
-                        '''UPDATE OR IGNORE monsters SET name = ? WHERE name = ? AND sources = ?''', (updates))
-
-            # Standardise the way sources are saved and confirm officiality - or lack thereof - of source
-            source_hashes = []
-            corrected_sources = []
-            storing_sources = []
-            for source in sources:
-                (source_name, index) = split_source_from_index(source)
-                if re.sub(whitespace_pattern, '', source_name.lower()) in official_sources or source_name in sources_official:
-                    source_is_official = 1
-                else:
-                    source_is_official = 0
-
-                corrected_sources.append(f"{source_name}: {index}")
-                source_hashes.append(hash_source_name(source_name))
-
-                storing_sources.append([source_name, source_is_official, hash_source_name(
-                    source_name), source_url, hash_source_name(f"{source_name}{source_url}")])
-
-            cursor.executemany('''INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?)''',
-                               storing_sources)
-
-            hash_string = ','.join(source_hashes)
-            if corrected_sources == 0:
-                continue
-
-            # Start sanity checking the data
-
-            # Tidy up alignments
-            if row['alignment'] == "any":
-                alignment = "any alignment"
-            elif row['alignment'] == "":
-                alignment = "unaligned"
-            else:
-                alignment = row['alignment'].lower()
+        store = BulkIngestStore(cursor) if bulk else CursorIngestStore(cursor)
+        sources_official = set(store.official_source_names())
 
-            # Prevent blank environments
-            if re.sub(whitespace_pattern, '', row['environment']) == "":
-                environments = "no environment specified"
-            else:
-                environments = row['environment']
+        if workers > 1:
+            normalised = normalise_in_parallel(
+                rows, sources_official, source_url, workers)
+        else:
+            normalised = (normalise_row(row, sources_official, source_url)
+                          for row in rows)
+        normalised = counted(normalised, progress)
+        if already_processed:
+            apply_sheet_diff(store, normalised, digests,
+                             sources_official, source_url, progress)
+        else:
+            for row in normalised:
+                add_normalised_row(store, row, sources_official, source_url, progress)
 
-            # Some source sheets don't have tags or sections...
-            try:
-                monster_tags = row["tags"]
-            except KeyError:
-                monster_tags = ""
+        store.flush()
+        prune_change_log(cursor)
+        return sheet_source_names(cursor, source_url)
 
-            try:
-                monster_section = row["section"]
-            except KeyError:
-                monster_section = ""
+    return submit_write(db_location, ingest, rebuild_facets=True).result()
 
-            try:
-                is_legendary = 1 if row['legendary'] == "legendary" else 0
-            except KeyError:
-                is_legendary = 0
 
-            try:
-                is_named = 1 if row['named'] == "named" else 0
-            except KeyError:
-                is_named = 0
+def rebuild_facet_tables(cursor: sqlite3.Cursor):
+    """Rebuilds the junction tables linking monsters to their environments, alignments and sources
 
-            values: List[Any] = []
-            try:
-                values = [row['fid'], monster_name, row['cr'], row['size'], row["type"], monster_tags, monster_section, alignment,
-                          environments, row['ac'], row['hp'], row['init'], row['lair'], is_legendary, is_named, ', '.join(corrected_sources), hash_string]
-            except KeyError:
-                values = [row['fid'], monster_name, row['cr'], row['size'], row["type"], monster_tags, monster_section, alignment,
-                          environments, row['ac'], row['hp'], row['init'], row['lair?'], is_legendary, is_named, ', '.join(corrected_sources), hash_string]
+    The monsters table stores these as comma separated strings, which can only be
+    searched with a full scan. The junction tables map each monster's rowid to
+    integer ids for every value, so that they can be filtered with indexed joins.
+    """
+    for table in facet_tables:
+        cursor.execute(f'''DELETE FROM {table}''')
 
-            for i in range(len(values)):
-                if type(values[i]) == str:
-                    values[i] = values[i].replace("'           '", "")
-                    values[i] = values[i].strip()
+    environment_ids: Dict[str, int] = {}
+    alignment_ids: Dict[str, int] = {}
+    source_ids: Dict[str, int] = {}
+    # Read a chunk of monsters at a time, so that the whole table is never held in memory
+    monsters = cursor.connection.execute(
+        '''SELECT rowid, environment, alignment, sourcehashes FROM monsters''')
+    for monster_list in iter(lambda: monsters.fetchmany(ingest_chunk_size), []):
+        monster_environments = set()
+        monster_alignments = set()
+        monster_sources = set()
+        for (monster_id, environment_string, alignment, source_hashes) in monster_list:
+            for environment in environment_string.split(","):
+                environment = environment.strip()
+                if environment != "":
+                    environment_id = environment_ids.setdefault(
+                        environment, len(environment_ids) + 1)
+                    monster_environments.add((environment_id, monster_id))
 
-            cursor.execute(
-                '''INSERT OR REPLACE INTO monsters VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', values)
+            alignment_id = alignment_ids.setdefault(
+                alignment, len(alignment_ids) + 1)
+            monster_alignments.add((alignment_id, monster_id))
 
-        conn.commit()
+            for source_hash in source_hashes.split(","):
+                source_id = source_ids.setdefault(
+                    source_hash, len(source_ids) + 1)
+                monster_sources.add((source_id, monster_id))
 
-        return check_if_key_processed(source_url)
+        cursor.executemany('''INSERT INTO monster_environments VALUES (?, ?)''',
+                           sorted(monster_environments))
+        cursor.executemany('''INSERT INTO monster_alignments VALUES (?, ?)''',
+                           sorted(monster_alignments))
+        cursor.executemany('''INSERT INTO monster_sources VALUES (?, ?)''',
+                           sorted(monster_sources))
+
+    cursor.executemany('''INSERT INTO environments VALUES (?, ?)''',
+                       [(i, name) for (name, i) in environment_ids.items()])
+    cursor.executemany('''INSERT INTO alignments VALUES (?, ?)''',
+                       [(i, name) for (name, i) in alignment_ids.items()])
+    cursor.executemany('''INSERT INTO source_ids VALUES (?, ?)''',
+                       [(i, source_hash) for (source_hash, i) in source_ids.items()])
 
 
 def load_csv_from_file(filename: str) -> str:
@@ -263,13 +1042,57 @@ def load_csv_from_file(filename: str) -> str:
         return csv_string
 
 
+def create_row_digests_table(cursor: sqlite3.Cursor):
+    """Creates the table of the digests of the rows added from each sheet, if the DB doesn't have it yet
+
+    Each row is tied to its sheet by the sourceurlhash of its first source, and
+    to the monster it added by its rowid.
+    """
+    cursor.execute('''CREATE TABLE IF NOT EXISTS row_digests (
+        sourceurlhash text,
+        digest text,
+        monster_id int,
+        merged int,
+        PRIMARY KEY (sourceurlhash, digest)) WITHOUT ROWID'''
+                   )
+    cursor.execute('''CREATE INDEX IF NOT EXISTS row_digests_monster_id ON row_digests (monster_id)''')
+
+
+def create_change_log(cursor: sqlite3.Cursor):
+    """Creates the log of changed monsters read by catalog.update_catalog, if the DB doesn't have it yet
+
+    Triggers log the rowid of every monster inserted or updated, however it was
+    written, so that a catalog can re-read just those. Only the last
+    max_logged_changes entries are kept, see prune_change_log.
+    """
+    cursor.execute('''CREATE TABLE IF NOT EXISTS monster_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        monster_id int)''')
+    for event in ["INSERT", "UPDATE"]:
+        cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS monsters_{event.lower()}_logged AFTER {event} ON monsters
+            BEGIN INSERT INTO monster_changes (monster_id) VALUES (NEW.rowid); END''')
+
+
+def prune_change_log(cursor: sqlite3.Cursor):
+    cursor.execute('''DELETE FROM monster_changes WHERE seq <= (SELECT MAX(seq) FROM monster_changes) - ?''',
+                   (max_logged_changes,))
+
+
 def configure_db(db_location: str):
     """Creates a DB in the specified location, overwriting existing"""
+    # The pooled connections may be to a file that has been deleted since, and
+    # their -wal file must be cleaned up before a new DB is created in its place
+    db.close_connections(db_location)
     conn = sqlite3.connect(db_location)
     cursor = conn.cursor()
 
     cursor.execute('''DROP TABLE IF EXISTS monsters''')
     cursor.execute('''DROP TABLE IF EXISTS sources''')
+    cursor.execute('''DROP TABLE IF EXISTS row_digests''')
+    cursor.execute('''DROP TABLE IF EXISTS catalog_build''')
+    cursor.execute('''DROP TABLE IF EXISTS monster_changes''')
+    for table in facet_tables:
+        cursor.execute(f'''DROP TABLE IF EXISTS {table}''')
     cursor.execute('''CREATE TABLE monsters (
                 fid text,
                 name text UNIQUE,
@@ -287,7 +1110,8 @@ def configure_db(db_location: str):
                 legendary int,
                 named int,
                 sources text,
-                sourcehashes text)'''
+                sourcehashes text,
+                crvalue real)'''
                    )
     cursor.execute('''CREATE TABLE sources (
         name text,
@@ -297,17 +1121,65 @@ def configure_db(db_location: str):
         sourceurlhash text UNIQUE)'''
                    )
 
+    # Multi-valued columns are also stored in junction tables keyed by integer ids,
+    # see rebuild_facet_tables. monsters.name is already indexed by its UNIQUE constraint.
+    cursor.execute('''CREATE TABLE environments (
+        id INTEGER PRIMARY KEY,
+        name text UNIQUE)'''
+                   )
+    cursor.execute('''CREATE TABLE monster_environments (
+        environment_id int,
+        monster_id int,
+        PRIMARY KEY (environment_id, monster_id)) WITHOUT ROWID'''
+                   )
+    cursor.execute('''CREATE TABLE alignments (
+        id INTEGER PRIMARY KEY,
+        name text UNIQUE)'''
+                   )
+    cursor.execute('''CREATE TABLE monster_alignments (
+        alignment_id int,
+        monster_id int,
+        PRIMARY KEY (alignment_id, monster_id)) WITHOUT ROWID'''
+                   )
+    cursor.execute('''CREATE TABLE source_ids (
+        id INTEGER PRIMARY KEY,
+        hash text UNIQUE)'''
+                   )
+    cursor.execute('''CREATE TABLE monster_sources (
+        source_id int,
+        monster_id int,
+        PRIMARY KEY (source_id, monster_id)) WITHOUT ROWID'''
+                   )
+    # crvalue is the numeric value of cr, so that CR ranges are a single range scan.
+    # init is stored as text, so it is indexed by its integer value instead
+    cursor.execute('''CREATE INDEX monsters_crvalue ON monsters (crvalue, cr)''')
+    cursor.execute('''CREATE INDEX monsters_hp ON monsters (hp)''')
+    cursor.execute('''CREATE INDEX monsters_ac ON monsters (ac)''')
+    cursor.execute('''CREATE INDEX monsters_init ON monsters (CAST(init AS INTEGER))''')
+    # Encounters can be looked up by fid, see main.get_monster_crs
+    cursor.execute('''CREATE INDEX monsters_fid ON monsters (fid)''')
+    cursor.execute('''CREATE INDEX sources_name ON sources (name)''')
+    cursor.execute('''CREATE INDEX sources_url ON sources (url)''')
+    create_row_digests_table(cursor)
+    cursor.execute('''CREATE TABLE catalog_build (id text)''')
+    cursor.execute('''INSERT INTO catalog_build VALUES (?)''', (uuid.uuid4().hex,))
+    create_change_log(cursor)
+
+    bump_catalog_version(cursor)
     conn.commit()
     return conn
 
 
 if __name__ == "__main__":
-    with contextlib.closing(sqlite3.connect(db_location, uri=True)) as conn:
+    # f is first each exported CSV, then a StringIO of master_sources.csv
+    f: IO[str]
+    with db.connection(db_location) as conn:
         cursor = conn.cursor()
         cursor.execute('''SELECT name FROM sqlite_master WHERE type="table"''')
         if len(cursor.fetchall()) > 0:
 
-            cursor.execute('''SELECT * FROM monsters''')
+            cursor.execute('''SELECT fid, name, cr, size, type, tags, section, alignment, environment,
+                ac, hp, init, lair, legendary, named, sources, sourcehashes FROM monsters''')
             results = cursor.fetchall()
             with open(f"{dir_path}/master.csv", 'w', newline='') as f:
                 writer = csv.writer(f)
@@ -323,9 +1195,9 @@ if __name__ == "__main__":
                     ["name", "official", "hash", "url", "sourceurlhash"])
                 writer.writerows(results)
 
-    configure_db(db_location)
+    configure_db(db_location).close()
     csv_string = load_csv_from_file("master.csv")
-    ingest_data(csv_string, db_location)
+    ingest_data(csv_string, db_location, bulk=True, workers=ingest_workers)
 
     csv_string = load_csv_from_file("master_sources.csv")
     f = StringIO(csv_string)
@@ -337,3 +1209,9 @@ if __name__ == "__main__":
 
     write_to_db(
         '''INSERT OR IGNORE INTO sources VALUES (?, ?, ?, ?, ?)''', storing_sources)
+
+    # Move everything from the -wal file into monsters.db itself, so that the .db
+    # file alone holds the whole DB when it is copied or committed
+    with db.connection(db_location) as conn:
+        conn.execute('''PRAGMA wal_checkpoint(TRUNCATE)''')
+    db.close_connections(db_location)
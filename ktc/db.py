@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""A pool of long-lived SQLite connections shared by every module
+
+Instead of opening and closing a connection for every query, code borrows one
+from the pool for the duration of a with block:
+
+    with db.connection(db_location) as conn:
+        conn.execute(...)
+
+Connections are not tied to a thread, since the threaded WSGI server starts a
+new thread for every request, but only one thread uses a connection at a time.
+Keeping them open means SQLite's page cache and each connection's cache of
+prepared statements survive from one request to the next.
+
+Every new connection runs the PRAGMAs in the pragmas dict. They can be changed
+with configure, or with the KTC_SQLITE_PRAGMAS environment variable, e.g.
+KTC_SQLITE_PRAGMAS="journal_mode=delete,synchronous=full".
+"""
+
+import contextlib
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+pragmas: Dict[str, Any] = {
+    # Readers don't block the writer (or each other) while a sheet is ingested
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 5000,
+}
+if os.environ.get("KTC_SQLITE_PRAGMAS"):
+    pragmas.update(dict(pragma.split("=", 1)
+                        for pragma in os.environ["KTC_SQLITE_PRAGMAS"].split(",")))
+
+# The size of each connection's prepared statement cache
+cached_statements = 256
+# How many unused connections are kept open per DB
+max_idle_connections = 8
+
+# (device, inode) of a DB file, so that a pooled connection to a file that has
+# since been deleted or replaced is never handed out
+FileIdentity = Optional[Tuple[int, int]]
+PooledConnection = Tuple[sqlite3.Connection, FileIdentity, int]
+# (file identity, watcher serial, data_version), see change_marker
+ChangeMarker = Tuple[FileIdentity, int, int]
+
+_idle: Dict[str, List[PooledConnection]] = {}
+_lock = threading.Lock()
+# Bumped by configure and close_connections, so that connections opened before
+# then are closed instead of being returned to the pool
+_generation = 0
+
+# A connection per DB that's only used to read its data_version, with the file
+# identity it was opened on and a serial that's different for every watcher
+_watchers: Dict[str, Tuple[sqlite3.Connection, FileIdentity, int]] = {}
+_watchers_lock = threading.Lock()
+_watcher_serial = 0
+
+
+def file_identity(path: str) -> FileIdentity:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_dev, stat.st_ino)
+
+
+def open_connection(path: str) -> sqlite3.Connection:
+    """Opens a new connection to a DB and runs the configured PRAGMAs on it"""
+    conn = sqlite3.connect(path, check_same_thread=False,
+                           cached_statements=cached_statements)
+    for (pragma, value) in pragmas.items():
+        conn.execute(f"PRAGMA {pragma} = {value}").fetchall()
+    return conn
+
+
+def configure(**new_pragmas: Any):
+    """Changes the PRAGMAs run on new connections, and retires the existing ones"""
+    pragmas.update(new_pragmas)
+    close_connections()
+
+
+def close_connections(db_location: Optional[str] = None):
+    """Closes the unused connections to a DB, or to every DB if none is given
+
+    Connections in use are closed as soon as they are given back. This should be
+    called before deleting a DB file.
+    """
+    global _generation
+    with _lock:
+        _generation += 1
+        paths = list(_idle) if db_location is None else [
+            os.path.abspath(db_location)]
+        closing = [pooled for path in paths for pooled in _idle.pop(path, [])]
+    with _watchers_lock:
+        closing += [_watchers.pop(path) for path in paths if path in _watchers]
+    for (conn, _, _) in closing:
+        conn.close()
+
+
+def change_marker(db_location: str) -> ChangeMarker:
+    """Returns a value that changes whenever anything commits to a DB, or it's replaced
+
+    It's the PRAGMA data_version of a connection kept open for the purpose, which
+    changes whenever any other connection, in this process or another, commits.
+    Reading it doesn't read the DB itself, so it's much cheaper than a query, and
+    whatever was read from the DB can be cached for as long as it stays the same.
+    """
+    global _watcher_serial
+    path = os.path.abspath(db_location)
+    identity = file_identity(path)
+    if identity is None:
+        return (None, 0, 0)
+    with _watchers_lock:
+        watcher = _watchers.get(path)
+        if watcher is not None and watcher[1] != identity:
+            watcher[0].close()
+            watcher = None
+        if watcher is None:
+            # A new watcher's data_version may repeat an old one's, but not its serial
+            _watcher_serial += 1
+            watcher = (open_connection(path), identity, _watcher_serial)
+            _watchers[path] = watcher
+        return (identity, watcher[2], watcher[0].execute('PRAGMA data_version').fetchone()[0])
+
+
+@contextlib.contextmanager
+def connection(db_location: str) -> Iterator[sqlite3.Connection]:
+    """Borrows a connection to a DB from the pool for the duration of a with block
+
+    Anything left uncommitted at the end of the block is rolled back, just as if
+    the connection had been closed.
+    """
+    path = os.path.abspath(db_location)
+    identity = file_identity(path)
+    pooled: Optional[PooledConnection] = None
+    stale: List[sqlite3.Connection] = []
+    with _lock:
+        idle = _idle.get(path, [])
+        while idle:
+            candidate = idle.pop()
+            if candidate[1] == identity and identity is not None:
+                pooled = candidate
+                break
+            stale.append(candidate[0])
+        generation = _generation
+    for conn in stale:
+        conn.close()
+
+    if pooled is None:
+        conn = open_connection(path)
+        pooled = (conn, file_identity(path), generation)
+    conn = pooled[0]
+
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        with _lock:
+            idle = _idle.setdefault(path, [])
+            keep = pooled[2] == _generation and len(idle) < max_idle_connections
+            if keep:
+                idle.append(pooled)
+        if not keep:
+            conn.close()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""Background jobs, run one at a time off the request threads
+
+A job is submitted with a function to run and an object that the function
+updates with its progress, and gets an id straight away. Its status, progress
+and result can then be looked up by that id, or waited on with wait_for_change.
+
+Jobs run on a single thread, since they are meant for writes to the DB, which
+SQLite only lets one connection make at a time anyway. At most max_queued_jobs
+jobs can be waiting or running at once, and only the last max_finished_jobs
+finished jobs are kept.
+"""
+
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+try:
+    import metrics  # type: ignore
+except ModuleNotFoundError:
+    from ktc import metrics  # type: ignore
+
+max_finished_jobs = 100
+max_queued_jobs = int(os.environ.get("KTC_MAX_QUEUED_JOBS", "16"))
+# How often wait_for_change looks at a job's progress; a change of status wakes it straight away
+progress_interval = 1.0
+
+job_metrics = metrics.Counters("jobs", "submitted", "succeeded", "failed", "rejected")
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    """Raised by submit when max_queued_jobs jobs are already waiting or running"""
+
+
+class Job:
+    """A function run in the background, and what has become of it so far"""
+
+    def __init__(self, function: Callable[[], Any], progress: Any = None):
+        self.id = uuid.uuid4().hex
+        self.function = function
+        # Anything with a to_dict method, updated by the function as it runs
+        self.progress = progress
+        self.status = "queued"
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.submitted = time.time()
+        self.finished = threading.Event()
+        # Notified whenever the status changes
+        self.changed = threading.Condition()
+
+    def set_status(self, status: str):
+        with self.changed:
+            self.status = status
+            self.changed.notify_all()
+
+    def run(self):
+        self.set_status("running")
+        try:
+            self.result = self.function()
+            self.set_status("done")
+            job_metrics.increment("succeeded")
+        except Exception as e:
+            logger.exception("Job %s failed", self.id)
+            self.error = str(e) or type(e).__name__
+            self.set_status("failed")
+            job_metrics.increment("failed")
+        finally:
+            self.finished.set()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"id": self.id, "status": self.status,
+                "progress": self.progress.to_dict() if self.progress is not None else {},
+                "result": self.result, "error": self.error}
+
+    def wait_for_change(self, last_seen: Optional[Dict[str, Any]], timeout: float) -> Dict[str, Any]:
+        """Waits until the job's dict differs from the one last seen, or the timeout passes,
+        and returns it
+
+        The waiting thread sleeps on the job's condition, and is woken as soon as
+        the status changes. Progress is only checked every progress_interval.
+        """
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while True:
+                current = self.to_dict()
+                remaining = deadline - time.monotonic()
+                if current != last_seen or remaining <= 0:
+                    return current
+                self.changed.wait(min(progress_interval, remaining))
+
+
+_jobs: "OrderedDict[str, Job]" = OrderedDict()
+_lock = threading.Lock()
+_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="ktc-job")
+
+
+def submit(function: Callable[[], Any], progress: Any = None) -> Job:
+    """Queues a function to be run in the background, returning its job
+
+    Raises:
+        JobQueueFull: if max_queued_jobs jobs are already waiting or running
+    """
+    job = Job(function, progress)
+    with _lock:
+        if sum(1 for old in _jobs.values() if not old.finished.is_set()) >= max_queued_jobs:
+            job_metrics.increment("rejected")
+            raise JobQueueFull(f"There are already {max_queued_jobs} jobs waiting to run")
+        _jobs[job.id] = job
+        finished = [job_id for (job_id, old) in _jobs.items() if old.finished.is_set()]
+        for job_id in finished[:max(0, len(finished) - max_finished_jobs)]:
+            del _jobs[job_id]
+    job_metrics.increment("submitted")
+    _executor.submit(job.run)
+    return job
+
+
+def get_job(job_id: str) -> Optional[Job]:
+    with _lock:
+        return _jobs.get(job_id)
@@ -2,10 +2,15 @@
 
 """A list of functions for performing encounter maths"""
 
-import contextlib
 import os
-import sqlite3
-from typing import List, Tuple
+from typing import Dict, List, Tuple
+
+try:
+    import cache  # type: ignore
+    import db  # type: ignore
+except ModuleNotFoundError:
+    from ktc import cache  # type: ignore
+    from ktc import db  # type: ignore
 
 xp_per_day_per_character_per_level = [
     0,
@@ -104,10 +109,17 @@ path_to_database = os.path.abspath(
 db_location = path_to_database
 
 
+# Thresholds of the parties seen so far, keyed by canonical_party
+party_thresholds_cache = cache.LRUCache("party_thresholds", 1024)
+
+
 def diff_calc(party: PartyType, enc_xp: int) -> str:
     """Calculate which threshold an encounter meets for a given party"""
-    party_thresholds = party_thresholds_calc(party)
+    return threshold_met(party_thresholds_calc(party), enc_xp)
+
 
+def threshold_met(party_thresholds: List[int], enc_xp: int) -> str:
+    """Calculate which of a party's thresholds an encounter meets"""
     if enc_xp < party_thresholds[0]:
         threshold = "trifling"
     elif enc_xp < party_thresholds[1]:
@@ -122,23 +134,45 @@ def diff_calc(party: PartyType, enc_xp: int) -> str:
     return threshold
 
 
+def canonical_party(party: PartyType) -> Tuple[Tuple[int, int], ...]:
+    """Puts a party into a hashable form that doesn't depend on how its characters are grouped
+
+    Args:
+        party (PartyType): a list of tuples [character quantity, character level]
+
+    Returns:
+        Tuple[Tuple[int, int], ...]: the number of characters at each level, ordered by level
+    """
+    characters_per_level: Dict[int, int] = {}
+    for (size, level) in party:
+        characters_per_level[int(level)] = characters_per_level.get(
+            int(level), 0) + int(size)
+    return tuple(sorted((level, size) for (level, size) in characters_per_level.items() if size != 0))
+
+
 def party_thresholds_calc(party: PartyType) -> List[int]:
     """Generates a list of XP thresholds for encounters based on the party
 
+    The thresholds of each party are only worked out once, then cached.
+
     Args:
         party (PartyType): the party to calculate the thresholds for
 
     Returns:
         List[int]: a list of xp values where each threshold is
     """
-    party_thresholds = [0, 0, 0, 0, 0]
-    for tup in party:
-        (size, level) = tup
-        for i in range(len(party_thresholds) - 1):
-            party_thresholds[i] += xp_thresholds[level][i] * size
-        party_thresholds[4] += xp_per_day_per_character_per_level[level] * size
+    key = canonical_party(party)
+    party_thresholds = party_thresholds_cache.get(key)
+    if party_thresholds is None:
+        thresholds = [0, 0, 0, 0, 0]
+        for (level, size) in key:
+            for i in range(len(thresholds) - 1):
+                thresholds[i] += xp_thresholds[level][i] * size
+            thresholds[4] += xp_per_day_per_character_per_level[level] * size
+        party_thresholds = tuple(thresholds)
+        party_thresholds_cache.put(key, party_thresholds)
 
-    return party_thresholds
+    return list(party_thresholds)
 
 
 # Pass a list of CRs and a list of quantities of monsters
@@ -157,33 +191,55 @@ def cr_calc(challenge_ratings: List[str], quantities: List[int]) -> int:
     for i, monster_cr in enumerate(challenge_ratings):
         unadj_cr_total += cr_xp_mapping[monster_cr] * quantities[i]
 
-    quantity: int = sum(quantities)
+    adj_xp_total = unadj_cr_total * encounter_multiplier(sum(quantities))
 
+    return int(adj_xp_total)
+
+
+def encounter_multiplier(quantity: int) -> float:
+    """Return the multiplier applied to the XP of an encounter with this many monsters"""
     if quantity == 1:
-        adj_xp_total = unadj_cr_total * encounter_xp_multipliers[0]
+        return encounter_xp_multipliers[0]
     elif quantity == 2:
-        adj_xp_total = unadj_cr_total * encounter_xp_multipliers[1]
+        return encounter_xp_multipliers[1]
     elif 3 <= quantity <= 6:
-        adj_xp_total = unadj_cr_total * encounter_xp_multipliers[2]
+        return encounter_xp_multipliers[2]
     elif 7 <= quantity <= 10:
-        adj_xp_total = unadj_cr_total * encounter_xp_multipliers[3]
+        return encounter_xp_multipliers[3]
     elif 11 <= quantity <= 14:
-        adj_xp_total = unadj_cr_total * encounter_xp_multipliers[4]
+        return encounter_xp_multipliers[4]
     else:
-        adj_xp_total = unadj_cr_total * encounter_xp_multipliers[5]
-
-    return int(adj_xp_total)
+        return encounter_xp_multipliers[5]
 
 
 def get_monster_cr(monster: str) -> str:
     """Return the CR of a monster given its name"""
-    with contextlib.closing(sqlite3.connect(db_location)) as conn:
+    return get_monster_crs([monster])[monster]
+
+
+def get_monster_crs(monsters: List[str], by_fid: bool = False) -> Dict[str, str]:
+    """Return the CRs of many monsters at once, with one query per 500 monsters
+
+    Args:
+        monsters (List[str]): the names of the monsters, or their fids if by_fid is set
+        by_fid (bool, optional): whether to look the monsters up by fid. Defaults to False.
+
+    Returns:
+        Dict[str, str]: the CR of every monster found, keyed by name (or fid). If several
+            monsters share a fid, the one that was stored first is used
+    """
+    column = "fid" if by_fid else "name"
+    unique_monsters = list(dict.fromkeys(monsters))
+    monster_crs: Dict[str, str] = {}
+    with db.connection(db_location) as conn:
         cursor = conn.cursor()
-        # conn.set_trace_callback(print)
-        cursor.execute(
-            """SELECT cr FROM monsters WHERE name = ?""", (monster,))
-        monster_cr = cursor.fetchone()[0]
-    return monster_cr
+        for i in range(0, len(unique_monsters), 500):
+            chunk = unique_monsters[i:i + 500]
+            cursor.execute(f"""SELECT {column}, cr FROM monsters
+                WHERE {column} IN ({', '.join(['?']*len(chunk))}) ORDER BY rowid""", chunk)
+            for (monster, monster_cr) in cursor.fetchall():
+                monster_crs.setdefault(monster, monster_cr)
+    return monster_crs
 
 
 def get_encounter_difficulty(party: PartyType, monsters: MonstersType) -> Tuple[int, str]:
@@ -196,12 +252,9 @@ def get_encounter_difficulty(party: PartyType, monsters: MonstersType) -> Tuple[
     Returns:
         Tuple[int, str]: A tuple of the XP earned in an encounter and which threshold it meets
     """
-    crs = []
-    quantities = []
-
-    for monster_set in monsters:
-        crs.append(get_monster_cr(monster_set[0]))
-        quantities.append(monster_set[1])
+    monster_crs = get_monster_crs([monster_set[0] for monster_set in monsters])
+    crs = [monster_crs[monster_set[0]] for monster_set in monsters]
+    quantities = [monster_set[1] for monster_set in monsters]
 
     encounter_exp = cr_calc(crs, quantities)
     diff_level = diff_calc(party, encounter_exp)
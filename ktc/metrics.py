@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+"""Named sets of counters, for keeping count of how often things happen
+
+Like the caches in the cache module, every set of counters registers itself in
+counters under its name, so that api.get_metrics can report them.
+"""
+
+import threading
+from typing import Dict
+
+counters: Dict[str, "Counters"] = {}
+
+
+class Counters:
+    """A thread safe set of counters, all starting at 0"""
+
+    def __init__(self, name: str, *keys: str):
+        self.name = name
+        self.counts = {key: 0 for key in keys}
+        self.lock = threading.Lock()
+        counters[name] = self
+
+    def increment(self, key: str, amount: int = 1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + amount
+
+    def stats(self) -> Dict[str, int]:
+        """Returns a copy of every count"""
+        with self.lock:
+            return dict(self.counts)
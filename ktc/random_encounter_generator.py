@@ -1,19 +1,43 @@
 # -*- coding: utf-8 -*-
+import json
+import os
 import random
+import time
+from collections import Counter
 from fractions import Fraction
-from typing import Dict, List, Tuple
+from functools import reduce
+from math import gcd
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
 
 try:
     import api  # type: ignore
+    import cache  # type: ignore
+    import converter  # type: ignore
     import main  # type: ignore
+    import metrics  # type: ignore
 except ModuleNotFoundError:
     from ktc import api  # type: ignore
+    from ktc import cache  # type: ignore
+    from ktc import converter  # type: ignore
     from ktc import main  # type: ignore
+    from ktc import metrics  # type: ignore
+
+
+class EncounterGenerationError(ValueError):
+    """Raised when no encounter can be generated, with how many attempts were made"""
+
+    def __init__(self, message: str, attempts: int = 0):
+        super().__init__(message)
+        self.attempts = attempts
 
 
 class Monster:
     """Just a simple monster object. Attributes & nothing else
     """
+    __slots__ = ["name", "cr", "size", "type",
+                 "tags", "section", "alignment", "sources"]
 
     def __init__(self, monster_as_list: List[str]):
         self.name = monster_as_list[0]
@@ -26,60 +50,393 @@ class Monster:
         self.sources = monster_as_list[7]
 
 
-def fits_rarity(monster, encounter_rarity):
-    monster_cr = float(Fraction(monster[1]))
-    if monster_cr < rarity_thresholds[0]:
-        monster_rarity = 0
-    elif monster_cr < rarity_thresholds[1]:
-        monster_rarity = 1
-    elif monster_cr < rarity_thresholds[2]:
-        monster_rarity = 2
-    else:
-        monster_rarity = 3
+class RarityProfile:
+    """How rare monsters are in a campaign setting, from their CR and type
+
+    A monster is common below the first CR threshold, uncommon below the second,
+    rare below the third and very rare otherwise. Its type's modifier then makes
+    it that many steps rarer; types without a modifier are always very rare.
+    The rarity of every CR and type with a modifier is worked out up front, so
+    looking one up is a dict lookup.
+    """
 
+    def __init__(self, name: str, thresholds: Sequence[float], type_modifiers: Dict[str, int]):
+        if len(thresholds) != len(rarities) - 1:
+            raise EncounterGenerationError(
+                f"A rarity profile needs {len(rarities) - 1} CR thresholds, not {len(thresholds)}")
+        try:
+            self.thresholds = [float(threshold) for threshold in thresholds]
+            self.type_modifiers = {monster_type.lower(): int(modifier)
+                                   for (monster_type, modifier) in type_modifiers.items()}
+        except (AttributeError, TypeError, ValueError) as error:
+            raise EncounterGenerationError(
+                f"Invalid rarity profile {name}: {error}")
+        self.name = name
+        # Identifies the profile's tables, whatever it is called
+        self.key = (tuple(self.thresholds), tuple(
+            sorted(self.type_modifiers.items())))
+        self.rarities = {(cr, monster_type): self.calculate_rarity(cr, monster_type)
+                         for cr in main.cr_xp_mapping for monster_type in self.type_modifiers}
+
+    def calculate_rarity(self, cr: str, monster_type: str) -> str:
+        monster_cr = float(Fraction(cr))
+        if monster_cr < self.thresholds[0]:
+            monster_rarity = 0
+        elif monster_cr < self.thresholds[1]:
+            monster_rarity = 1
+        elif monster_cr < self.thresholds[2]:
+            monster_rarity = 2
+        else:
+            monster_rarity = 3
+
+        try:
+            monster_rarity += self.type_modifiers[monster_type.lower()]
+        except KeyError:
+            monster_rarity = 3
+        if monster_rarity > 3:
+            monster_rarity = 3
+
+        return rarities[monster_rarity]
+
+    def rarity(self, cr: str, monster_type: str) -> str:
+        """Looks up how rare a monster of a CR and type is"""
+        monster_type = monster_type.lower()
+        if monster_type not in self.type_modifiers:
+            return rarities[-1]
+        try:
+            return self.rarities[(cr, monster_type)]
+        except KeyError:
+            return self.calculate_rarity(cr, monster_type)
+
+    def to_dict(self) -> Dict:
+        return {"thresholds": self.thresholds, "modifiers": self.type_modifiers}
+
+
+def define_rarity_profile(name: str, thresholds: Sequence[float], type_modifiers: Dict[str, int]) -> RarityProfile:
+    """Adds a named rarity profile that generate can be asked to use, replacing any of the same name"""
+    profile = RarityProfile(name, thresholds, type_modifiers)
+    rarity_profiles[name] = profile
+    return profile
+
+
+def get_rarity_profile(profile) -> RarityProfile:
+    """Finds the rarity profile generate was asked for
+
+    Args:
+        profile: the name of a profile in rarity_profiles, a dict defining one
+            with "thresholds" and "modifiers", or None for the default profile
+
+    Raises:
+        EncounterGenerationError: if there's no profile of that name, or the definition is invalid
+    """
+    if profile is None:
+        return rarity_profiles[default_rarity_profile]
+    if isinstance(profile, dict):
+        if not isinstance(profile.get("thresholds"), list) or not isinstance(profile.get("modifiers"), dict):
+            raise EncounterGenerationError(
+                "A rarity profile needs a list of \"thresholds\" and a dict of \"modifiers\"")
+        return custom_rarity_profile_cache.get_or_compute(
+            json.dumps(profile, sort_keys=True),
+            lambda: RarityProfile("custom", profile["thresholds"], profile["modifiers"]))
     try:
-        # TODO allow user to define rarity modifiers
-        monster_rarity += taldorei_type_rarity_modifiers[monster[3].lower()]
-    except KeyError:
-        monster_rarity = 3
-    if monster_rarity > 3:
-        monster_rarity = 3
-
-    if rarities[monster_rarity] in encounter_rarity:
+        return rarity_profiles[profile]
+    except (KeyError, TypeError):
+        raise EncounterGenerationError(f"There is no rarity profile {profile}")
+
+
+def get_monster_rarity(monster, profile: Optional[RarityProfile] = None) -> str:
+    """Works out how rare a monster is from its CR and type, by default with the Tal'Dorei profile"""
+    if profile is None:
+        profile = rarity_profiles[default_rarity_profile]
+    return profile.rarity(monster[1], monster[3])
+
+
+def fits_rarity(monster, encounter_rarity, profile: Optional[RarityProfile] = None):
+    if get_monster_rarity(monster, profile) in encounter_rarity:
         return True
     return False
 
 
-def randomise_within_cr(monsters: List[Monster]) -> List[List[Monster]]:
-    monsters_by_cr = []
-    crs = [monster.cr for monster in monsters]
-    crs = list(set(crs))
-    crs.sort(key=lambda x: float(Fraction(x)))
-    for cr in crs[::-1]:
-        cr_monsters = [monster for monster in monsters if monster.cr == cr]
-        random.shuffle(cr_monsters)
-        monsters_by_cr.append(cr_monsters)
+class CrBucket(NamedTuple):
+    """The monsters of one CR, and the XP each is worth"""
+    cr: str
+    xp: int
+    monsters: List[Monster]
+
+
+class CandidatePool(NamedTuple):
+    """The monsters an encounter of one rarity can be made of, and the same monsters grouped by type
+
+    buckets_by_type splits each type's monsters by CR, from highest to lowest.
+    min_xp and max_xp bound the adjusted XP of any encounter either solver can
+    make from them, and are 0 if there are no monsters.
+    """
+    monsters: List[Monster]
+    by_type: Dict[str, List[Monster]]
+    buckets_by_type: Dict[str, List[CrBucket]]
+    min_xp: int
+    max_xp: int
+
+    def can_reach(self, lower_xp: float, upper_xp: float) -> bool:
+        """Whether an encounter worth between lower_xp and upper_xp might be made from these monsters"""
+        return bool(self.monsters) and self.min_xp < upper_xp and self.max_xp > lower_xp
+
+
+def cr_buckets(monsters: List[Monster]) -> List[CrBucket]:
+    """Groups monsters by CR, from highest to lowest"""
+    monsters_by_cr: Dict[str, List[Monster]] = {}
+    for monster in monsters:
+        monsters_by_cr.setdefault(monster.cr, []).append(monster)
+    crs = sorted(monsters_by_cr, key=lambda x: float(Fraction(x)), reverse=True)
+    return [CrBucket(cr, main.cr_xp_mapping[cr], monsters_by_cr[cr]) for cr in crs]
+
+
+def candidate_pool(monsters: List[Monster]) -> CandidatePool:
+    """Groups the monsters of a candidate pool by type and CR"""
+    by_type: Dict[str, List[Monster]] = {}
+    for monster in monsters:
+        by_type.setdefault(monster.type, []).append(monster)
+    buckets_by_type = {monster_type: cr_buckets(type_monsters)
+                       for (monster_type, type_monsters) in by_type.items()}
+    return CandidatePool(monsters, by_type, buckets_by_type, *achievable_xp(buckets_by_type))
+
+
+def achievable_xp(buckets_by_type: Dict[str, List[CrBucket]]) -> Tuple[int, int]:
+    """Bounds the adjusted XP of the encounters that can be made from some monsters
+
+    The least is a single one of the weakest monster. The most is, for the type
+    allowing it, 3 of its strongest monster as the random solver's starter and 3
+    of every CR, at the multiplier for that many monsters. This is more than the
+    exact solver can reach too, so it is never too strict.
+    """
+    min_xp = 0
+    max_xp = 0
+    for buckets in buckets_by_type.values():
+        xps = [bucket.xp for bucket in buckets]
+        quantity = 3 + 3 * len(xps)
+        max_xp = max(max_xp, int((3 * xps[0] + 3 * sum(xps))
+                                 * main.encounter_multiplier(quantity)))
+        min_xp = min(min_xp, xps[-1]) if min_xp else xps[-1]
+    return (min_xp, max_xp)
+
+
+def build_candidate_pools(environments: Sequence[str], sources: Sequence[str],
+                          profile: RarityProfile) -> Dict[Tuple[str, ...], CandidatePool]:
+    """Builds the candidate pool of every encounter rarity for an environment and source selection"""
+    possible_monsters = api.get_list_of_monsters(
+        {"environments": list(environments),
+         "sources": list(sources),
+         "allowLegendary": False,
+         "allowNamed": False, })["data"]
+
+    rated_monsters = [(profile.rarity(monster[1], monster[3]), Monster(monster))
+                      for monster in possible_monsters]
+
+    pools = {}
+    for encounter_rarity in encounter_rarities:
+        pools[encounter_rarity] = candidate_pool([monster for (rarity, monster) in rated_monsters
+                                                  if rarity in encounter_rarity])
+    return pools
+
+
+def get_candidate_pools(environments: Sequence[str], sources: Sequence[str],
+                        profile: Optional[RarityProfile] = None) -> Dict[Tuple[str, ...], CandidatePool]:
+    """Returns the candidate pool of every encounter rarity, building them only once per catalog version
+
+    The pools are shared between calls, so they must not be modified.
+
+    Args:
+        environments (Sequence[str]): the environments the monsters can be from, as given to generate
+        sources (Sequence[str]): the sources the monsters can be from, as given to generate
+        profile (Optional[RarityProfile]): how rare each monster is, by default the Tal'Dorei profile
+
+    Returns:
+        Dict[Tuple[str, ...], CandidatePool]: the monsters matching every constraint, by encounter rarity
+    """
+    if profile is None:
+        profile = rarity_profiles[default_rarity_profile]
+    key = (os.path.abspath(api.db_location), *converter.get_catalog_state(api.db_location),
+           tuple(sorted(set(environments))), tuple(sorted(set(sources))), profile.key)
+    return candidate_pool_cache.get_or_compute(
+        key, lambda: build_candidate_pools(environments, sources, profile))
+
+
+def get_candidate_pool(environments: Sequence[str], sources: Sequence[str],
+                       encounter_rarity: Tuple[str, ...], profile: Optional[RarityProfile] = None) -> CandidatePool:
+    """Returns the monsters an encounter of one of encounter_rarities can be made of"""
+    return get_candidate_pools(environments, sources, profile)[encounter_rarity]
+
+
+def roll_encounter_rarity(rng: random.Random) -> Tuple[str, ...]:
+    """Rolls d8 + d12 to determine creature rarities"""
+    return rarity_of_roll(rng.randint(1, 9) + rng.randint(1, 13))
+
+
+def rarity_of_roll(rarity_roll: int) -> Tuple[str, ...]:
+    if rarity_roll < 4 or rarity_roll > 18:
+        return encounter_rarities[0]
+    elif rarity_roll == 4 or rarity_roll == 18:
+        return encounter_rarities[1]
+    elif rarity_roll < 7 or rarity_roll > 15:
+        return encounter_rarities[2]
+    elif rarity_roll < 9 or rarity_roll > 13:
+        return encounter_rarities[3]
+    else:
+        return encounter_rarities[4]
+
+
+def solve_encounter(buckets: List[CrBucket], lower_xp: float, upper_xp: float,
+                    rng: random.Random) -> Optional[List[Tuple[int, str]]]:
+    """Picks an encounter worth between lower_xp and upper_xp uniformly from every one that is
+
+    This is a bounded knapsack over the monsters' CRs: an encounter is a number of
+    monsters, from 0 to max_quantity_per_cr, of each CR. Since the XP multiplier
+    depends on how many monsters there are, the number of encounters reaching
+    each (monster count, unadjusted XP) pair is counted one CR at a time. An
+    encounter is then drawn by walking those counts backwards from a random pair
+    whose adjusted XP fits, so the time taken doesn't depend on luck.
+
+    Args:
+        buckets (List[CrBucket]): the monsters the encounter can be made of, as returned by cr_buckets
+        lower_xp (float): the adjusted XP the encounter must be worth more than
+        upper_xp (float): the adjusted XP the encounter must be worth less than
+        rng (random.Random): the random number generator to draw the encounter with
+
+    Returns:
+        Optional[List[Tuple[int, str]]]: a list of (quantity, monster name), with one
+            monster per CR from highest to lowest, or None if no encounter fits
+    """
+    # Lowest CR first, so that walking back gives the highest CR first
+    buckets = [bucket for bucket in reversed(buckets) if bucket.xp < upper_xp]
+    if not buckets:
+        return None
+
+    # XP sums are counted in steps of the largest amount that divides every CR's XP
+    step = reduce(gcd, [bucket.xp for bucket in buckets])
+    # Every multiplier is at least 1, so no unadjusted sum of upper_xp or more can fit,
+    # and no encounter is worth more than max_encounter_size of the highest CR
+    max_sum = min(int(-(-upper_xp // step)) - 1,
+                  max_encounter_size * max(bucket.xp for bucket in buckets) // step)
+    max_quantity = max_encounter_size
+
+    # ways[i][n, s] is how many encounters of n monsters worth s steps of XP the first i CRs make
+    ways = [np.zeros((max_quantity + 1, max_sum + 1))]
+    ways[0][0, 0] = 1
+    for bucket in buckets:
+        units = bucket.xp // step
+        previous = ways[-1]
+        current = previous.copy()
+        for quantity in range(1, max_quantity_per_cr + 1):
+            if quantity * units > max_sum:
+                break
+            current[quantity:, quantity * units:] += previous[:max_quantity +
+                                                              1 - quantity, :max_sum + 1 - quantity * units]
+        ways.append(current)
+
+    # Weight every (monster count, XP) pair by how many encounters reach it, if it fits
+    sums = np.arange(max_sum + 1) * step
+    weights = ways[-1].copy()
+    weights[0] = 0
+    for quantity in range(1, max_quantity + 1):
+        adjusted = np.floor(sums * main.encounter_multiplier(quantity))
+        weights[quantity, (adjusted <= lower_xp) | (adjusted >= upper_xp)] = 0
+    flat_weights = weights.ravel()
+    candidates = np.flatnonzero(flat_weights)
+    if not len(candidates):
+        return None
+    (quantity, xp_sum) = divmod(int(rng.choices(
+        candidates, weights=flat_weights[candidates].tolist())[0]), max_sum + 1)
+
+    # Walk back through the CRs, choosing how many of each proportionally to the encounters left
+    encounter = []
+    for (i, bucket) in reversed(list(enumerate(buckets))):
+        units = bucket.xp // step
+        options = [cr_quantity for cr_quantity in range(min(max_quantity_per_cr, quantity) + 1)
+                   if cr_quantity * units <= xp_sum]
+        cr_quantity = rng.choices(options, weights=[
+            ways[i][quantity - option, xp_sum - option * units] for option in options])[0]
+        if cr_quantity:
+            encounter.append(
+                (cr_quantity, rng.choice(bucket.monsters).name))
+            quantity -= cr_quantity
+            xp_sum -= cr_quantity * units
+
+    return encounter
+
+
+def exact_encounter(candidates: CandidatePool, lower_xp: float, upper_xp: float,
+                    rng: random.Random) -> List[Tuple[int, str]]:
+    """Solves for an encounter of a single creature type, trying types in a random order
 
-    return monsters_by_cr
+    Like the random starter monster of the default solver, a type is more likely
+    to be tried first the more monsters there are of it.
+    """
+    types = list(candidates.by_type)
+    attempts = 0
+    while types:
+        monster_type = rng.choices(
+            types, weights=[len(candidates.by_type[t]) for t in types])[0]
+        types.remove(monster_type)
+        attempts += 1
+        encounter = solve_encounter(
+            candidates.buckets_by_type[monster_type], lower_xp, upper_xp, rng)
+        if encounter is not None:
+            return encounter
+    raise EncounterGenerationError(
+        f"No encounter of these monsters is worth between {lower_xp} and {upper_xp} XP", attempts)
 
 
 rarities = ["common", "uncommon", "rare", "very rare"]
+# Every combination of rarities an encounter can roll
+encounter_rarities = [("very rare",), ("very rare", "rare"),
+                      ("rare",), ("uncommon",), ("common",)]
+# How many of the rolls made by roll_encounter_rarity give each encounter rarity
+encounter_rarity_weights = Counter(rarity_of_roll(first + second)
+                                   for first in range(1, 10) for second in range(1, 14))
 rarity_thresholds = [7, 15, 22]
 
 taldorei_type_rarity_modifiers = {"aberration": 1, "beast": 0, "celestial": 2, "construct": 1, "dragon": 1, "elemental": 1,
                                   "fey": 1, "fiend": 2, "giant": +1, "humanoid": 0, "monstrosity": 1, "ooze": 1, "plant": 1, "undead": 0}
 
-
-def generate(params: Dict) -> List[Tuple[int, str]]:
-    if "environments" in params:
-        environments = params["environments"]
-    else:
-        environments = []
-
-    if "sources" in params:
-        sources = params["sources"]
-    else:
-        sources = ['_Basic Rules v1',
+# The rarity profiles generate's "rarityProfile" parameter can name. More can be
+# added with define_rarity_profile, or from a JSON file named by the
+# KTC_RARITY_PROFILES environment variable, of the form
+# {"name": {"thresholds": [7, 15, 22], "modifiers": {"beast": 0, ...}}, ...}
+default_rarity_profile = "taldorei"
+rarity_profiles: Dict[str, RarityProfile] = {}
+define_rarity_profile(default_rarity_profile, rarity_thresholds,
+                      taldorei_type_rarity_modifiers)
+if os.environ.get("KTC_RARITY_PROFILES"):
+    with open(os.environ["KTC_RARITY_PROFILES"]) as profiles_file:
+        for (profile_name, definition) in json.load(profiles_file).items():
+            define_rarity_profile(
+                profile_name, definition["thresholds"], definition["modifiers"])
+
+# Rarity profiles defined by a generate call instead of by name, keyed by their definition
+custom_rarity_profile_cache = cache.LRUCache("custom_rarity_profiles", 32)
+
+# The exact solver's limits on how many monsters of one CR, and in all, an encounter has
+max_quantity_per_cr = 3
+max_encounter_size = 15
+
+solvers = ["random", "exact"]
+
+# The candidate pools of every encounter rarity, keyed by DB, build id, catalog version, environments, sources and rarity profile
+candidate_pool_cache = cache.LRUCache(
+    "candidate_pools", int(os.environ.get("KTC_CANDIDATE_POOL_CACHE_SIZE", "64")))
+
+# How many encounters the random solver may try, and for how many seconds, before giving up
+max_attempts = int(os.environ.get("KTC_GENERATOR_MAX_ATTEMPTS", "5000"))
+time_budget = float(os.environ.get("KTC_GENERATOR_TIME_BUDGET", "0.5"))
+
+generator_metrics = metrics.Counters(
+    "encounter_generator", "encounters", "attempts", "failed_attempts", "infeasible", "out_of_budget")
+
+# Encounters generated from a seed, keyed by DB, build id, catalog version, parameters and seed
+encounter_cache = cache.LRUCache(
+    "encounters", int(os.environ.get("KTC_ENCOUNTER_CACHE_SIZE", "256")))
+
+default_sources = ['_Basic Rules v1',
                    '_Curse of Strahd',
                    '_Explorer\'s Guide to Wildemount',
                    '_Ghosts of Saltmarsh',
@@ -100,6 +457,55 @@ def generate(params: Dict) -> List[Tuple[int, str]]:
                    '_Waterdeep: Dragon Heist',
                    '_Waterdeep: Dungeon of the Mad Mage']
 
+
+def generate(params: Dict, cache_seeded: bool = True) -> List[Tuple[int, str]]:
+    """Generates a random encounter
+
+    The "solver" parameter chooses how: "random" (the default) builds encounters
+    from a random starter monster until one lands in the difficulty's XP range,
+    while "exact" uses solve_encounter to pick one from every encounter that does.
+
+    If there is a "seed" parameter, the encounter is drawn with a random number
+    generator seeded with it, so the same parameters and seed give the same
+    encounter until the catalog changes. Those encounters are cached in
+    encounter_cache, so repeating a seeded roll doesn't search again, unless
+    cache_seeded is False, as it is for seeds that were made up for the request
+    rather than chosen by the client.
+
+    The "rarityProfile" parameter decides how rare each monster is: it is either
+    the name of one of rarity_profiles, or a definition of a profile of its own.
+
+    Raises:
+        EncounterGenerationError: if the monsters can't make an encounter of the
+            difficulty, or none was found within max_attempts and time_budget
+    """
+    if params.get("seed") is None:
+        return build_encounter(params, random.Random())
+
+    seed = str(params["seed"])
+    other_params = {key: value for (key, value)
+                    in params.items() if key != "seed"}
+    if not cache_seeded:
+        return build_encounter(other_params, random.Random(seed))
+    key = (os.path.abspath(api.db_location), *converter.get_catalog_state(api.db_location),
+           json.dumps(other_params, sort_keys=True), seed)
+    encounter = encounter_cache.get_or_compute(
+        key, lambda: build_encounter(other_params, random.Random(seed)))
+    return list(encounter)
+
+
+def build_encounter(params: Dict, rng: random.Random) -> List[Tuple[int, str]]:
+    """Generates an encounter for generate, drawing every random choice from rng"""
+    if "environments" in params:
+        environments = params["environments"]
+    else:
+        environments = []
+
+    if "sources" in params:
+        sources = params["sources"]
+    else:
+        sources = default_sources
+
     if "difficulty" in params and params["difficulty"] in ["easy", "medium", "hard", "deadly"]:
         difficulty = params["difficulty"]
     else:
@@ -110,30 +516,15 @@ def generate(params: Dict) -> List[Tuple[int, str]]:
     else:
         party = [(4, 1)]
 
-    # roll d8 + d12 to determine creature rarities
-    rarity_roll = random.randint(1, 9) + random.randint(1, 13)
-
-    if rarity_roll < 4 or rarity_roll > 18:
-        encounter_rarity = ["very rare"]
-    elif rarity_roll == 4 or rarity_roll == 18:
-        encounter_rarity = ["very rare", "rare"]
-    elif rarity_roll < 7 or rarity_roll > 15:
-        encounter_rarity = ["rare"]
-    elif rarity_roll < 9 or rarity_roll > 13:
-        encounter_rarity = ["uncommon"]
+    if "solver" in params and params["solver"] in solvers:
+        solver = params["solver"]
     else:
-        encounter_rarity = ["common"]
+        solver = "random"
 
-    # Select all monsters matching environment and source constraints
-    possible_monsters = api.get_list_of_monsters(
-        {"environments": environments,
-         "sources": sources,
-         "allowLegendary": False,
-         "allowNamed": False, })["data"]
+    profile = get_rarity_profile(params.get("rarityProfile"))
 
-    # Filter those monsters to match the required rarity
-    ordered_monsters = [Monster(monster) for monster in possible_monsters if fits_rarity(
-        monster, encounter_rarity)]
+    encounter_rarity = roll_encounter_rarity(rng)
+    pools = get_candidate_pools(environments, sources, profile)
 
     # Calculate the CR range for the encounter
     thresholds = main.party_thresholds_calc(party)
@@ -153,54 +544,85 @@ def generate(params: Dict) -> List[Tuple[int, str]]:
         upper_xp = thresholds[4]/2
         lower_xp = thresholds[3]
 
+    # Reject impossible requests before trying to solve them, and reroll
+    # rarities that can't make an encounter of the difficulty
+    feasible_rarities = [rarity for rarity in encounter_rarities
+                         if pools[rarity].can_reach(lower_xp, upper_xp)]
+    if not feasible_rarities:
+        generator_metrics.increment("infeasible")
+        raise EncounterGenerationError(
+            f"No encounter of the candidate monsters can be worth between {lower_xp} and {upper_xp} XP")
+    if encounter_rarity not in feasible_rarities:
+        encounter_rarity = rng.choices(feasible_rarities, weights=[
+            encounter_rarity_weights[rarity] for rarity in feasible_rarities])[0]
+
+    # All monsters matching environment, source and rarity constraints
+    candidates = pools[encounter_rarity]
+    ordered_monsters = candidates.monsters
+
+    if solver == "exact":
+        try:
+            encounter = exact_encounter(
+                candidates, lower_xp, upper_xp, rng)
+        except EncounterGenerationError:
+            generator_metrics.increment("infeasible")
+            raise
+        generator_metrics.increment("encounters")
+        return encounter
+
+    deadline = time.monotonic() + time_budget
+    attempts = 0
     while True:
+        if attempts >= max_attempts or time.monotonic() > deadline:
+            generator_metrics.increment("attempts", attempts)
+            generator_metrics.increment("failed_attempts", attempts)
+            generator_metrics.increment("out_of_budget")
+            raise EncounterGenerationError(
+                f"No encounter worth between {lower_xp} and {upper_xp} XP was found in {attempts} attempts", attempts)
+        attempts += 1
+
         # Add a beginning monster
         # Specifically, this will be 1-3 monsters randomly selected
         # and the only check made here is that that selection doesn't
         # violate the encounter's upper difficulty constraint.
         # TODO: Fix this bloody encounter DS, for the love of god. Use a List[Tuple[str, int]]
-        while True:
-            monster = random.choice(ordered_monsters)
-            quantity = random.randint(1, 3)
-            if main.cr_calc([monster.cr], [quantity]) < upper_xp:
-                encounter_monsters = [monster.name]
-                encounter_quantities = [quantity]
-                encounter_monster_crs = [monster.cr]
-                break
-
-        coherent_monsters = [
-            mon for mon in ordered_monsters if mon.type == monster.type]
-
-        # Sort monsters by CR ascending
-        monsters_by_cr = randomise_within_cr(coherent_monsters)
-
-        monsters_by_cr = randomise_within_cr(coherent_monsters)
-        for challenge_rating in monsters_by_cr:
-            # breakpoint()
+        monster = rng.choice(ordered_monsters)
+        quantity = rng.randint(1, 3)
+        if main.cr_calc([monster.cr], [quantity]) >= upper_xp:
+            continue
+        encounter_monsters = [monster.name]
+        encounter_quantities = [quantity]
+        # The encounter's XP and size so far, so that adding monsters doesn't mean recalculating it
+        unadjusted_xp = main.cr_xp_mapping[monster.cr] * quantity
+        encounter_size = quantity
+
+        # Go through the starter's type from the highest CR to the lowest
+        for bucket in candidates.buckets_by_type[monster.type]:
             # We know the CR of all these monsters is the same, so all we need to do
             # is figure out how many of these CRs makes an encounter of the right difficulty
-            proposed_crs = encounter_monster_crs + [challenge_rating[0].cr]
-            proposed_quantities = encounter_quantities + [0]
-            while upper_xp > main.cr_calc(proposed_crs, proposed_quantities) and proposed_quantities[-1] < 4:
-                # Find the max number of this CR of monster we can add.
-                # breakpoint
-                proposed_quantities[-1] += 1
-            # Loop breaks when we have one monster too many, so subtract one
-            proposed_quantities[-1] -= 1
+            added = 0
+            while added < 3 and upper_xp > int((unadjusted_xp + bucket.xp * (added + 1))
+                                                * main.encounter_multiplier(encounter_size + added + 1)):
+                added += 1
 
             # Append the new monsters to the encounter
-            if proposed_quantities[-1] > 0:
-                encounter_monster_crs = proposed_crs
-                encounter_quantities = proposed_quantities
+            if added > 0:
+                unadjusted_xp += bucket.xp * added
+                encounter_size += added
+                encounter_quantities.append(added)
                 # We want to avoid duplicating the random starter monster
-                monster_index = 0
-                while monster_index < len(challenge_rating)-1 and challenge_rating[monster_index].name in encounter_monsters:
-                    monster_index += 1
-                encounter_monsters.append(challenge_rating[monster_index].name)
+                fresh_monsters = [bucket_monster for bucket_monster in bucket.monsters
+                                  if bucket_monster.name not in encounter_monsters]
+                encounter_monsters.append(
+                    rng.choice(fresh_monsters or bucket.monsters).name)
 
-        if lower_xp < main.cr_calc(encounter_monster_crs, encounter_quantities) < upper_xp:
+        if lower_xp < int(unadjusted_xp * main.encounter_multiplier(encounter_size)) < upper_xp:
             break
 
+    generator_metrics.increment("attempts", attempts)
+    generator_metrics.increment("failed_attempts", attempts - 1)
+    generator_metrics.increment("encounters")
+
     # for i in range(len(encounter_quantities)):
     #    print(f"{encounter_quantities[i]}x {encounter_monsters[i]}")
     # print()
@@ -155,20 +155,30 @@ var highlightEncounterDifficulty = function () {
     $(".exp-list.hard").css("background-color", highlight_colours[2])
     $(".exp-list.deadly").css("background-color", highlight_colours[3])
     $(".exp-list.daily").css("background-color", highlight_colours[4])
-    for (var i = 0; i < window.partyThresholds.length; i++) {
-        if (window.encounterDifficulty < window.partyThresholds[0]) {
-            $(".exp-list").css("opacity", "0.7");
-            $(".exp-list").css("font-weight", "normal");
-        } else if (window.encounterDifficulty > window.partyThresholds[i]) {
-            $(".exp-list").css("opacity", "0.7");
-            $(".exp-list").css("font-weight", "normal");
-            $(".exp-list." + difficulties[i]).css("opacity", "1")
-            $(".exp-list." + difficulties[i]).css("font-weight", "bold")
-        }
+    $(".exp-list").css("opacity", "0.7");
+    $(".exp-list").css("font-weight", "normal");
+    // The server works out which threshold the encounter meets, apart from the daily budget
+    var band = window.encounterBand;
+    if (window.encounterDifficulty > window.partyThresholds[4]) {
+        band = "daily";
+    }
+    if (band != undefined && band != "trifling") {
+        $(".exp-list." + band).css("opacity", "1")
+        $(".exp-list." + band).css("font-weight", "bold")
     }
 }
 
-var updateEncounterDifficulty = function () {
+var showThresholds = function (thresholds) {
+    var displayDiv = $("div #encounterThresholds");
+    displayDiv.empty();
+    displayDiv.append('<div class="row float-end"><div class="col exp-list easy">Easy: ' + thresholds[0].toLocaleString("en-GB") + 'exp</div></div>');
+    displayDiv.append('<div class="row float-end"><div class="col exp-list medium">Medium: ' + thresholds[1].toLocaleString("en-GB") + 'exp</div></div>');
+    displayDiv.append('<div class="row float-end"><div class="col exp-list hard">Hard: ' + thresholds[2].toLocaleString("en-GB") + 'exp</div></div>');
+    displayDiv.append('<div class="row float-end"><div class="col exp-list deadly">Deadly: ' + thresholds[3].toLocaleString("en-GB") + 'exp</div></div>');
+    displayDiv.append('<div class="row float-end"><div class="col exp-list daily">Daily: ' + thresholds[4].toLocaleString("en-GB") + 'exp</div></div>');
+}
+
+var getEncounterMonsters = function () {
     var monsterListDiv = $('#monsterList');
     var monstersInEncounter = new Array()
     for (var i = 0; i < $(monsterListDiv).children('div').length; i++) {
@@ -178,21 +188,37 @@ var updateEncounterDifficulty = function () {
         let noOfMonsters = parseInt($(thisSpan).text())
         monstersInEncounter[monstersInEncounter.length] = new Array(monsterName, noOfMonsters)
     }
+    return monstersInEncounter
+}
 
-    window.localStorage.setItem("monsters", JSON.stringify(monstersInEncounter));
+// Gets the party's thresholds, the encounter's XP and its difficulty in one request
+var evaluateEncounter = function () {
+    let party = JSON.parse(window.localStorage.getItem("party"));
+    if (party == null) {
+        return
+    }
 
     $.ajax({
         type: "POST",
-        url: "api/encounterxp",
-        data: { monsters: JSON.stringify(monstersInEncounter) },
+        url: "/api/evaluate",
+        data: { party: JSON.stringify(party), monsters: JSON.stringify(getEncounterMonsters()) },
         success: function (results) {
+            showThresholds(results["thresholds"]);
+            window.partyThresholds = results["thresholds"];
             $('#encounterDifficulty').empty();
-            $('#encounterDifficulty').text('(' + results + 'XP)')
-            window.encounterDifficulty = results;
+            $('#encounterDifficulty').text('(' + results["xp"] + 'XP)')
+            window.encounterDifficulty = results["xp"];
+            window.encounterBand = results["difficulty"];
             highlightEncounterDifficulty()
+            colourAllCells();
         }
     })
+}
+
+var updateEncounterDifficulty = function () {
+    window.localStorage.setItem("monsters", JSON.stringify(getEncounterMonsters()));
 
+    evaluateEncounter();
 }
 
 const clearEncounter = function() {
@@ -215,8 +241,10 @@ const generateEncounter = function(data) {
         })
     })
 
-    encounterRequest.fail(function () {
-        $('.encounter-col').prepend('<div class="alert alert-danger" id="encounter-generation-alert" role="alert">Encounter generation failed. Please try again with different parameters.</div >')
+    encounterRequest.fail(function (jqXHR) {
+        clearEncounter();
+        let reason = (jqXHR.responseJSON && jqXHR.responseJSON.error) ? ' (' + $('<div>').text(jqXHR.responseJSON.error).html() + ')' : '';
+        $('.encounter-col').prepend('<div class="alert alert-danger" id="encounter-generation-alert" role="alert">Encounter generation failed' + reason + '. Please try again with different parameters.</div >')
     })
 }
 
@@ -242,7 +270,7 @@ var colourAllCells = function () {
     }
 }
 
-module.exports = { addMonster: addMonster, updateMonsterCount: updateMonsterCount, highlightEncounterDifficulty: highlightEncounterDifficulty, importEncounter: importEncounter, colourCell: colourCell, colourAllCells: colourAllCells, generateEncounter: generateEncounter }
+module.exports = { addMonster: addMonster, updateMonsterCount: updateMonsterCount, highlightEncounterDifficulty: highlightEncounterDifficulty, importEncounter: importEncounter, colourCell: colourCell, colourAllCells: colourAllCells, generateEncounter: generateEncounter, evaluateEncounter: evaluateEncounter }
 },{}],3:[function(require,module,exports){
 // https://github.com/Asmor/5e-monsters/blob/master/app/services/integration.service.js
 
@@ -350,24 +378,59 @@ var getMonsterParameters = function () {
         params: JSON.stringify(window.monsterParameters)
     };
 }
+// Show how many monsters each checkbox would give next to its label
+var showFacetCounts = function (facetCounts) {
+    let containers = {
+        "environments": "#environments_selector",
+        "sizes": "#sizes_selector",
+        "types": "#types_selector",
+        "alignments": "#alignments_selector",
+        "sources": "#sources_selector, #customSourcesUsed",
+    }
+    for (let facet in containers) {
+        let counts = facetCounts[facet];
+        if (counts == undefined) { continue }
+        $(containers[facet]).find("input[type='checkbox']").each(function () {
+            let label = $(this).parent();
+            if ($(this).data("facet-value") == undefined) {
+                $(this).data("facet-value", label.text().trim());
+            }
+            let count = counts[$(this).data("facet-value")];
+            label.children(".facet-count").remove();
+            if (count != undefined) {
+                label.append('<span class="facet-count"> (' + count + ')</span>');
+            }
+        })
+    }
+}
+
+// The params the facet counts were last asked for with, since paging, sorting and
+// searching the table don't change them
+var facetCountsParams = null;
+
 var createMonsterTable = function () {
     // Populate the monster table
 
     window.monsterDataTable = $('#monsterTable').DataTable({
         "ajax": {
             "url": '/api/monsters',
+            // POST, since every page carries a new draw counter and could never be revalidated
             "type": 'POST',
-            "data": getMonsterParameters
+            "data": function () {
+                let parameters = getMonsterParameters();
+                if (parameters.params != facetCountsParams) {
+                    facetCountsParams = parameters.params;
+                    parameters.facetCounts = true;
+                }
+                return parameters;
+            }
         },
+        // Sorting, searching and paging happen on the server
+        "serverSide": true,
+        "processing": true,
         "aoColumns": [
-            {
-                "bSortable": true,
-                "sType": "name"
-            },
-            {
-                "bSortable": true,
-                "sType": "cr",
-            },
+            { "bSortable": true },
+            { "bSortable": true },
             { "bSortable": true },
             { "bSortable": true },
             { "bSortable": false },
@@ -403,19 +466,16 @@ var createMonsterTable = function () {
         "order": [[0, "asc"]]
 
     });
-    $.fn.dataTableExt.oSort["cr-desc"] = function (a, b) {
-        a = updaterButton.floatify(a);
-        b = updaterButton.floatify(b);
-        return ((a < b) ? -1 : ((a > b) ? 1 : 0));
-    }
-    $.fn.dataTableExt.oSort["cr-asc"] = function (a, b) {
-        a = updaterButton.floatify(a);
-        b = updaterButton.floatify(b);
-        return ((a > b) ? -1 : ((a < b) ? 1 : 0));
-    }
-    $.fn.dataTableExt.oSort["name-desc"] = function (a, b) { return b.localeCompare(a) }
-    $.fn.dataTableExt.oSort["name-asc"] = function (a, b) { return a.localeCompare(b) }
-    window.monsterDataTable.columns.adjust().draw();
+    window.monsterDataTable.on('xhr.dt', function (e, settings, json) {
+        if (json == null) {
+            // Ask for the counts again with the next page if this one failed
+            facetCountsParams = null;
+        } else if (json["facetCounts"] != undefined) {
+            showFacetCounts(json["facetCounts"]);
+        }
+    })
+    // Initialising the table has already fetched its first page
+    window.monsterDataTable.columns.adjust();
     //$("input").each($(this).attr({"autocomplete": "off", "autocorrect": "off", "autocapitalize": "off", "spellcheck": "false", color: "pink"}));
 }
 $(function () {
@@ -428,31 +488,29 @@ $(function () {
     }
     debugLog("Version check done.")
 
-    // Populate the first five accordions
+    // Every accordion is populated from a single request
     let listPopulatorPromises = []
     let selectors = ["sources", "environments", "sizes", "types", "alignments"]
-    for (let i = 0; i < selectors.length; i++) {
-        let selector = selectors[i];
-        debugLog("Requesting " + selector + "...")
-        listPopulatorPromises.push($.getJSON("/api/" + selector, function (data) {
-            debugLog(selector + " data received")
+    debugLog("Requesting lists...")
+    listPopulatorPromises.push($.getJSON("/api/bootstrap", function (lists) {
+        debugLog("Lists received")
+        // Populate the first five accordions
+        for (let i = 0; i < selectors.length; i++) {
+            let selector = selectors[i];
+            let data = lists[selector];
             var parent = $("#" + selector + "_selector");
             parent.append(listElements(data, selector));
             if (selector == "sources") {
                 // Populate unofficial sources
-                sourcesManager.getUnofficialSources();
+                sourcesManager.listUnofficialSources(lists["unofficialsources"]);
             }
             window.monsterParameters[selector] = data;
             debugLog(selector + " added to page, done.")
-        }));
-        debugLog("Request sent.")
-    };
-
+        };
 
-    // Populate the last accordion
-    debugLog("Requesting CRs...")
-    listPopulatorPromises.push($.getJSON("/api/crs", function (data) {
+        // Populate the last accordion
         debugLog("Processing CRs...")
+        let data = lists["crs"];
         var min = $("#challengeRatingMinimum");
         var max = $("#challengeRatingMaximum");
         let min_cr_stored = JSON.parse(window.localStorage.getItem("minCr"))
@@ -530,11 +588,14 @@ $(function () {
         // Handle Improved Initiative button clicks
         $(document).on("click", "#run_in_ii_button", function () {
             var monsters = JSON.parse(window.localStorage.getItem("monsters"));
-            var monsterData = window.monsterDataTable.data().toArray()
+            // The table only holds the page on screen, so fetch every matching monster
+            $.post('/api/monsters', getMonsterParameters()).done(function (response) {
+                var monsterData = response["data"]
 
-            var combatants = improvedInitiativeService.generateCombatantPayload(monsters, monsterData)
+                var combatants = improvedInitiativeService.generateCombatantPayload(monsters, monsterData)
 
-            improvedInitiativeService.openImprovedInitiative({ Combatants: combatants });
+                improvedInitiativeService.openImprovedInitiative({ Combatants: combatants });
+            })
         })
         // Handle sort updates
         $(document).on("click", ".updater_button", function () {
@@ -576,6 +637,39 @@ $(function () {
         $(document).on("input", "#customSourceSearcher", function () {
             sourcesManager.searchSources(window.unofficialSourceNames);
         })
+        // Submits a sheet to be ingested in the background, and polls the job until it finishes,
+        // backing off from ingestPollDelay to ingestMaxPollDelay milliseconds between polls.
+        // The promise returned is resolved with the job's result, or rejected with its error.
+        const ingestPollDelay = 250;
+        const ingestMaxPollDelay = 2000;
+        function ingestSheet(key, sheet, onProgress) {
+            let ingested = $.Deferred();
+            $.ajax({
+                type: "POST",
+                url: "api/ingestjobs?key=" + encodeURIComponent(key),
+                data: sheet,
+                contentType: "text/csv; charset=utf-8",
+                processData: false,
+            }).done(function (job) {
+                let poll = function (delay) {
+                    $.ajax({ type: "GET", url: "api/ingestjobs/" + job["id"], cache: false }).done(function (job) {
+                        if (job["status"] == "done") {
+                            ingested.resolve(job["result"]);
+                        } else if (job["status"] == "failed") {
+                            ingested.reject(job["error"]);
+                        } else {
+                            if (onProgress) {
+                                onProgress(job["progress"]);
+                            }
+                            setTimeout(poll, delay, Math.min(delay * 2, ingestMaxPollDelay));
+                        }
+                    }).fail(function () { ingested.reject(); });
+                };
+                setTimeout(poll, ingestPollDelay, ingestPollDelay * 2);
+            }).fail(function () { ingested.reject(); });
+            return ingested.promise();
+        }
+
         $(document).on("input", "#sourceKeyInput", function () {
             $('#sourceKeyManagementDiv .alert').remove();
             let key = $("#sourceKeyInput").val()
@@ -589,10 +683,8 @@ $(function () {
                     customSourceSheetRequest.done(function (data) {
                         $('#sourceKeyManagementDiv .alert').remove();
                         $('#sourceKeyManagementDiv').prepend('<div class="alert alert-primary" id="processing-custom-source-alert role="alert">Sheet received. Processing the sheet now...</div >')
-                        var customSheetProcessRequest = $.ajax({
-                            type: "POST",
-                            url: "api/processCSV",
-                            data: { csv: JSON.stringify(data), key: JSON.stringify(key) },
+                        var customSheetProcessRequest = ingestSheet(key, data, function (progress) {
+                            $('#sourceKeyManagementDiv .alert').text('Sheet received. Processing the sheet now... ' + progress["rows_parsed"] + ' rows read, ' + progress["rows_written"] + ' monsters added.');
                         })
                         customSheetProcessRequest.done(function (results) {
                             customSourceNames[customSourceNames.length] = results["name"];
@@ -612,7 +704,12 @@ $(function () {
                 } else {
                     $('#sourceKeyManagementDiv .alert').remove();
                     $('#sourceKeyManagementDiv').prepend('<div class="alert alert-primary" id="processing-custom-source-alert role="alert">Source ' + data + ' processed! Search for it in the box above.</div >')
-
+                    // Send the sheet again, so that any changes made to it since are picked up
+                    $.get('https://docs.google.com/spreadsheet/pub?key=' + key + '&output=csv').done(function (sheet) {
+                        ingestSheet(key, sheet).done(function () {
+                            $.getJSON('/api/unofficialsources').done(function (response) { window.unofficialSourceNames = response; })
+                        })
+                    })
                 }
             })
 
@@ -683,25 +780,8 @@ var updateThresholds = function () {
 
     window.localStorage.setItem("party", JSON.stringify(party))
 
-    $.ajax({
-        type: "POST",
-        url: "/api/expthresholds",
-        data: { party: JSON.stringify(party) },
-        success: function (result) {
-            var displayDiv = $("div #encounterThresholds");
-            displayDiv.empty();
-            displayDiv.append('<div class="row float-end"><div class="col exp-list easy">Easy: ' + result[0].toLocaleString("en-GB") + 'exp</div></div>');
-            displayDiv.append('<div class="row float-end"><div class="col exp-list medium">Medium: ' + result[1].toLocaleString("en-GB") + 'exp</div></div>');
-            displayDiv.append('<div class="row float-end"><div class="col exp-list hard">Hard: ' + result[2].toLocaleString("en-GB") + 'exp</div></div>');
-            displayDiv.append('<div class="row float-end"><div class="col exp-list deadly">Deadly: ' + result[3].toLocaleString("en-GB") + 'exp</div></div>');
-            displayDiv.append('<div class="row float-end"><div class="col exp-list daily">Daily: ' + result[4].toLocaleString("en-GB") + 'exp</div></div>');
-            window.partyThresholds = result;
-            encounterManager.highlightEncounterDifficulty();
-            encounterManager.colourAllCells();
-        }
-
-    })
-
+    // The thresholds come back with the encounter's XP and difficulty
+    encounterManager.evaluateEncounter();
 }
 
 module.exports = { createCharLevelCombo: createCharLevelCombo, handleClick: handleClick, updateThresholds: updateThresholds, getParty: getParty }
@@ -724,14 +804,15 @@ var searchSources = function () {
     }
 }
 
+var listUnofficialSources = function (unofficialSourceNames) {
+    $("#customSourcesUsed").empty;
+    window.unofficialSourceNames = unofficialSourceNames;
+    var parent = $("#customSourcesUsed");
+    parent.append(listElements(unofficialSourceNames, "sources_"));
+}
+
 var getUnofficialSources = function () {
-    $.getJSON('/api/unofficialsources').done(function (response) {
-        let unofficialSourceNames = response;
-        $("#customSourcesUsed").empty;
-        window.unofficialSourceNames = unofficialSourceNames;
-        var parent = $("#customSourcesUsed");
-        parent.append(listElements(unofficialSourceNames, "sources_"));
-    })
+    $.getJSON('/api/unofficialsources').done(listUnofficialSources)
 }
 
 var moveSourceCheckbox = function (checked_box) {
@@ -742,7 +823,7 @@ var moveSourceCheckbox = function (checked_box) {
     li.detach();
     $('#customSourcesUsed').append(li);
 }
-module.exports = { searchSources: searchSources, moveSourceCheckbox: moveSourceCheckbox, getUnofficialSources: getUnofficialSources }
+module.exports = { searchSources: searchSources, moveSourceCheckbox: moveSourceCheckbox, getUnofficialSources: getUnofficialSources, listUnofficialSources: listUnofficialSources }
 },{"./element_lister.js":1}],7:[function(require,module,exports){
 // updater-button.js
 
@@ -812,8 +893,10 @@ var sortTable = function (clicked_button) {
         let listUpdatedName = listUpdated.split("_")[0];
         window.monsterParameters[listUpdatedName] = GetUpdatedValues(listUpdated);
     }
+    // With server-side processing, ajax.reload redraws the table itself, and
+    // another draw() would fetch the page a second time
     window.monsterDataTable.ajax.reload();
-    window.monsterDataTable.columns.adjust().draw();
+    window.monsterDataTable.columns.adjust();
 }
 
 var toggleAll = function (clicked_button) {
@@ -827,7 +910,7 @@ var toggleAll = function (clicked_button) {
         $(clicked_button).text("Deselect All");
     }
     window.monsterDataTable.ajax.reload();
-    window.monsterDataTable.columns.adjust().draw();
+    window.monsterDataTable.columns.adjust();
 }
 
 module.exports = { GetUpdatedValues: GetUpdatedValues, AssociatedId: AssociatedId, getUpdatedChallengeRatings: getUpdatedChallengeRatings, floatify: floatify, sortTable: sortTable, toggleAll: toggleAll }
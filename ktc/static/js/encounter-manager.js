@@ -127,20 +127,30 @@ var highlightEncounterDifficulty = function () {
     $(".exp-list.hard").css("background-color", highlight_colours[2])
     $(".exp-list.deadly").css("background-color", highlight_colours[3])
     $(".exp-list.daily").css("background-color", highlight_colours[4])
-    for (var i = 0; i < window.partyThresholds.length; i++) {
-        if (window.encounterDifficulty < window.partyThresholds[0]) {
-            $(".exp-list").css("opacity", "0.7");
-            $(".exp-list").css("font-weight", "normal");
-        } else if (window.encounterDifficulty > window.partyThresholds[i]) {
-            $(".exp-list").css("opacity", "0.7");
-            $(".exp-list").css("font-weight", "normal");
-            $(".exp-list." + difficulties[i]).css("opacity", "1")
-            $(".exp-list." + difficulties[i]).css("font-weight", "bold")
-        }
+    $(".exp-list").css("opacity", "0.7");
+    $(".exp-list").css("font-weight", "normal");
+    // The server works out which threshold the encounter meets, apart from the daily budget
+    var band = window.encounterBand;
+    if (window.encounterDifficulty > window.partyThresholds[4]) {
+        band = "daily";
+    }
+    if (band != undefined && band != "trifling") {
+        $(".exp-list." + band).css("opacity", "1")
+        $(".exp-list." + band).css("font-weight", "bold")
     }
 }
 
-var updateEncounterDifficulty = function () {
+var showThresholds = function (thresholds) {
+    var displayDiv = $("div #encounterThresholds");
+    displayDiv.empty();
+    displayDiv.append('<div class="row float-end"><div class="col exp-list easy">Easy: ' + thresholds[0].toLocaleString("en-GB") + 'exp</div></div>');
+    displayDiv.append('<div class="row float-end"><div class="col exp-list medium">Medium: ' + thresholds[1].toLocaleString("en-GB") + 'exp</div></div>');
+    displayDiv.append('<div class="row float-end"><div class="col exp-list hard">Hard: ' + thresholds[2].toLocaleString("en-GB") + 'exp</div></div>');
+    displayDiv.append('<div class="row float-end"><div class="col exp-list deadly">Deadly: ' + thresholds[3].toLocaleString("en-GB") + 'exp</div></div>');
+    displayDiv.append('<div class="row float-end"><div class="col exp-list daily">Daily: ' + thresholds[4].toLocaleString("en-GB") + 'exp</div></div>');
+}
+
+var getEncounterMonsters = function () {
     var monsterListDiv = $('#monsterList');
     var monstersInEncounter = new Array()
     for (var i = 0; i < $(monsterListDiv).children('div').length; i++) {
@@ -150,21 +160,37 @@ var updateEncounterDifficulty = function () {
         let noOfMonsters = parseInt($(thisSpan).text())
         monstersInEncounter[monstersInEncounter.length] = new Array(monsterName, noOfMonsters)
     }
+    return monstersInEncounter
+}
 
-    window.localStorage.setItem("monsters", JSON.stringify(monstersInEncounter));
+// Gets the party's thresholds, the encounter's XP and its difficulty in one request
+var evaluateEncounter = function () {
+    let party = JSON.parse(window.localStorage.getItem("party"));
+    if (party == null) {
+        return
+    }
 
     $.ajax({
         type: "POST",
-        url: "api/encounterxp",
-        data: { monsters: JSON.stringify(monstersInEncounter) },
+        url: "/api/evaluate",
+        data: { party: JSON.stringify(party), monsters: JSON.stringify(getEncounterMonsters()) },
         success: function (results) {
+            showThresholds(results["thresholds"]);
+            window.partyThresholds = results["thresholds"];
             $('#encounterDifficulty').empty();
-            $('#encounterDifficulty').text('(' + results + 'XP)')
-            window.encounterDifficulty = results;
+            $('#encounterDifficulty').text('(' + results["xp"] + 'XP)')
+            window.encounterDifficulty = results["xp"];
+            window.encounterBand = results["difficulty"];
             highlightEncounterDifficulty()
+            colourAllCells();
         }
     })
+}
 
+var updateEncounterDifficulty = function () {
+    window.localStorage.setItem("monsters", JSON.stringify(getEncounterMonsters()));
+
+    evaluateEncounter();
 }
 
 const clearEncounter = function() {
@@ -187,8 +213,10 @@ const generateEncounter = function(data) {
         })
     })
 
-    encounterRequest.fail(function () {
-        $('.encounter-col').prepend('<div class="alert alert-danger" id="encounter-generation-alert" role="alert">Encounter generation failed. Please try again with different parameters.</div >')
+    encounterRequest.fail(function (jqXHR) {
+        clearEncounter();
+        let reason = (jqXHR.responseJSON && jqXHR.responseJSON.error) ? ' (' + $('<div>').text(jqXHR.responseJSON.error).html() + ')' : '';
+        $('.encounter-col').prepend('<div class="alert alert-danger" id="encounter-generation-alert" role="alert">Encounter generation failed' + reason + '. Please try again with different parameters.</div >')
     })
 }
 
@@ -214,4 +242,4 @@ var colourAllCells = function () {
     }
 }
 
-module.exports = { addMonster: addMonster, updateMonsterCount: updateMonsterCount, highlightEncounterDifficulty: highlightEncounterDifficulty, importEncounter: importEncounter, colourCell: colourCell, colourAllCells: colourAllCells, generateEncounter: generateEncounter }
\ No newline at end of file
+module.exports = { addMonster: addMonster, updateMonsterCount: updateMonsterCount, highlightEncounterDifficulty: highlightEncounterDifficulty, importEncounter: importEncounter, colourCell: colourCell, colourAllCells: colourAllCells, generateEncounter: generateEncounter, evaluateEncounter: evaluateEncounter }
\ No newline at end of file
@@ -38,24 +38,59 @@ var getMonsterParameters = function () {
         params: JSON.stringify(window.monsterParameters)
     };
 }
+// Show how many monsters each checkbox would give next to its label
+var showFacetCounts = function (facetCounts) {
+    let containers = {
+        "environments": "#environments_selector",
+        "sizes": "#sizes_selector",
+        "types": "#types_selector",
+        "alignments": "#alignments_selector",
+        "sources": "#sources_selector, #customSourcesUsed",
+    }
+    for (let facet in containers) {
+        let counts = facetCounts[facet];
+        if (counts == undefined) { continue }
+        $(containers[facet]).find("input[type='checkbox']").each(function () {
+            let label = $(this).parent();
+            if ($(this).data("facet-value") == undefined) {
+                $(this).data("facet-value", label.text().trim());
+            }
+            let count = counts[$(this).data("facet-value")];
+            label.children(".facet-count").remove();
+            if (count != undefined) {
+                label.append('<span class="facet-count"> (' + count + ')</span>');
+            }
+        })
+    }
+}
+
+// The params the facet counts were last asked for with, since paging, sorting and
+// searching the table don't change them
+var facetCountsParams = null;
+
 var createMonsterTable = function () {
     // Populate the monster table
 
     window.monsterDataTable = $('#monsterTable').DataTable({
         "ajax": {
             "url": '/api/monsters',
+            // POST, since every page carries a new draw counter and could never be revalidated
             "type": 'POST',
-            "data": getMonsterParameters
+            "data": function () {
+                let parameters = getMonsterParameters();
+                if (parameters.params != facetCountsParams) {
+                    facetCountsParams = parameters.params;
+                    parameters.facetCounts = true;
+                }
+                return parameters;
+            }
         },
+        // Sorting, searching and paging happen on the server
+        "serverSide": true,
+        "processing": true,
         "aoColumns": [
-            {
-                "bSortable": true,
-                "sType": "name"
-            },
-            {
-                "bSortable": true,
-                "sType": "cr",
-            },
+            { "bSortable": true },
+            { "bSortable": true },
             { "bSortable": true },
             { "bSortable": true },
             { "bSortable": false },
@@ -91,19 +126,16 @@ var createMonsterTable = function () {
         "order": [[0, "asc"]]
 
     });
-    $.fn.dataTableExt.oSort["cr-desc"] = function (a, b) {
-        a = updaterButton.floatify(a);
-        b = updaterButton.floatify(b);
-        return ((a < b) ? -1 : ((a > b) ? 1 : 0));
-    }
-    $.fn.dataTableExt.oSort["cr-asc"] = function (a, b) {
-        a = updaterButton.floatify(a);
-        b = updaterButton.floatify(b);
-        return ((a > b) ? -1 : ((a < b) ? 1 : 0));
-    }
-    $.fn.dataTableExt.oSort["name-desc"] = function (a, b) { return b.localeCompare(a) }
-    $.fn.dataTableExt.oSort["name-asc"] = function (a, b) { return a.localeCompare(b) }
-    window.monsterDataTable.columns.adjust().draw();
+    window.monsterDataTable.on('xhr.dt', function (e, settings, json) {
+        if (json == null) {
+            // Ask for the counts again with the next page if this one failed
+            facetCountsParams = null;
+        } else if (json["facetCounts"] != undefined) {
+            showFacetCounts(json["facetCounts"]);
+        }
+    })
+    // Initialising the table has already fetched its first page
+    window.monsterDataTable.columns.adjust();
     //$("input").each($(this).attr({"autocomplete": "off", "autocorrect": "off", "autocapitalize": "off", "spellcheck": "false", color: "pink"}));
 }
 $(function () {
@@ -116,31 +148,29 @@ $(function () {
     }
     debugLog("Version check done.")
 
-    // Populate the first five accordions
+    // Every accordion is populated from a single request
     let listPopulatorPromises = []
     let selectors = ["sources", "environments", "sizes", "types", "alignments"]
-    for (let i = 0; i < selectors.length; i++) {
-        let selector = selectors[i];
-        debugLog("Requesting " + selector + "...")
-        listPopulatorPromises.push($.getJSON("/api/" + selector, function (data) {
-            debugLog(selector + " data received")
+    debugLog("Requesting lists...")
+    listPopulatorPromises.push($.getJSON("/api/bootstrap", function (lists) {
+        debugLog("Lists received")
+        // Populate the first five accordions
+        for (let i = 0; i < selectors.length; i++) {
+            let selector = selectors[i];
+            let data = lists[selector];
             var parent = $("#" + selector + "_selector");
             parent.append(listElements(data, selector));
             if (selector == "sources") {
                 // Populate unofficial sources
-                sourcesManager.getUnofficialSources();
+                sourcesManager.listUnofficialSources(lists["unofficialsources"]);
             }
             window.monsterParameters[selector] = data;
             debugLog(selector + " added to page, done.")
-        }));
-        debugLog("Request sent.")
-    };
-
+        };
 
-    // Populate the last accordion
-    debugLog("Requesting CRs...")
-    listPopulatorPromises.push($.getJSON("/api/crs", function (data) {
+        // Populate the last accordion
         debugLog("Processing CRs...")
+        let data = lists["crs"];
         var min = $("#challengeRatingMinimum");
         var max = $("#challengeRatingMaximum");
         let min_cr_stored = JSON.parse(window.localStorage.getItem("minCr"))
@@ -218,11 +248,14 @@ $(function () {
         // Handle Improved Initiative button clicks
         $(document).on("click", "#run_in_ii_button", function () {
             var monsters = JSON.parse(window.localStorage.getItem("monsters"));
-            var monsterData = window.monsterDataTable.data().toArray()
+            // The table only holds the page on screen, so fetch every matching monster
+            $.post('/api/monsters', getMonsterParameters()).done(function (response) {
+                var monsterData = response["data"]
 
-            var combatants = improvedInitiativeService.generateCombatantPayload(monsters, monsterData)
+                var combatants = improvedInitiativeService.generateCombatantPayload(monsters, monsterData)
 
-            improvedInitiativeService.openImprovedInitiative({ Combatants: combatants });
+                improvedInitiativeService.openImprovedInitiative({ Combatants: combatants });
+            })
         })
         // Handle sort updates
         $(document).on("click", ".updater_button", function () {
@@ -264,6 +297,39 @@ $(function () {
         $(document).on("input", "#customSourceSearcher", function () {
             sourcesManager.searchSources(window.unofficialSourceNames);
         })
+        // Submits a sheet to be ingested in the background, and polls the job until it finishes,
+        // backing off from ingestPollDelay to ingestMaxPollDelay milliseconds between polls.
+        // The promise returned is resolved with the job's result, or rejected with its error.
+        const ingestPollDelay = 250;
+        const ingestMaxPollDelay = 2000;
+        function ingestSheet(key, sheet, onProgress) {
+            let ingested = $.Deferred();
+            $.ajax({
+                type: "POST",
+                url: "api/ingestjobs?key=" + encodeURIComponent(key),
+                data: sheet,
+                contentType: "text/csv; charset=utf-8",
+                processData: false,
+            }).done(function (job) {
+                let poll = function (delay) {
+                    $.ajax({ type: "GET", url: "api/ingestjobs/" + job["id"], cache: false }).done(function (job) {
+                        if (job["status"] == "done") {
+                            ingested.resolve(job["result"]);
+                        } else if (job["status"] == "failed") {
+                            ingested.reject(job["error"]);
+                        } else {
+                            if (onProgress) {
+                                onProgress(job["progress"]);
+                            }
+                            setTimeout(poll, delay, Math.min(delay * 2, ingestMaxPollDelay));
+                        }
+                    }).fail(function () { ingested.reject(); });
+                };
+                setTimeout(poll, ingestPollDelay, ingestPollDelay * 2);
+            }).fail(function () { ingested.reject(); });
+            return ingested.promise();
+        }
+
         $(document).on("input", "#sourceKeyInput", function () {
             $('#sourceKeyManagementDiv .alert').remove();
             let key = $("#sourceKeyInput").val()
@@ -277,10 +343,8 @@ $(function () {
                     customSourceSheetRequest.done(function (data) {
                         $('#sourceKeyManagementDiv .alert').remove();
                         $('#sourceKeyManagementDiv').prepend('<div class="alert alert-primary" id="processing-custom-source-alert role="alert">Sheet received. Processing the sheet now...</div >')
-                        var customSheetProcessRequest = $.ajax({
-                            type: "POST",
-                            url: "api/processCSV",
-                            data: { csv: JSON.stringify(data), key: JSON.stringify(key) },
+                        var customSheetProcessRequest = ingestSheet(key, data, function (progress) {
+                            $('#sourceKeyManagementDiv .alert').text('Sheet received. Processing the sheet now... ' + progress["rows_parsed"] + ' rows read, ' + progress["rows_written"] + ' monsters added.');
                         })
                         customSheetProcessRequest.done(function (results) {
                             customSourceNames[customSourceNames.length] = results["name"];
@@ -300,7 +364,12 @@ $(function () {
                 } else {
                     $('#sourceKeyManagementDiv .alert').remove();
                     $('#sourceKeyManagementDiv').prepend('<div class="alert alert-primary" id="processing-custom-source-alert role="alert">Source ' + data + ' processed! Search for it in the box above.</div >')
-
+                    // Send the sheet again, so that any changes made to it since are picked up
+                    $.get('https://docs.google.com/spreadsheet/pub?key=' + key + '&output=csv').done(function (sheet) {
+                        ingestSheet(key, sheet).done(function () {
+                            $.getJSON('/api/unofficialsources').done(function (response) { window.unofficialSourceNames = response; })
+                        })
+                    })
                 }
             })
 
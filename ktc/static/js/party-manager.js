@@ -59,25 +59,8 @@ var updateThresholds = function () {
 
     window.localStorage.setItem("party", JSON.stringify(party))
 
-    $.ajax({
-        type: "POST",
-        url: "/api/expthresholds",
-        data: { party: JSON.stringify(party) },
-        success: function (result) {
-            var displayDiv = $("div #encounterThresholds");
-            displayDiv.empty();
-            displayDiv.append('<div class="row float-end"><div class="col exp-list easy">Easy: ' + result[0].toLocaleString("en-GB") + 'exp</div></div>');
-            displayDiv.append('<div class="row float-end"><div class="col exp-list medium">Medium: ' + result[1].toLocaleString("en-GB") + 'exp</div></div>');
-            displayDiv.append('<div class="row float-end"><div class="col exp-list hard">Hard: ' + result[2].toLocaleString("en-GB") + 'exp</div></div>');
-            displayDiv.append('<div class="row float-end"><div class="col exp-list deadly">Deadly: ' + result[3].toLocaleString("en-GB") + 'exp</div></div>');
-            displayDiv.append('<div class="row float-end"><div class="col exp-list daily">Daily: ' + result[4].toLocaleString("en-GB") + 'exp</div></div>');
-            window.partyThresholds = result;
-            encounterManager.highlightEncounterDifficulty();
-            encounterManager.colourAllCells();
-        }
-
-    })
-
+    // The thresholds come back with the encounter's XP and difficulty
+    encounterManager.evaluateEncounter();
 }
 
 module.exports = { createCharLevelCombo: createCharLevelCombo, handleClick: handleClick, updateThresholds: updateThresholds, getParty: getParty }
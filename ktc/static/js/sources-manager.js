@@ -15,14 +15,15 @@ var searchSources = function () {
     }
 }
 
+var listUnofficialSources = function (unofficialSourceNames) {
+    $("#customSourcesUsed").empty;
+    window.unofficialSourceNames = unofficialSourceNames;
+    var parent = $("#customSourcesUsed");
+    parent.append(listElements(unofficialSourceNames, "sources_"));
+}
+
 var getUnofficialSources = function () {
-    $.getJSON('/api/unofficialsources').done(function (response) {
-        let unofficialSourceNames = response;
-        $("#customSourcesUsed").empty;
-        window.unofficialSourceNames = unofficialSourceNames;
-        var parent = $("#customSourcesUsed");
-        parent.append(listElements(unofficialSourceNames, "sources_"));
-    })
+    $.getJSON('/api/unofficialsources').done(listUnofficialSources)
 }
 
 var moveSourceCheckbox = function (checked_box) {
@@ -33,4 +34,4 @@ var moveSourceCheckbox = function (checked_box) {
     li.detach();
     $('#customSourcesUsed').append(li);
 }
-module.exports = { searchSources: searchSources, moveSourceCheckbox: moveSourceCheckbox, getUnofficialSources: getUnofficialSources }
\ No newline at end of file
+module.exports = { searchSources: searchSources, moveSourceCheckbox: moveSourceCheckbox, getUnofficialSources: getUnofficialSources, listUnofficialSources: listUnofficialSources }
\ No newline at end of file
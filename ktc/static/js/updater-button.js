@@ -66,8 +66,10 @@ var sortTable = function (clicked_button) {
         let listUpdatedName = listUpdated.split("_")[0];
         window.monsterParameters[listUpdatedName] = GetUpdatedValues(listUpdated);
     }
+    // With server-side processing, ajax.reload redraws the table itself, and
+    // another draw() would fetch the page a second time
     window.monsterDataTable.ajax.reload();
-    window.monsterDataTable.columns.adjust().draw();
+    window.monsterDataTable.columns.adjust();
 }
 
 var toggleAll = function (clicked_button) {
@@ -81,7 +83,7 @@ var toggleAll = function (clicked_button) {
         $(clicked_button).text("Deselect All");
     }
     window.monsterDataTable.ajax.reload();
-    window.monsterDataTable.columns.adjust().draw();
+    window.monsterDataTable.columns.adjust();
 }
 
 module.exports = { GetUpdatedValues: GetUpdatedValues, AssociatedId: AssociatedId, getUpdatedChallengeRatings: getUpdatedChallengeRatings, floatify: floatify, sortTable: sortTable, toggleAll: toggleAll }
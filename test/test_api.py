@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
+import gzip
+import io
 import json
+import os
 import sqlite3
+import threading
+import time
 from fractions import Fraction
 
 import pytest
 
-from ktc import app
+from ktc import app, converter, db
 
 
 @pytest.fixture
@@ -277,6 +282,17 @@ def test_cr_list_gives_correct_list(client):
     assert expected == received
 
 
+def test_bootstrap_gives_every_list(client):
+    received = client.get("/api/bootstrap").get_json()
+
+    for route in ["sources", "environments", "sizes", "types", "alignments", "crs", "unofficialsources"]:
+        assert client.get(f"/api/{route}").get_json() == received[route]
+
+
+def test_bootstrap_is_only_read_once_per_catalog_version():
+    assert app.api.get_bootstrap() is app.api.get_bootstrap()
+
+
 def test_monster_list_gives_json_with_proper_mimetype(client):
     response = client.get("/api/monsters")
     assert response.status_code == 200
@@ -409,6 +425,96 @@ def test_monster_list_returns_good_all_constraint_list(client):
             assert ':'.join(source.split[":"][:-1]) in parameters['sources']
 
 
+def test_monster_list_returns_one_page_for_server_side_processing(client):
+    everything = client.get("/api/monsters").get_json()["data"]
+    response = client.post("/api/monsters", data={
+        "draw": "3", "start": "10", "length": "25",
+        "order[0][column]": "0", "order[0][dir]": "asc", "search[value]": ""})
+    received = response.get_json()
+
+    assert 3 == received["draw"]
+    assert len(everything) == received["recordsTotal"]
+    assert len(everything) == received["recordsFiltered"]
+    assert everything[10:35] == received["data"]
+
+
+def test_monster_list_searches_and_sorts_for_server_side_processing(client):
+    response = client.post("/api/monsters", data={
+        "draw": "1", "start": "0", "length": "-1",
+        "order[0][column]": "1", "order[0][dir]": "desc", "search[value]": "DRAGON red"})
+    received = response.get_json()
+
+    assert received["recordsFiltered"] == len(received["data"])
+    assert received["recordsFiltered"] < received["recordsTotal"]
+    challenge_ratings = [float(Fraction(monster[1]))
+                         for monster in received["data"]]
+    assert sorted(challenge_ratings, reverse=True) == challenge_ratings
+    for monster in received["data"]:
+        searched = " ".join(monster[:8]).lower()
+        assert "dragon" in searched and "red" in searched
+
+
+def test_monster_list_gives_facet_counts_when_asked(client):
+    assert "facetCounts" not in client.get("/api/monsters").get_json()
+
+    parameters = json.dumps({"sizes": ["_Tiny"]})
+    received = client.get(
+        f"/api/monsters?params={parameters}&facetCounts=true&draw=1&length=10").get_json()
+    assert received["recordsTotal"] == received["facetCounts"]["sizes"]["Tiny"]
+    assert received["recordsTotal"] == sum(
+        received["facetCounts"]["types"].values())
+
+
+def test_catalog_routes_answer_matching_etag_with_not_modified(client, monkeypatch):
+    response = client.get("/api/environments")
+    etag = response.headers["ETag"]
+    assert 200 == response.status_code
+
+    def fail():
+        raise AssertionError("the DB should not be queried")
+    monkeypatch.setattr(app.api, "get_list_of_environments", fail)
+    response = client.get("/api/environments",
+                          headers={"If-None-Match": etag})
+    assert 304 == response.status_code
+    assert etag == response.headers["ETag"]
+    assert b"" == response.data
+
+
+def test_catalog_etag_depends_on_parameters_and_catalog_version(client, monkeypatch):
+    etag = client.get("/api/monsters").headers["ETag"]
+    assert etag != client.get(
+        '/api/monsters?params={"sizes": ["_Tiny"]}').headers["ETag"]
+
+    (build, version) = app.converter.get_catalog_state(app.api.db_location)
+    monkeypatch.setattr(app.converter, "get_catalog_state",
+                        lambda db_location: (build, version + 1))
+    response = client.get("/api/monsters", headers={"If-None-Match": etag})
+    assert 200 == response.status_code
+    assert etag != response.headers["ETag"]
+
+
+def test_catalog_etag_depends_on_catalog_build(client, monkeypatch):
+    etag = client.get("/api/monsters").headers["ETag"]
+
+    # A rebuilt DB starts again from the same catalog version, but with a new build id
+    version = app.converter.get_catalog_version(app.api.db_location)
+    monkeypatch.setattr(app.converter, "get_catalog_state",
+                        lambda db_location: ("rebuilt", version))
+    response = client.get("/api/monsters", headers={"If-None-Match": etag})
+    assert 200 == response.status_code
+    assert etag != response.headers["ETag"]
+
+
+def test_catalog_etag_answers_304_without_querying_the_db(client, monkeypatch):
+    etag = client.get("/api/monsters").headers["ETag"]
+
+    def no_queries(db_location):
+        raise AssertionError("queried the DB")
+    monkeypatch.setattr(db, "connection", no_queries)
+    response = client.get("/api/monsters", headers={"If-None-Match": etag})
+    assert 304 == response.status_code
+
+
 def test_monster_list_returns_good_no_legendary_list(client):
     parameters = {"allowLegendary": "false"}
     response = client.get(f"/api/monsters?params={json.dumps(parameters)}")
@@ -459,6 +565,77 @@ def test_encounter_xp_returns_good_data(client):
     assert expected == received
 
 
+def test_encounter_xp_accepts_fids(client):
+    fids = [["mm.aarakocra", 4]]
+    response = client.post("/api/encounterxp", data={"fids": json.dumps(fids)})
+
+    assert 400 == response.get_json()
+
+
+def test_batch_encounter_xp_gives_xp_and_difficulties(client):
+    encounters = [[["Aarakocra", 4]], [["Air Elemental", 1]],
+                  [["Aarakocra", 4], ["Air Elemental", 2]]]
+    parties = [[[4, 3]], [[4, 5], [1, 6]]]
+    response = client.post("/api/encounterxp/batch", data={
+        "encounters": json.dumps(encounters), "parties": json.dumps(parties)})
+    received = response.get_json()
+
+    assert [400, 1800, 7600] == received["xp"]
+    assert [[300, 600, 900, 1600, 4800], [1300, 2600, 3900, 5800, 18000]
+            ] == received["thresholds"]
+    assert [["easy", "deadly", "deadly"], [
+        "trifling", "easy", "deadly"]] == received["difficulties"]
+
+
+def test_batch_encounter_xp_accepts_crs(client):
+    encounters = [[["1/4", 4]], [["5", 1]]]
+    response = client.post("/api/encounterxp/batch", data={
+        "encounters": json.dumps(encounters), "identifier": "cr"})
+
+    assert {"xp": [400, 1800]} == response.get_json()
+
+
+@pytest.mark.parametrize("data", [
+    {"encounters": [[["Aarakocra", 1]]], "parties": [[[4, -1]]]},
+    {"encounters": [[["Aarakocra", 1]]], "parties": [[[4, 25]]]},
+    {"encounters": [[["Aarakocra", 1]]], "parties": [[[100, 20]]]},
+    {"encounters": [[["No Such Monster", 1]]]},
+    {"encounters": [[["31", 1]]], "identifier": "cr"},
+    {"encounters": [[["Aarakocra", -1]]]},
+    {"encounters": [[["Aarakocra", 0]]]},
+    {"encounters": [[["Aarakocra", 1.5]]]},
+    {"encounters": [["Aarakocra"]]},
+    {"encounters": [[["Aarakocra", 1]]], "identifier": "size"},
+])
+def test_batch_encounter_xp_rejects_bad_input(client, data):
+    form = {key: json.dumps(value) if key != "identifier" else value for (key, value) in data.items()}
+    response = client.post("/api/encounterxp/batch", data=form)
+
+    assert 400 == response.status_code
+    assert "error" in response.get_json()
+
+
+def test_evaluate_gives_thresholds_xp_and_difficulty(client):
+    party = [[4, 3]]
+    monsters = [["Aarakocra", 4]]
+    response = client.post("/api/evaluate", data={
+        "party": json.dumps(party), "monsters": json.dumps(monsters)})
+
+    assert response.content_type == "application/json"
+    assert {"thresholds": [300, 600, 900, 1600, 4800], "xp": 400,
+            "difficulty": "easy"} == response.get_json()
+
+
+def test_evaluate_accepts_fids(client):
+    party = [[4, 5], [1, 6]]
+    fids = [["mm.aarakocra", 4]]
+    response = client.post("/api/evaluate", data={
+        "party": json.dumps(party), "fids": json.dumps(fids)})
+
+    assert {"thresholds": [1300, 2600, 3900, 5800, 18000], "xp": 400,
+            "difficulty": "trifling"} == response.get_json()
+
+
 def test_check_source_gives_json_with_proper_mimetype(client):
     source = "1NwjJS2Jpf_CxCZtHRCIJxc-6rERIo9vbFSqcs5ttE8M"
     response = client.get("/api/checksource?key=" + json.dumps(source))
@@ -479,3 +656,179 @@ def test_encounter_generator_gives_json_with_proper_mimetype(client):
     response = client.get("/api/encountergenerator")
     assert response.status_code == 200
     assert response.content_type == "application/json"
+
+
+def test_encounter_generator_is_reproducible_from_its_seed(client):
+    params = json.dumps({"party": [[4, 5]], "difficulty": "medium"})
+    response = client.get("/api/encountergenerator?params=" + params)
+    seed = response.headers["X-Encounter-Seed"]
+
+    repeated = client.get("/api/encountergenerator?seed=" + seed + "&params=" + params)
+    assert seed == repeated.headers["X-Encounter-Seed"]
+    assert response.get_json() == repeated.get_json()
+
+
+def test_unseeded_encounters_are_not_cached(client):
+    misses = app.random_encounter_generator.encounter_cache.stats()["misses"]
+    params = json.dumps({"party": [[4, 5]], "difficulty": "medium"})
+    response = client.get("/api/encountergenerator?params=" + params)
+
+    assert response.headers["X-Encounter-Seed"]
+    assert misses == app.random_encounter_generator.encounter_cache.stats()["misses"]
+
+
+def test_encounter_generator_explains_impossible_encounters(client):
+    params = json.dumps({"party": [[1, 1]], "environments": ["_nowhere"]})
+    response = client.get("/api/encountergenerator?params=" + params)
+
+    assert 422 == response.status_code
+    assert 0 == response.get_json()["attempts"]
+    assert "candidate monsters" in response.get_json()["error"]
+
+
+@pytest.mark.parametrize("party", [[[100, 20]], [[4, 21]], [[4, 0]], [["four", 5]], [[4]], 4])
+def test_encounter_generator_rejects_unplannable_parties(client, party):
+    params = json.dumps({"party": party, "difficulty": "deadly", "solver": "exact"})
+    response = client.get("/api/encountergenerator?params=" + params)
+
+    assert 400 == response.status_code
+    assert "error" in response.get_json()
+
+
+def test_thresholds_reject_oversized_parties(client):
+    response = client.get("/api/expthresholds?party=" + str([[100, 20]]))
+
+    assert 400 == response.status_code
+
+
+def test_rarity_profiles_include_taldorei(client):
+    response = client.get("/api/rarityprofiles")
+
+    assert [7, 15, 22] == response.get_json()["taldorei"]["thresholds"]
+    assert 2 == response.get_json()["taldorei"]["modifiers"]["fiend"]
+
+
+UPLOAD_CSV = """fid,name,cr,size,type,tags,section,alignment,environment,ac,hp,init,lair?,legendary?,unique?,sources,
+mot.uploaded_monster,Uploaded Monster,1,Medium,Beast,,,,forest,,,,,,,Uploaded Bestiary: 12,
+mot.another_uploaded_monster,Another Uploaded Monster,2,Large,Fiend,,,,swamp,,,,,,,Uploaded Bestiary: 13,
+"""
+
+
+@pytest.fixture
+def upload_database(monkeypatch):
+    conn = converter.configure_db("test_upload.db")
+    monkeypatch.setattr(app, "db_location", "test_upload.db")
+
+    yield "test_upload.db"
+
+    conn.close()
+    db.close_connections("test_upload.db")
+    os.remove("test_upload.db")
+
+
+def uploaded_monster_names(database):
+    with db.connection(database) as conn:
+        return sorted(name for (name,) in conn.execute("SELECT name FROM monsters"))
+
+
+def test_upload_csv_streams_the_request_body(client, upload_database):
+    response = client.post("/api/uploadcsv?key=uploadkey", data=UPLOAD_CSV.encode(),
+                           content_type="text/csv")
+
+    assert {"name": "Uploaded Bestiary"} == response.get_json()
+    assert ["Another Uploaded Monster", "Uploaded Monster"] == uploaded_monster_names(upload_database)
+
+
+def test_upload_csv_is_received_in_full_before_it_is_parsed(client, upload_database, monkeypatch):
+    body = io.BytesIO(UPLOAD_CSV.encode())
+    ingest_stream = app.converter.ingest_stream
+
+    def check_received(stream, *args, **kwargs):
+        assert body.tell() == len(UPLOAD_CSV.encode())
+        return ingest_stream(stream, *args, **kwargs)
+    monkeypatch.setattr(app.converter, "ingest_stream", check_received)
+
+    assert "Uploaded Bestiary" == app.api.ingest_custom_csv_stream(body, upload_database, "spooledkey")
+
+
+def test_upload_csv_accepts_gzipped_multipart_files(client, upload_database):
+    data = {"key": "gzippeduploadkey",
+            "csv": (io.BytesIO(gzip.compress(UPLOAD_CSV.encode())), "sheet.csv.gz")}
+    response = client.post("/api/uploadcsv", data=data, content_type="multipart/form-data")
+
+    assert {"name": "Uploaded Bestiary"} == response.get_json()
+    assert ["Another Uploaded Monster", "Uploaded Monster"] == uploaded_monster_names(upload_database)
+
+
+def test_upload_csv_accepts_gzip_content_encoding(client, upload_database):
+    response = client.post("/api/uploadcsv?key=encodeduploadkey", data=gzip.compress(UPLOAD_CSV.encode()),
+                           content_type="text/csv", headers={"Content-Encoding": "gzip"})
+
+    assert {"name": "Uploaded Bestiary"} == response.get_json()
+
+
+def test_upload_csv_rejects_unreadable_files(client, upload_database):
+    response = client.post("/api/uploadcsv?key=badkey", data=b"not gzip at all",
+                           content_type="application/gzip")
+
+    assert 400 == response.status_code
+    assert [] == uploaded_monster_names(upload_database)
+
+
+def test_ingest_job_reports_its_progress(client, upload_database):
+    response = client.post("/api/ingestjobs?key=jobkey", data=UPLOAD_CSV.encode(), content_type="text/csv")
+    assert 202 == response.status_code
+    location = response.headers["Location"]
+
+    job = app.jobs.get_job(response.get_json()["id"])
+    assert job.finished.wait(10)
+
+    received = client.get(location).get_json()
+    assert "done" == received["status"]
+    assert {"name": "Uploaded Bestiary"} == received["result"]
+    assert {"rows_parsed": 2, "rows_written": 2, "renames": 0} == received["progress"]
+    assert ["Another Uploaded Monster", "Uploaded Monster"] == uploaded_monster_names(upload_database)
+
+
+def test_ingest_job_events_end_when_it_finishes(client, upload_database):
+    data = {"key": "eventjobkey", "csv": (io.BytesIO(b"not,a,monster\n1,2,3\n"), "sheet.csv")}
+    job_id = client.post("/api/ingestjobs", data=data, content_type="multipart/form-data").get_json()["id"]
+
+    response = client.get(f"/api/ingestjobs/{job_id}/events")
+    assert response.mimetype == "text/event-stream"
+    events = [json.loads(line[len("data: "):])
+              for line in response.get_data(as_text=True).splitlines() if line.startswith("data: ")]
+    assert "failed" == events[-1]["status"]
+    assert events[-1]["error"]
+
+
+def test_ingest_jobs_are_turned_away_when_the_queue_is_full(client, upload_database, monkeypatch):
+    monkeypatch.setattr(app.jobs, "max_queued_jobs", 0)
+    response = client.post("/api/ingestjobs?key=fullkey", data=UPLOAD_CSV.encode(), content_type="text/csv")
+
+    assert 503 == response.status_code
+    assert response.headers["Retry-After"]
+    assert [] == uploaded_monster_names(upload_database)
+
+
+def test_job_waiters_wake_as_soon_as_it_finishes(monkeypatch):
+    monkeypatch.setattr(app.jobs, "progress_interval", 60)
+    started = threading.Event()
+    release = threading.Event()
+
+    def wait_for_release():
+        started.set()
+        release.wait(10)
+    job = app.jobs.submit(wait_for_release)
+    assert started.wait(10)
+    running = job.to_dict()
+
+    release.set()
+    waited_from = time.monotonic()
+    assert "done" == job.wait_for_change(running, 30)["status"]
+    assert time.monotonic() - waited_from < 10
+
+
+def test_unknown_ingest_job_is_not_found(client):
+    assert 404 == client.get("/api/ingestjobs/nosuchjob").status_code
+    assert 404 == client.get("/api/ingestjobs/nosuchjob/events").status_code
@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 import os
 import sqlite3
+from fractions import Fraction
 from re import A
 
 import pytest
 
-from ktc import api, converter
+from ktc import api, converter, db
 
 
 @pytest.fixture
@@ -341,6 +342,18 @@ def test_monster_list_returns_good_challenge_rating_constrained_list():
         assert monster[1] in ["1", "2"]
 
 
+def test_monster_list_returns_good_numeric_range_constrained_list():
+    parameters = {"minimumChallengeRating": "1/4", "maximumChallengeRating": "8",
+                  "minimumAc": "17", "maximumHp": 150, "minimumInit": "2"}
+    actual = api.get_list_of_monsters(parameters)["data"]
+    assert len(actual) > 0
+    for monster in actual:
+        assert 0.25 <= float(Fraction(monster[1])) <= 8
+        assert int(monster[9]) <= 150
+        assert int(monster[10]) >= 17
+        assert int(monster[11]) >= 2
+
+
 def test_monster_list_returns_good_source_constraint_list():
     parameters = {"sources": ["sources_Monster Manual"]}
     actual = api.get_list_of_monsters(parameters)["data"]
@@ -426,6 +439,19 @@ def test_get_encounter_xp():
     assert expected == actual
 
 
+def test_get_encounter_xp_by_fid():
+    expected = api.get_encounter_xp([['Aarakocra', 4], ['Air Elemental', 1]])
+    actual = api.get_encounter_xp([['Aarakocra', 4]], [['mm.air-elemental', 1]])
+    assert expected == actual
+    assert expected == api.get_encounter_xp(
+        [], [['mm.aarakocra', 4], ['mm.air-elemental', 1]])
+
+
+def test_monster_crs_match_database_lookup():
+    names = ["Tarrasque", "Aarakocra", "Not A Monster"]
+    assert api.main.get_monster_crs(names) == api.get_monster_crs(names)
+
+
 def test_ingest_custom_csv(setup_database):
 
     csv_string = converter.load_csv_from_file("tal'dorei.csv")
@@ -437,6 +463,7 @@ def test_ingest_custom_csv(setup_database):
     c.execute("SELECT COUNT(*) FROM monsters")
     assert c.fetchone()[0] == 16
     conn.close()  # added to prevent "file in use" error on windows
+    db.close_connections("test.db")
     os.remove("test.db")
 
 
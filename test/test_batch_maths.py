@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import random
+
+from ktc import batch_maths, main
+
+
+def random_encounters(rng, count):
+    return [[(rng.choice(batch_maths.challenge_ratings), rng.randint(0, 6))
+             for _ in range(rng.randint(1, 4))] for _ in range(count)]
+
+
+def random_parties(rng, count):
+    return [[(rng.randint(1, 5), rng.randint(1, 20)) for _ in range(rng.randint(1, 3))]
+            for _ in range(count)]
+
+
+def test_adjusted_xp_matches_cr_calc():
+    rng = random.Random(1)
+    encounters = random_encounters(rng, 500)
+
+    xp = batch_maths.adjusted_xp(batch_maths.encounter_matrix(encounters))
+    expected = [main.cr_calc([challenge_rating for (challenge_rating, _) in encounter],
+                             [quantity for (_, quantity) in encounter]) for encounter in encounters]
+    assert expected == xp.tolist()
+
+
+def test_party_thresholds_match_party_thresholds_calc():
+    rng = random.Random(2)
+    parties = random_parties(rng, 100)
+
+    thresholds = batch_maths.party_thresholds(batch_maths.party_matrix(parties))
+    assert [main.party_thresholds_calc(party)
+            for party in parties] == thresholds.tolist()
+
+
+def test_difficulties_match_diff_calc():
+    rng = random.Random(3)
+    encounters = random_encounters(rng, 50)
+    parties = random_parties(rng, 20)
+
+    xp = batch_maths.adjusted_xp(batch_maths.encounter_matrix(encounters))
+    thresholds = batch_maths.party_thresholds(batch_maths.party_matrix(parties))
+    difficulties = batch_maths.difficulty_names(
+        batch_maths.difficulty_bands(thresholds, xp))
+
+    assert [[main.diff_calc(party, encounter_xp) for encounter_xp in xp.tolist()]
+            for party in parties] == difficulties
+
+
+def test_empty_encounter_is_worth_nothing():
+    assert [0] == batch_maths.adjusted_xp(
+        batch_maths.encounter_matrix([[]])).tolist()
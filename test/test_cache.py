@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from ktc import cache
+
+
+def test_cache_returns_cached_value():
+    result_cache = cache.LRUCache("test_returns", 2)
+    result_cache.put("a", 1)
+    assert 1 == result_cache.get("a")
+    assert None is result_cache.get("b")
+    assert {"size": 1, "max_size": 2, "hits": 1,
+            "misses": 1, "evictions": 0} == result_cache.stats()
+
+
+def test_cache_evicts_least_recently_used():
+    result_cache = cache.LRUCache("test_evicts", 2)
+    result_cache.put("a", 1)
+    result_cache.put("b", 2)
+    result_cache.get("a")
+    result_cache.put("c", 3)
+
+    assert 1 == result_cache.get("a")
+    assert None is result_cache.get("b")
+    assert 3 == result_cache.get("c")
+    assert 1 == result_cache.stats()["evictions"]
+
+
+def test_cache_computes_only_on_miss():
+    result_cache = cache.LRUCache("test_computes", 2)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert 1 == result_cache.get_or_compute("a", compute)
+    assert 1 == result_cache.get_or_compute("a", compute)
+    assert 1 == len(calls)
+
+
+def test_caches_are_registered():
+    result_cache = cache.LRUCache("test_registered", 2)
+    assert cache.caches["test_registered"] is result_cache
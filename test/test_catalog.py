@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+
+import pytest
+
+from ktc import api, catalog, converter, db
+
+CSV_HEADER = "fid,name,cr,size,type,tags,section,alignment,environment,ac,hp,init,lair?,legendary?,unique?,sources,\n"
+
+
+@pytest.fixture
+def catalog_database():
+    try:
+        os.remove("test_catalog.db")
+    except FileNotFoundError:
+        pass
+    conn = converter.configure_db("test_catalog.db")
+    csv_string = CSV_HEADER + \
+        """mot.monster_one,Monster One,1,Medium,Beast,,,,forest,,,,,,,Mythic Odysseys of Theros: 123,
+kuk.monster_two,Monster Two,5,Large,Fiend,,,chaotic evil,"Forest, Swamp",,,,,,,Klarota's Underdark Kingdom: 456,"""
+    converter.ingest_data(csv_string, "test_catalog.db", "catalogkey")
+
+    yield "test_catalog.db"
+
+    conn.close()
+    db.close_connections("test_catalog.db")
+    os.remove("test_catalog.db")
+
+
+parameter_sets = [
+    {},
+    {"sizes": ["sizes_Medium", "sizes_Large"]},
+    {"environments": ["_forest", "_ARCTIC"]},
+    {"sources": ["_Monster Manual"], "customSourcesUsed": ["_Tome of Beasts"]},
+    {"types": ["_Dragon", "_Undead"], "alignments": ["_neutral"]},
+    {"minimumChallengeRating": "1/4", "maximumChallengeRating": "5"},
+    {"allowLegendary": "false", "allowNamed": "false"},
+    {"minimumChallengeRating": "5", "maximumChallengeRating": "8", "minimumAc": "17"},
+    {"minimumHp": 100, "maximumHp": "150", "maximumInit": "0"},
+    {"minimumInit": "3", "maximumAc": 12},
+]
+
+
+@pytest.mark.parametrize("parameters", parameter_sets)
+def test_catalog_matches_database_query(parameters):
+    monster_catalog = catalog.get_catalog(api.db_location, api.format_monster)
+    constraints = api.parse_monster_parameters(parameters)
+
+    expected = api.query_monsters(constraints)
+    actual = monster_catalog.query(constraints)
+    assert expected == actual
+
+
+page_sets = [
+    (0, -1, "", 0, False),
+    (20, 15, "", 0, True),
+    (5, 50, "", 1, False),
+    (0, 100, "", 7, True),
+    (0, 30, "", 11, False),
+    (10, 10, "giant", 2, False),
+    (0, -1, "DRAGON red", 1, True),
+    (0, -1, "100%", 0, False),
+    (0, 10, "no_such_monster", 0, False),
+]
+
+
+@pytest.mark.parametrize("page", page_sets)
+@pytest.mark.parametrize("parameters", parameter_sets[:4])
+def test_catalog_page_matches_database_query(parameters, page):
+    monster_catalog = catalog.get_catalog(api.db_location, api.format_monster)
+    constraints = api.parse_monster_parameters(parameters)
+
+    expected = api.query_page_of_monsters(constraints, *page)
+    actual = monster_catalog.query_page(constraints, *page)
+    assert expected == actual
+
+
+def test_facet_counts_match_toggled_queries():
+    parameters = {"environments": ["_forest"], "sizes": ["_Large"], "minimumChallengeRating": "1"}
+    counts = api.get_facet_counts(parameters)
+
+    for (facet, value_counts) in counts.items():
+        for (value, count) in value_counts.items():
+            toggled = dict(parameters, **{facet: [f"_{value}"]})
+            constraints = api.parse_monster_parameters(toggled)
+            # The parameter parsing can't handle values containing "_"
+            if "_" not in value:
+                assert len(api.query_monsters(constraints)) == count, (facet, value)
+
+
+def test_facet_counts_ignore_own_facet(catalog_database):
+    monster_catalog = catalog.get_catalog(catalog_database, api.format_monster)
+    constraints = api.parse_monster_parameters(
+        {"environments": ["_swamp"], "sources": ["_Klarota's Underdark Kingdom", "_Mythic Odysseys of Theros"]})
+    counts = monster_catalog.facet_counts(constraints)
+
+    # Environments match regardless of case, like the LIKE they stand in for
+    assert {"forest": 2, "Forest": 2, "Swamp": 1} == counts["environments"]
+    assert {"Medium": 0, "Large": 1} == counts["sizes"]
+    assert {"Klarota's Underdark Kingdom": 1, "Mythic Odysseys of Theros": 0} == counts["sources"]
+
+
+def test_catalog_official_sources_match_database():
+    monster_catalog = catalog.get_catalog(api.db_location, api.format_monster)
+    assert api.get_list_of_sources() == monster_catalog.official_sources
+
+
+def test_catalog_environment_match_ignores_ascii_case(catalog_database):
+    monster_catalog = catalog.get_catalog(catalog_database, api.format_monster)
+    constraints = api.parse_monster_parameters(
+        {"environments": ["_SWAMP"], "sources": ["_Klarota's Underdark Kingdom", "_Mythic Odysseys of Theros"]})
+
+    actual = monster_catalog.query(constraints)
+    assert ["Monster Two"] == [monster[0] for monster in actual]
+
+
+def test_catalog_reloads_after_ingest(catalog_database):
+    monster_catalog = catalog.get_catalog(catalog_database, api.format_monster)
+    loaded_version = monster_catalog.version
+    constraints = api.parse_monster_parameters(
+        {"sources": ["_Klarota's Underdark Kingdom", "_Mythic Odysseys of Theros"]})
+    assert 2 == len(monster_catalog.query(constraints))
+
+    csv_string = CSV_HEADER + \
+        "mot.monster_three,Monster Three,2,Small,Beast,,,,,,,,,,,Mythic Odysseys of Theros: 124,"
+    converter.ingest_data(csv_string, catalog_database, "anothercatalogkey")
+
+    monster_catalog = catalog.get_catalog(catalog_database, api.format_monster)
+    assert monster_catalog.version > loaded_version
+    actual = monster_catalog.query(constraints)
+    assert ["Monster One", "Monster Three", "Monster Two"] == [
+        monster[0] for monster in actual]
+
+
+def test_catalog_is_not_reloaded_without_ingest(catalog_database):
+    monster_catalog = catalog.get_catalog(catalog_database, api.format_monster)
+    formatted = monster_catalog.formatted
+
+    assert formatted is catalog.get_catalog(
+        catalog_database, api.format_monster).formatted
+
+
+def test_incremental_update_matches_full_load(catalog_database):
+    monster_catalog = catalog.get_catalog(catalog_database, api.format_monster)
+
+    # Monster Two gets renamed to Monster Two (KUK) by the official monster of the same name
+    csv_string = CSV_HEADER + \
+        """mot.monster_two,Monster Two,3,Tiny,Dragon,,,lawful good,arctic,,,,,,,Mythic Odysseys of Theros: 130,
+mot.monster_four,Monster Four,4,Huge,Dragon,,,lawful good,arctic,,,,,,,Mythic Odysseys of Theros: 131,"""
+    converter.ingest_data(csv_string, catalog_database, "yetanothercatalogkey")
+
+    updated = catalog.get_catalog(catalog_database, api.format_monster)
+    assert updated is not monster_catalog
+    reloaded = catalog.load_catalog(
+        catalog_database, api.format_monster, updated.version)
+
+    assert reloaded.monsters == updated.monsters
+    assert reloaded.formatted == updated.formatted
+    assert reloaded.bitmaps == updated.bitmaps
+    assert reloaded.order == updated.order
+    assert ["Monster Four", "Monster One", "Monster Two", "Monster Two (KUK)"] == [
+        updated.monsters[rowid][0] for rowid in updated.order]
+
+
+def test_bitmaps_round_trip_positions():
+    positions = [0, 3, 8, 64, 1000]
+    assert positions == catalog.positions_from_bitmap(
+        catalog.bitmap_from_positions(positions))
+
+
+def test_monster_list_cache_ignores_parameter_order():
+    first = api.get_list_of_monsters(
+        {"sizes": ["sizes_Large", "sizes_Medium"], "types": ["_Beast", "_Beast"]})
+    hits = api.monster_list_cache.stats()["hits"]
+    second = api.get_list_of_monsters(
+        {"types": ["types_Beast"], "sizes": ["_Medium", "_Large"]})
+
+    assert first is second
+    assert hits + 1 == api.monster_list_cache.stats()["hits"]
+
+
+def test_monster_list_cache_is_invalidated_by_ingest(catalog_database, monkeypatch):
+    monkeypatch.setattr(api, "db_location", catalog_database)
+    parameters = {"sources": ["_Klarota's Underdark Kingdom", "_Mythic Odysseys of Theros"]}
+    assert 2 == len(api.get_list_of_monsters(parameters)["data"])
+
+    csv_string = CSV_HEADER + \
+        "mot.monster_three,Monster Three,2,Small,Beast,,,,,,,,,,,Mythic Odysseys of Theros: 124,"
+    converter.ingest_data(csv_string, catalog_database, "cachedcatalogkey")
+
+    assert 3 == len(api.get_list_of_monsters(parameters)["data"])
+
+
+def test_catalog_is_reloaded_after_rebuild_with_same_version(catalog_database, monkeypatch):
+    monster_catalog = catalog.get_catalog(catalog_database, api.format_monster)
+    # A rebuilt DB's user_version can come back round to the old catalog's
+    get_catalog_state = converter.get_catalog_state
+    monkeypatch.setattr(converter, "get_catalog_state", lambda db_location: (
+        get_catalog_state(db_location)[0], monster_catalog.version))
+    converter.configure_db(catalog_database).close()
+    converter.ingest_data(CSV_HEADER + "tob.zed,Zed,1,Small,Beast,,,,,,,,,,,Tome of Beasts: 1,",
+                          catalog_database, "rebuiltcatalogkey")
+
+    rebuilt = catalog.get_catalog(catalog_database, api.format_monster)
+    assert rebuilt.build != monster_catalog.build
+    assert ["Zed"] == [monster[0] for monster in rebuilt.monsters.values()]
+
+
+def test_catalog_version_sees_other_connections_writes(catalog_database):
+    version = converter.get_catalog_version(catalog_database)
+    # As another process would, without going through this process's writer
+    conn = sqlite3.connect(catalog_database)
+    with conn:
+        converter.bump_catalog_version(conn.cursor())
+    conn.close()
+
+    assert version + 1 == converter.get_catalog_version(catalog_database)
+
+
+def test_catalog_state_is_only_read_again_after_a_commit(catalog_database, monkeypatch):
+    state = converter.get_catalog_state(catalog_database)
+    connection = db.connection
+
+    def no_queries(db_location):
+        raise AssertionError("queried the DB")
+    monkeypatch.setattr(db, "connection", no_queries)
+    assert state == converter.get_catalog_state(catalog_database)
+
+    monkeypatch.setattr(db, "connection", connection)
+    converter.ingest_data(CSV_HEADER + "tob.zed,Zed,1,Small,Beast,,,,,,,,,,,Tome of Beasts: 1,",
+                          catalog_database, "changedcatalogkey")
+    assert (state[0], state[1] + 1) == converter.get_catalog_state(catalog_database)
+
+
+def test_incremental_update_sees_reused_rowids(catalog_database):
+    csv_string = CSV_HEADER + \
+        """tob.zed,Zed,1,Small,Beast,,,,,,,,,,,Tome of Beasts: 1,
+tob.foo,Foo,1,Small,Beast,,,,,,,,,,,Tome of Beasts: 2,
+tob.bar,Bar,1,Small,Beast,,,,,,,,,,,Tome of Beasts: 3,"""
+    converter.ingest_data(csv_string, catalog_database, "sheeta")
+    monster_catalog = catalog.get_catalog(catalog_database, api.format_monster)
+
+    # Foo and Bar are deleted by the diff, and a different Foo takes Foo's old rowid
+    converter.ingest_data(CSV_HEADER + "tob.zed,Zed,1,Small,Beast,,,,,,,,,,,Tome of Beasts: 1,",
+                          catalog_database, "sheeta")
+    converter.ingest_data(CSV_HEADER + "cc.foo,Foo,9,Huge,Beast,,,,,,,,,,,Creature Codex: 2,",
+                          catalog_database, "sheetb")
+
+    updated = catalog.get_catalog(catalog_database, api.format_monster)
+    assert updated is not monster_catalog
+    reloaded = catalog.load_catalog(catalog_database, api.format_monster, updated.version)
+    assert reloaded.monsters == updated.monsters
+    assert reloaded.bitmaps == updated.bitmaps
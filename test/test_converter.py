@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import concurrent.futures
+import os
+import sqlite3
+import threading
+import time
+
 import pytest
 
+from ktc import converter, db
 from ktc.converter import configure_db, ingest_data, load_csv_from_file
 
 
@@ -201,3 +208,195 @@ def test_blank_environment_replaced(populate_database):
     c.execute('''SELECT DISTINCT environment FROM monsters''')
     alignment_list = c.fetchall()
     assert [('no environment specified',)] == alignment_list
+
+
+def test_facet_tables_link_every_monster(populate_database):
+    """Expected data: every monster has a row in each junction table"""
+    conn = populate_database
+    c = conn.cursor()
+
+    c.execute('''SELECT COUNT(*) FROM monsters''')
+    monster_count = c.fetchone()[0]
+    for table in ["monster_environments", "monster_alignments", "monster_sources"]:
+        c.execute(f'''SELECT COUNT(DISTINCT monster_id) FROM {table}''')
+        assert monster_count == c.fetchone()[0]
+
+
+def test_facet_tables_give_integer_source_ids(populate_database):
+    """Expected data: monsters from the same source share a source id"""
+    conn = populate_database
+    c = conn.cursor()
+
+    c.execute('''SELECT source_id, COUNT(*) FROM monster_sources GROUP BY source_id ORDER BY source_id''')
+    assert [(1, 4), (2, 4)] == c.fetchall()
+
+
+BULK_CSVS = [
+    """fid,name,cr,size,type,tags,section,alignment,environment,ac,hp,init,lair?,legendary?,unique?,sources,
+mot.monster_one,Monster One, 1, Medium,,,,,,,,,,,,Mythic Odysseys of Theros: 123,
+kuk.monster_two,Monster Two, 1, Medium,,,,,,,,,,,,Klarota's Underdark Kingdom: 456,
+kuk.monster_three,Monster Three, 1, Medium,,,,,,,,,,,,Klarota's Underdark Kingdom: 456,""",
+    """fid,name,cr,size,type,tags,section,alignment,environment,ac,hp,init,lair?,legendary?,unique?,sources,
+gos.monster_one,Monster One, 2, Large,,,,,,,,,,,,Ghosts of Saltmarsh: 123,
+mot.monster_two,Monster Two, 1, Medium,,,,,,,,,,,,Mythic Odysseys of Theros: 124,
+tob.monster_three,Monster Three, 1, Medium,,,,,,,,,,,,Tome of Beasts: 7,""",
+]
+
+
+def dump_database(db_location):
+    conn = sqlite3.connect(db_location)
+    tables = {table: conn.execute(f'''SELECT rowid, * FROM {table} ORDER BY rowid''').fetchall()
+              for table in ["monsters", "sources"]}
+    conn.close()
+    return tables
+
+
+def test_bulk_ingest_gives_the_same_database():
+    dumps = []
+    for bulk in [False, True]:
+        db_location = f"testing_bulk_{bulk}.db"
+        configure_db(db_location).close()
+        for (i, csv_string) in enumerate(BULK_CSVS):
+            ingest_data(csv_string, db_location, f"bulkkey{i}", bulk=bulk)
+        dumps.append(dump_database(db_location))
+        db.close_connections(db_location)
+        os.remove(db_location)
+
+    assert dumps[0] == dumps[1]
+    # Make sure the name-twin renaming happened at all
+    assert sorted(monster[2] for monster in dumps[1]["monsters"]) == [
+        "Monster One", "Monster Three (KUK)", "Monster Three (ToB)", "Monster Two", "Monster Two (KUK)"]
+
+
+def test_parallel_ingest_gives_the_same_database(monkeypatch):
+    # Small chunks, so that the rows of each CSV are split between the workers
+    monkeypatch.setattr(converter, "ingest_chunk_size", 2)
+    dumps = []
+    for workers in [0, 2]:
+        db_location = f"testing_parallel_{workers}.db"
+        configure_db(db_location).close()
+        for (i, csv_string) in enumerate(BULK_CSVS):
+            ingest_data(csv_string, db_location, f"parallelkey{i}", bulk=True, workers=workers)
+        dumps.append(dump_database(db_location))
+        db.close_connections(db_location)
+        os.remove(db_location)
+
+    assert dumps[0] == dumps[1]
+
+
+SHEET_HEADER = "fid,name,cr,size,type,tags,section,alignment,environment,ac,hp,init,lair?,legendary?,unique?,sources,\n"
+SHEET_ROWS = ["tob.monster_one,Monster One, 1, Medium,,,,,,,,,,,,Tome of Beasts: 1,",
+              "tob.monster_two,Monster Two, 2, Medium,,,,,,,,,,,,Tome of Beasts: 2,",
+              "tob.monster_three,Monster Three, 3, Medium,,,,,,,,,,,,Tome of Beasts: 3,",
+              "cc.monster_four,Monster Four, 4, Medium,,,,,,,,,,,,Creature Codex: 4,"]
+UPDATED_SHEET_ROWS = ["tob.monster_one,Monster One, 1, Medium,,,,,,,,,,,,Tome of Beasts: 1,",
+                      "tob.monster_two,Monster Two, 5, Huge,,,,,,,,,,,,Tome of Beasts: 2,",
+                      "tob.monster_five,Monster Five, 5, Medium,,,,,,,,,,,,Tome of Beasts: 5,"]
+
+
+def sheet_contents(db_location):
+    conn = sqlite3.connect(db_location)
+    contents = {table: sorted(conn.execute(f'''SELECT * FROM {table}''').fetchall())
+                for table in ["monsters", "sources"]}
+    conn.close()
+    return contents
+
+
+def test_resubmitted_sheet_is_diffed(setup_database):
+    ingest_data(SHEET_HEADER + "\n".join(SHEET_ROWS), "testing.db", "diffkey")
+    conn = sqlite3.connect("testing.db")
+    rowid = conn.execute('''SELECT rowid FROM monsters WHERE name = "Monster One"''').fetchone()
+
+    assert "Tome of Beasts" == ingest_data(SHEET_HEADER + "\n".join(UPDATED_SHEET_ROWS), "testing.db", "diffkey")
+
+    # The unchanged row's monster is left alone
+    assert rowid == conn.execute('''SELECT rowid FROM monsters WHERE name = "Monster One"''').fetchone()
+    assert [("Monster Five",), ("Monster One",), ("Monster Two",)] == conn.execute(
+        '''SELECT name FROM monsters WHERE sources LIKE "Tome of Beasts%" ORDER BY name''').fetchall()
+    assert ("5", "Huge") == conn.execute(
+        '''SELECT cr, size FROM monsters WHERE name = "Monster Two"''').fetchone()
+    assert [] == conn.execute('''SELECT * FROM monsters WHERE name IN ("Monster Three", "Monster Four")''').fetchall()
+    assert [] == conn.execute('''SELECT * FROM sources WHERE name = "Creature Codex"''').fetchall()
+    conn.close()
+
+
+def test_diffed_sheet_matches_a_fresh_ingest():
+    contents = []
+    for (db_location, versions) in [("testing_diff.db", [SHEET_ROWS, UPDATED_SHEET_ROWS]),
+                                    ("testing_fresh.db", [UPDATED_SHEET_ROWS])]:
+        configure_db(db_location).close()
+        for rows in versions:
+            ingest_data(SHEET_HEADER + "\n".join(rows), db_location, "diffkey")
+        contents.append(sheet_contents(db_location))
+        db.close_connections(db_location)
+        os.remove(db_location)
+
+    assert contents[0] == contents[1]
+
+
+def test_queued_ingests_are_committed_together(setup_database):
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking_write(cursor):
+        started.set()
+        release.wait(10)
+    blocked = converter.submit_write("testing.db", blocking_write)
+    assert started.wait(10)
+    groups = converter.writer_metrics.stats()["groups"]
+
+    def failing_write(cursor):
+        cursor.execute('''DELETE FROM monsters''')
+        raise KeyError("sources")
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        ingests = [executor.submit(ingest_data, SHEET_HEADER + "\n".join(SHEET_ROWS), "testing.db", "groupkey")]
+        # Queue them in order
+        while converter._write_queue.qsize() < 1:
+            time.sleep(0.001)
+        failing = converter.submit_write("testing.db", failing_write)
+        ingests.append(executor.submit(ingest_data, SHEET_HEADER + "\n".join(SHEET_ROWS), "testing.db", "groupkey"))
+        while converter._write_queue.qsize() < 3:
+            time.sleep(0.001)
+        release.set()
+        blocked.result(10)
+
+        assert "Tome of Beasts, Creature Codex" == ingests[0].result(10)
+        # Only the failing write is rolled back
+        with pytest.raises(KeyError):
+            failing.result(10)
+        # The second submission of the sheet finds the first, and has nothing to change
+        assert "Tome of Beasts, Creature Codex" == ingests[1].result(10)
+
+    # One group for the blocking write, and one for all the ingests queued behind it
+    assert groups + 2 == converter.writer_metrics.stats()["groups"]
+    conn = sqlite3.connect("testing.db")
+    assert 4 == conn.execute('''SELECT COUNT(*) FROM monsters''').fetchone()[0]
+    conn.close()
+
+
+
+def streamed_rows(count, progress, max_ahead):
+    for i in range(count):
+        # Rows are only read a bounded distance ahead of the ones written
+        assert i - progress.rows_written <= max_ahead
+        yield {"fid": f"tob.monster_{i}", "name": f"Monster {i}", "cr": "1", "size": "Medium", "type": "",
+               "alignment": "", "environment": "", "ac": "", "hp": "", "init": "", "lair?": "",
+               "sources": f"Tome of Beasts: {i}"}
+
+
+@pytest.mark.parametrize("bulk", [False, True])
+def test_ingest_reads_rows_a_chunk_at_a_time(setup_database, bulk):
+    progress = converter.IngestProgress()
+    converter.ingest_rows(streamed_rows(100, progress, 1), "testing.db", "streamedkey", bulk, progress=progress)
+
+    assert 100 == progress.rows_written
+
+
+def test_parallel_ingest_reads_rows_a_chunk_at_a_time(setup_database, monkeypatch):
+    monkeypatch.setattr(converter, "ingest_chunk_size", 10)
+    progress = converter.IngestProgress()
+    converter.ingest_rows(streamed_rows(100, progress, 5 * 10), "testing.db", "parallelstreamedkey",
+                          workers=2, progress=progress)
+
+    assert 100 == progress.rows_written
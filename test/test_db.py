@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+import pytest
+
+from ktc import db
+
+
+@pytest.fixture
+def pooled_database():
+    yield "test_pool.db"
+
+    db.close_connections("test_pool.db")
+    for suffix in ["", "-wal", "-shm"]:
+        try:
+            os.remove("test_pool.db" + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def test_connection_is_reused(pooled_database):
+    with db.connection(pooled_database) as conn:
+        first = conn
+    with db.connection(pooled_database) as conn:
+        assert first is conn
+
+
+def test_nested_connections_are_different(pooled_database):
+    with db.connection(pooled_database) as outer:
+        with db.connection(pooled_database) as inner:
+            assert outer is not inner
+
+
+def test_pragmas_are_applied(pooled_database):
+    with db.connection(pooled_database) as conn:
+        assert "wal" == conn.execute("PRAGMA journal_mode").fetchone()[0]
+        assert 5000 == conn.execute("PRAGMA busy_timeout").fetchone()[0]
+
+
+def test_uncommitted_changes_are_rolled_back(pooled_database):
+    with db.connection(pooled_database) as conn:
+        conn.execute("CREATE TABLE numbers (number int)")
+        conn.commit()
+        conn.execute("INSERT INTO numbers VALUES (1)")
+
+    with db.connection(pooled_database) as conn:
+        assert 0 == conn.execute("SELECT COUNT(*) FROM numbers").fetchone()[0]
+
+
+def test_replaced_file_gets_a_new_connection(pooled_database):
+    with db.connection(pooled_database) as conn:
+        conn.execute("CREATE TABLE numbers (number int)")
+        conn.commit()
+        first = conn
+
+    os.remove(pooled_database)
+    with db.connection(pooled_database) as conn:
+        assert first is not conn
+        tables = conn.execute("SELECT name FROM sqlite_master").fetchall()
+        assert [] == tables
+
+
+def test_connections_are_shared_between_threads(pooled_database):
+    with db.connection(pooled_database) as conn:
+        conn.execute("CREATE TABLE numbers (number int)")
+        conn.commit()
+
+    def insert(number):
+        with db.connection(pooled_database) as conn:
+            conn.execute("INSERT INTO numbers VALUES (?)", (number,))
+            conn.commit()
+
+    threads = [threading.Thread(target=insert, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with db.connection(pooled_database) as conn:
+        assert 20 == conn.execute("SELECT COUNT(*) FROM numbers").fetchone()[0]
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-from ktc.main import diff_calc, cr_calc, get_encounter_difficulty, get_monster_cr
+from ktc.main import diff_calc, cr_calc, get_encounter_difficulty, get_monster_cr, get_monster_crs, \
+    canonical_party, party_thresholds_calc
 
 
 class TestDifficultyCalculator:
@@ -44,6 +45,14 @@ class TestGetMonsterCr:
     def test_get_tarrasque_cr(self):
         assert get_monster_cr("Tarrasque") == "30"
 
+    def test_get_many_crs_at_once(self):
+        assert get_monster_crs(["Tarrasque", "Aarakocra", "Tarrasque", "Not A Monster"]) == {
+            "Tarrasque": "30", "Aarakocra": "1/4"}
+
+    def test_get_crs_by_fid(self):
+        assert get_monster_crs(["mm.tarrasque", "mm.aarakocra"], by_fid=True) == {
+            "mm.tarrasque": "30", "mm.aarakocra": "1/4"}
+
 
 class TestGetEncounterDifficulty:
     def test_encounter_difficulty_single_level_single_monster(self):
@@ -65,3 +74,18 @@ class TestGetEncounterDifficulty:
         party = [(4, 5), (1, 6)]
         monsters = [("Air Elemental", 2), ("Allosaurus", 1)]
         assert get_encounter_difficulty(party, monsters) == (8100, "deadly")
+
+
+class TestPartyThresholds:
+    def test_canonical_party_ignores_grouping(self):
+        assert canonical_party([(4, 3), (1, 3)]) == ((3, 5),)
+        assert canonical_party([(1, 6), (0, 2), (4, 5)]) == ((5, 4), (6, 1))
+
+    def test_thresholds_are_the_same_however_the_party_is_grouped(self):
+        assert party_thresholds_calc([(4, 5), (1, 6)]) == party_thresholds_calc(
+            [(1, 6), (2, 5), (2, 5)]) == [1300, 2600, 3900, 5800, 18000]
+
+    def test_memoized_thresholds_cannot_be_changed_by_callers(self):
+        thresholds = party_thresholds_calc([(4, 3)])
+        thresholds[0] = 0
+        assert party_thresholds_calc([(4, 3)])[0] == 300
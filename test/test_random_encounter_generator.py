@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import random
+from fractions import Fraction
+
+import pytest
+
+from ktc import api, main, random_encounter_generator
+
+
+def make_monster(name, cr, monster_type="beast"):
+    return random_encounter_generator.Monster([name, cr, "Medium", monster_type, "", "", "unaligned", ""])
+
+
+def encounter_xp(monsters, encounter):
+    crs = {monster.name: monster.cr for monster in monsters}
+    return main.cr_calc([crs[name] for (_, name) in encounter], [quantity for (quantity, _) in encounter])
+
+
+def test_solved_encounters_fit_the_xp_range():
+    monsters = [make_monster("Wolf", "1/4"), make_monster("Dire Wolf", "1"),
+                make_monster("Brown Bear", "1"), make_monster("Giant Elk", "2")]
+    for _ in range(50):
+        encounter = random_encounter_generator.solve_encounter(random_encounter_generator.cr_buckets(monsters), 900, 1600, random.Random())
+        assert 900 < encounter_xp(monsters, encounter) < 1600
+        assert all(1 <= quantity <= random_encounter_generator.max_quantity_per_cr
+                   for (quantity, _) in encounter)
+
+
+def test_solver_finds_the_only_encounter_that_fits():
+    monsters = [make_monster("Wolf", "1/4"), make_monster("Giant Elk", "2")]
+    # Only one Giant Elk and two Wolves, at (450 + 100) * 2, is worth between 1000 and 1200 XP
+    for _ in range(10):
+        encounter = random_encounter_generator.solve_encounter(random_encounter_generator.cr_buckets(monsters), 1000, 1200, random.Random())
+        assert [(1, "Giant Elk"), (2, "Wolf")] == encounter
+
+
+def test_solver_gives_none_when_nothing_fits():
+    monsters = [make_monster("Tarrasque", "30")]
+    assert random_encounter_generator.solve_encounter(random_encounter_generator.cr_buckets(monsters), 100, 200, random.Random()) is None
+
+
+def test_solver_tables_stop_at_the_largest_encounter(monkeypatch):
+    shapes = []
+    zeros = random_encounter_generator.np.zeros
+    monkeypatch.setattr(random_encounter_generator.np, "zeros",
+                        lambda shape: shapes.append(shape) or zeros(shape))
+    monsters = [make_monster("Wolf", "1/4"), make_monster("Dire Wolf", "1")]
+    encounter = random_encounter_generator.solve_encounter(
+        random_encounter_generator.cr_buckets(monsters), 100, 10 ** 9, random.Random())
+
+    assert 100 < encounter_xp(monsters, encounter)
+    # XP is counted in steps of 50, and no encounter is worth more than the largest one of Dire Wolves
+    max_size = random_encounter_generator.max_encounter_size
+    assert [(max_size + 1, max_size * 200 // 50 + 1)] == shapes
+
+
+def test_exact_solver_keeps_to_one_type():
+    candidates = random_encounter_generator.candidate_pool(
+        [make_monster("Wolf", "1/4"), make_monster("Zombie", "1/4", "undead"), make_monster("Ghoul", "1", "undead")])
+    encounter = random_encounter_generator.exact_encounter(candidates, 300, 600, random.Random())
+    names = {name for (_, name) in encounter}
+    assert names <= {"Wolf"} or names <= {"Zombie", "Ghoul"}
+
+
+def test_exact_solver_raises_when_nothing_fits():
+    with pytest.raises(ValueError):
+        random_encounter_generator.exact_encounter(
+            random_encounter_generator.candidate_pool([make_monster("Tarrasque", "30", "monstrosity")]),
+            100, 200, random.Random())
+
+
+def test_candidate_pools_are_reused():
+    pool = random_encounter_generator.get_candidate_pool(["_forest"], ["_Monster Manual"], ("common",))
+    assert pool is random_encounter_generator.get_candidate_pool(
+        ["_forest", "_forest"], ["_Monster Manual"], ("common",))
+    assert pool.monsters
+    assert all(random_encounter_generator.get_monster_rarity(
+        [monster.name, monster.cr, monster.size, monster.type]) == "common" for monster in pool.monsters)
+    for (monster_type, monsters) in pool.by_type.items():
+        assert all(monster.type == monster_type for monster in monsters)
+
+
+def test_candidate_pools_match_rarity_filter():
+    pool = random_encounter_generator.get_candidate_pool([], ["_Monster Manual"], ("very rare", "rare"))
+    monsters = api.get_list_of_monsters({"environments": [], "sources": ["_Monster Manual"],
+                                         "allowLegendary": False, "allowNamed": False})["data"]
+
+    assert [monster[0] for monster in monsters if random_encounter_generator.fits_rarity(
+        monster, ("very rare", "rare"))] == [monster.name for monster in pool.monsters]
+
+
+@pytest.mark.parametrize("solver", random_encounter_generator.solvers)
+def test_same_seed_gives_same_encounter(solver):
+    params = {"party": [(4, 3)], "difficulty": "hard", "solver": solver}
+    rolls = [random_encounter_generator.build_encounter(params, random.Random("a seed")) for _ in range(2)]
+    assert rolls[0] == rolls[1]
+
+
+def test_seeded_encounters_are_cached():
+    params = {"party": [(5, 7)], "difficulty": "easy", "seed": 1234}
+    first = random_encounter_generator.generate(params)
+    hits = random_encounter_generator.encounter_cache.stats()["hits"]
+
+    assert first == random_encounter_generator.generate(dict(params, seed="1234"))
+    assert hits + 1 == random_encounter_generator.encounter_cache.stats()["hits"]
+
+
+def test_impossible_encounters_are_rejected_without_searching():
+    failures = random_encounter_generator.generator_metrics.stats()["infeasible"]
+    with pytest.raises(random_encounter_generator.EncounterGenerationError) as error:
+        random_encounter_generator.generate({"party": [(1, 1)], "environments": ["_nowhere"]})
+
+    assert 0 == error.value.attempts
+    assert failures + 1 == random_encounter_generator.generator_metrics.stats()["infeasible"]
+
+
+def test_achievable_xp_bounds_the_pool():
+    candidates = random_encounter_generator.candidate_pool(
+        [make_monster("Wolf", "1/4"), make_monster("Giant Elk", "2"), make_monster("Zombie", "1/4", "undead")])
+    # 3 Giant Elk, then 3 Giant Elk and 3 Wolves, at the multiplier for 9 monsters
+    assert (50, int((3 * 450 + 3 * 500) * 2.5)) == (candidates.min_xp, candidates.max_xp)
+
+
+def test_generation_stops_when_out_of_attempts(monkeypatch):
+    monkeypatch.setattr(random_encounter_generator, "max_attempts", 0)
+    with pytest.raises(random_encounter_generator.EncounterGenerationError) as error:
+        random_encounter_generator.generate({"party": [(4, 5)]})
+
+    assert 0 == error.value.attempts
+
+
+def test_cr_buckets_go_from_highest_cr_to_lowest():
+    monsters = [make_monster("Wolf", "1/4"), make_monster("Giant Elk", "2"),
+                make_monster("Rat", "0"), make_monster("Jackal", "0")]
+    buckets = random_encounter_generator.cr_buckets(monsters)
+
+    assert ["2", "1/4", "0"] == [bucket.cr for bucket in buckets]
+    assert [450, 50, 10] == [bucket.xp for bucket in buckets]
+    assert ["Rat", "Jackal"] == [monster.name for monster in buckets[-1].monsters]
+
+
+def test_taldorei_profile_matches_its_tables():
+    profile = random_encounter_generator.get_rarity_profile(None)
+    assert "common" == profile.rarity("6", "Beast")
+    assert "rare" == profile.rarity("3", "celestial")
+    assert "very rare" == profile.rarity("21", "Fiend")
+    assert "very rare" == profile.rarity("1", "Swarm of Tiny beasts")
+    assert profile.rarity("1/4", "undead") == profile.calculate_rarity("1/4", "undead")
+
+
+def test_custom_rarity_profiles_change_the_pools():
+    definition = {"thresholds": [1, 2, 3], "modifiers": {"undead": 0}}
+    profile = random_encounter_generator.get_rarity_profile(definition)
+    assert profile is random_encounter_generator.get_rarity_profile(dict(definition))
+
+    pools = random_encounter_generator.get_candidate_pools([], ["_Monster Manual"], profile)
+    assert {"Undead"} == set(pools[("common",)].by_type)
+    assert all(float(Fraction(monster.cr)) < 1 for monster in pools[("common",)].monsters)
+
+
+def test_named_rarity_profiles(monkeypatch):
+    monkeypatch.setattr(random_encounter_generator, "rarity_profiles",
+                        dict(random_encounter_generator.rarity_profiles))
+    profile = random_encounter_generator.define_rarity_profile("undead only", [30, 30, 30], {"undead": 0})
+    encounter = random_encounter_generator.generate(
+        {"party": [(4, 5)], "rarityProfile": "undead only", "seed": 7})
+
+    pools = random_encounter_generator.get_candidate_pools(
+        [], random_encounter_generator.default_sources, profile)
+    assert {name for (_, name) in encounter} <= {monster.name for monster in pools[("common",)].by_type["Undead"]}
+
+
+def test_unknown_rarity_profiles_are_rejected():
+    with pytest.raises(random_encounter_generator.EncounterGenerationError):
+        random_encounter_generator.get_rarity_profile("nowhere")
+    with pytest.raises(random_encounter_generator.EncounterGenerationError):
+        random_encounter_generator.get_rarity_profile({"thresholds": [1, 2], "modifiers": {}})